@@ -0,0 +1,120 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Dense annotations from the object index and depth passes of the same Cycles render as the image (render_image.py --annotations).
+# Next to every customclevr_<split>_<imgidx>.png, render_image.py writes:
+#   ..._mask.png         instance mask: 0 for the background, objidx + 1 for the pixels of each object (8-bit png)
+#   ..._depth.png        depth along the camera's view axis in units of 1/DEPTH_SCALE (16-bit png; 0 where nothing was hit)
+#   ..._annotations.json per-object pixel counts and bounding boxes
+# Run this file directly to merge the annotations into ../output/customclevr_<split>_scenes.json.
+# Both passes take the first sample of each pixel (they are not antialiased), so every pixel belongs to exactly one object.
+from __future__ import print_function
+import argparse
+import json
+import os
+
+import numpy as np
+
+import pngio
+
+
+DEPTH_SCALE = 1000.0 # depth png units per blender unit (millimeters), so depths up to 65.535 fit in 16 bits
+
+
+def mask_path(img_path:str) -> str:
+    return img_path[:-len(".png")] + "_mask.png"
+
+
+def depth_path(img_path:str) -> str:
+    return img_path[:-len(".png")] + "_depth.png"
+
+
+def annotations_path(img_path:str) -> str:
+    return img_path[:-len(".png")] + "_annotations.json"
+
+
+def object_annotations(mask:np.ndarray, n_objects:int) -> list:
+    """
+    pixel count and bounding box [xmin, ymin, xmax, ymax] (inclusive, in pixel_coords' convention: x right, y down from the
+    top left corner) of every object in a height x width instance mask; the bounding box is None if the object is not visible
+    """
+    objects = []
+    counts = np.bincount(mask.ravel(), minlength=n_objects + 1)
+    for objidx in range(n_objects):
+        if counts[objidx + 1] == 0:
+            objects.append({"pixels":0, "bbox":None})
+            continue
+        rows = np.nonzero((mask == objidx + 1).any(axis=1))[0]
+        cols = np.nonzero((mask == objidx + 1).any(axis=0))[0]
+        objects.append({"pixels":int(counts[objidx + 1]), "bbox":[int(cols[0]), int(rows[0]), int(cols[-1]), int(rows[-1])]})
+    return objects
+
+
+def write_annotations(img_path:str, split:str, imgidx:int, index:np.ndarray, depth:np.ndarray, n_objects:int):
+    """
+    writes the mask, depth map and annotations of one image next to img_path
+    - index, depth: height x width object index and depth passes, top row first
+    """
+    mask = np.clip(np.round(index), 0, n_objects).astype(np.uint8 if n_objects < 256 else np.uint16)
+    depth = np.round(depth * DEPTH_SCALE)
+    depth[~(depth <= 65535)] = 0 # the background (cycles' depth pass is 1e10 where no object was hit)
+    pngio.write_png(mask_path(img_path), mask)
+    pngio.write_png(depth_path(img_path), depth.astype(np.uint16))
+    annotations = {"split":split, "image_index":imgidx, "mask_filename":os.path.basename(mask_path(img_path)),
+                   "depth_filename":os.path.basename(depth_path(img_path)), "objects":object_annotations(mask, n_objects)}
+    with open(annotations_path(img_path), "w") as f: # written last, so it only exists if the png files are complete
+        json.dump(annotations, f)
+
+
+def read_depth(img_path:str) -> np.ndarray:
+    """height x width depth map of an image in blender units (nan where nothing was hit)"""
+    depth = pngio.read_png(depth_path(img_path))[:, :, 0].astype(np.float32) / DEPTH_SCALE
+    depth[depth == 0] = np.nan
+    return depth
+
+
+def merge(scenes:list, img_dir:str) -> int:
+    """
+    adds the annotations of every image that has them to its scene struct: "mask_filename" and "depth_filename" per scene,
+    "mask_pixels" and "bbox" per object. modifies scenes
+    returns the number of scenes without annotations (left as they are)
+    """
+    n_missing = 0
+    for scene in scenes:
+        path = annotations_path(os.path.join(img_dir, scene["image_filename"]))
+        if not os.path.exists(path):
+            n_missing += 1
+            continue
+        with open(path, "r") as f:
+            annotations = json.load(f)
+        scene["mask_filename"] = annotations["mask_filename"]
+        scene["depth_filename"] = annotations["depth_filename"]
+        for obj, annotation in zip(scene["objects"], annotations["objects"]):
+            obj["mask_pixels"] = annotation["pixels"]
+            obj["bbox"] = annotation["bbox"]
+    return n_missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description="merge the annotations written by render_image.py --annotations into ../output/customclevr_<split>_scenes.json")
+    parser.add_argument("--splits", type=str, nargs="+", default=["trnsimple", "tstsimple"], help="which splits")
+    parser.add_argument("--img_dir", type=str, default="../output/images", help="where the images and their annotations are")
+    args = parser.parse_args()
+
+    for split in args.splits:
+        scenes_path = "../output/customclevr_" + split + "_scenes.json"
+        with open(scenes_path, "r") as f:
+            scenes = json.load(f)
+        n_missing = merge(scenes["scenes"], args.img_dir)
+        with open(scenes_path, "w") as f:
+            json.dump(scenes, f)
+        print(split + ": merged the annotations of " + str(len(scenes["scenes"]) - n_missing) + " of " + str(len(scenes["scenes"])) + " images")
+        # how well the estimate config_images.py enforced min_pixels_per_object with (see visibility.py) matches the render
+        pairs = np.array([[obj["visible_pixels"], obj["mask_pixels"]] for scene in scenes["scenes"] for obj in scene["objects"]
+                          if "visible_pixels" in obj and "mask_pixels" in obj]).reshape(-1, 2)
+        if len(pairs) > 0:
+            error = pairs[:, 0] - pairs[:, 1]
+            print("  visible_pixels estimate - rendered mask_pixels: mean %.1f, mean absolute %.1f, max absolute %d" % (error.mean(), np.abs(error).mean(), np.abs(error).max()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# Columnar storage for configs and scene metadata: a directory with a small header.json (everything that is not per-image)
+# and one .npy file per per-image field, which np.load can memory-map so readers only touch the rows and fields they use.
+# The *_config.json and *_scenes.json files can be exported from it (and converted into it).
+# Run this file directly to convert between the two formats.
+from __future__ import print_function
+import argparse
+import json
+import os
+
+import numpy as np
+
+import config_arrays
+import projection
+import relationships
+
+
+FORMAT_VERSION = 1
+
+# scene metadata columns, next to the config columns in config_arrays.OBJECT_FIELDS/OFFSET_FIELDS/IMAGE_FIELDS
+SCENE_FIELDS = ["coords_3d", "depth", "directions", "relationship_bits"]
+# ^ n_images x n_objects x 3 (3d_coords), n_images x n_objects (pixel_coords[2]), n_images x 6 x 3 (projection.DIRECTION_NAMES order),
+#   n_images x 4 x n_objects (relationships.RELATIONSHIP_NAMES order, see relationships.to_bits)
+DTYPES = {"theta":np.float64, "mat_idx":np.int8, "shape_idx":np.int8, "color_idx":np.int8, "size_idx":np.int8, "r":np.float64,
+          "pos_planex":np.float64, "pos_planey":np.float64, "camera_offset":np.float64, "key_light_offset":np.float64,
+          "fill_light_offset":np.float64, "back_light_offset":np.float64, "randomized_obj_idx":np.int16, "eyes_same_color":bool,
+          "imgidx":np.int64, "pixel_coords_x":np.int16, "pixel_coords_y":np.int16,
+          "coords_3d":np.float32, "depth":np.float64, "directions":np.float64, "relationship_bits":np.uint64}
+# ^ coords_3d are blender object locations, which are float32
+
+
+def store_path(split:str) -> str:
+    return "../output/customclevr_" + split + "_columns"
+
+
+def compute_scene_columns(config:dict, eps:float=relationships.EPS) -> dict:
+    """
+    the scene metadata of an array config (see config_arrays.py) as columns, computed without blender (see projection.py)
+    like projection.get_scenes, fills in config["pixel_coords_x"] and config["pixel_coords_y"]
+    """
+    cam_locs = projection.camera_locations(config)
+    plane_dirs = projection.get_plane_dirs(cam_locs)
+    coords = projection.object_coords(config)
+    px, py, depth = projection.get_camera_coords(cam_locs, coords)
+    config["pixel_coords_x"] = px
+    config["pixel_coords_y"] = py
+
+    scene = {}
+    scene["coords_3d"] = coords
+    scene["depth"] = depth
+    scene["directions"] = np.stack([plane_dirs[name] for name in projection.DIRECTION_NAMES], axis=1)
+    rel_dirs = np.stack([plane_dirs[name] for name in relationships.RELATIONSHIP_NAMES], axis=1)
+    scene["relationship_bits"] = np.zeros((len(coords), len(relationships.RELATIONSHIP_NAMES), config["n_objects"]), dtype=np.uint64)
+    for start in range(0, len(coords), relationships.CHUNK_SIZE):
+        chunk = slice(start, start + relationships.CHUNK_SIZE)
+        scene["relationship_bits"][chunk] = relationships.to_bits(relationships.relationship_masks(relationships.relationship_dots(coords[chunk], rel_dirs[chunk]), eps))
+    return scene
+
+
+def save(path:str, config:dict, scene:dict):
+    """writes an array config and its scene columns to directory path"""
+    os.makedirs(path, exist_ok=True)
+    columns = {}
+    columns.update({field:config[field] for field in config_arrays.OBJECT_FIELDS + config_arrays.OFFSET_FIELDS + config_arrays.IMAGE_FIELDS + ["imgidx", "pixel_coords_x", "pixel_coords_y"]})
+    columns.update({field:scene[field] for field in SCENE_FIELDS})
+
+    header = {"format_version":FORMAT_VERSION, "n_rows":len(config["imgidx"]), "columns":{}}
+    header["config"] = {key:value for key, value in config.items() if key not in columns}
+    for field, values in columns.items():
+        values = np.ascontiguousarray(values, dtype=DTYPES[field])
+        np.save(os.path.join(path, field + ".npy"), values)
+        header["columns"][field] = {"dtype":values.dtype.str, "shape":list(values.shape)}
+    with open(os.path.join(path, "header.json"), "w") as f:
+        json.dump(header, f, indent=1)
+
+
+def load(path:str, mmap:bool=True):
+    """
+    returns (config, scene) as written by save(); with mmap, columns are read-only memory maps, so nothing is read until used
+    """
+    with open(os.path.join(path, "header.json"), "r") as f:
+        header = json.load(f)
+    assert header["format_version"] == FORMAT_VERSION
+    config = dict(header["config"])
+    scene = {}
+    for field in header["columns"]:
+        values = np.load(os.path.join(path, field + ".npy"), mmap_mode="r" if mmap else None)
+        if field in SCENE_FIELDS:
+            scene[field] = values
+        else:
+            config[field] = values
+    return config, scene
+
+
+def to_json_scenes(config:dict, scene:dict, rows=None) -> list:
+    """scene structs in the *_scenes.json layout (see config_images.render_scene and compute_all_relationships) for the given rows (default all)"""
+    material_names = list(config["materials"].keys())
+    shape_names = list(config["shapes"].keys())
+    size_names = list(config["sizes"].keys())
+    color_names = list(config["colors"].keys())
+    if rows is None:
+        rows = range(len(config["imgidx"]))
+
+    all_scenes = []
+    for row in rows:
+        imgidx = int(config["imgidx"][row])
+        scene_struct = {"split":config["split"], "image_index":imgidx, "image_filename":"customclevr_" + config["split"] + "_%06d.png" % imgidx, "objects":[], "directions":{}}
+        for objidx in range(config["n_objects"]):
+            scene_struct["objects"].append({
+                "shape": shape_names[config["shape_idx"][row, objidx]],
+                "size": size_names[config["size_idx"][row, objidx]],
+                "material": material_names[config["mat_idx"][row, objidx]],
+                "3d_coords": tuple(scene["coords_3d"][row, objidx].astype(np.float64).tolist()),
+                "rotation": float(config["theta"][row, objidx]),
+                "pixel_coords": (int(config["pixel_coords_x"][row, objidx]), int(config["pixel_coords_y"][row, objidx]), float(scene["depth"][row, objidx])),
+                "color": color_names[config["color_idx"][row, objidx]],
+            })
+        scene_struct["directions"] = {name:tuple(scene["directions"][row, diridx].tolist()) for diridx, name in enumerate(projection.DIRECTION_NAMES)}
+        masks = relationships.from_bits(np.asarray(scene["relationship_bits"][row:row+1]), config["n_objects"])
+        scene_struct["relationships"] = relationships.to_lists(masks)[0]
+        all_scenes.append(scene_struct)
+    return all_scenes
+
+
+def from_json(json_config:dict, json_scenes:list):
+    """converts the contents of *_config.json and *_scenes.json to (config, scene) columns"""
+    config = config_arrays.from_json_config(json_config)
+    coords, _ = relationships.scenes_to_arrays(json_scenes)
+    scene = {}
+    scene["coords_3d"] = coords
+    scene["depth"] = np.array([[obj["pixel_coords"][2] for obj in s["objects"]] for s in json_scenes], dtype=np.float64)
+    scene["directions"] = np.array([[s["directions"][name] for name in projection.DIRECTION_NAMES] for s in json_scenes], dtype=np.float64)
+    masks = np.zeros((len(json_scenes), len(relationships.RELATIONSHIP_NAMES), config["n_objects"], config["n_objects"]), dtype=bool)
+    for imgidx, s in enumerate(json_scenes):
+        for relidx, name in enumerate(relationships.RELATIONSHIP_NAMES):
+            for objidx, related in enumerate(s["relationships"][name]):
+                masks[imgidx, relidx, objidx, related] = True
+    scene["relationship_bits"] = relationships.to_bits(masks)
+    return config, scene
+
+
+def main():
+    parser = argparse.ArgumentParser(description="convert between ../output/customclevr_<split>_{config,scenes}.json and ../output/customclevr_<split>_columns/")
+    parser.add_argument("--splits", type=str, nargs="+", default=["trnsimple", "tstsimple"], help="which splits")
+    parser.add_argument("--export", action="store_true", help="write the json files from the columns (default: write the columns from the json files)")
+    args = parser.parse_args()
+
+    for split in args.splits:
+        config_path = "../output/customclevr_" + split + "_config.json"
+        scenes_path = "../output/customclevr_" + split + "_scenes.json"
+        if args.export:
+            config, scene = load(store_path(split))
+            with open(config_path, "w") as f:
+                json.dump(config_arrays.to_json_config(config), f)
+            with open(scenes_path, "w") as f:
+                json.dump({"scenes": to_json_scenes(config, scene)}, f)
+            print("exported " + store_path(split) + " to " + config_path + " and " + scenes_path)
+        else:
+            with open(config_path, "r") as f:
+                json_config = json.load(f)
+            with open(scenes_path, "r") as f:
+                json_scenes = json.load(f)["scenes"]
+            save(store_path(split), *from_json(json_config, json_scenes))
+            print("wrote " + store_path(split))
+
+
+if __name__ == "__main__":
+    main()
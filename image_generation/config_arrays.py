@@ -0,0 +1,338 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# Array-backed version of config_images.generate_config for large splits.
+# Every per-image field is sampled for all images at once with numpy. Instead of one global random stream,
+# each random number is a hash of (image seed, stream, counter), where the image seed is derived from (split seed, imgidx).
+# So any image can be regenerated on its own, and the output does not depend on which images are generated together or in what order.
+# With several views per layout (see config_images.base_config), the objects of an image are drawn from its layout's seed
+# instead, derived from (split seed, layout index), so every view of a layout gets the same objects and its own jitter.
+# Note this draws different random numbers than generate_config, so it does not reproduce the trnsimple/tstsimple splits.
+from __future__ import print_function
+import argparse
+import json
+import time
+
+import numpy as np
+
+import image_records
+import placement
+import projection
+import visibility
+from config_images import base_config
+
+
+# per-image fields, in the order generate_config adds them; the index arrays refer to list(config[...]) order
+OBJECT_FIELDS = ["theta", "mat_idx", "shape_idx", "color_idx", "size_idx", "r", "pos_planex", "pos_planey"] # n_images x n_objects
+OFFSET_FIELDS = ["camera_offset", "key_light_offset", "fill_light_offset", "back_light_offset"] # n_images x 3
+IMAGE_FIELDS  = ["randomized_obj_idx", "eyes_same_color"] # n_images
+
+NO_VISIBILITY = {"min_pixels_per_object":0} # settings that skip the visibility check (see replace_occluded)
+
+# random streams; every field draws from its own stream so adding draws to one field never shifts another
+STREAM_CAMERA         = 1
+STREAM_KEY_LIGHT      = 2
+STREAM_FILL_LIGHT     = 3
+STREAM_BACK_LIGHT     = 4
+STREAM_THETA          = 5
+STREAM_MATERIAL       = 6
+STREAM_SHAPE          = 7
+STREAM_COLOR          = 8
+STREAM_SIZE           = 9
+STREAM_POS_JITTER     = 10
+STREAM_RANDOMIZED_OBJ = 11
+STREAM_PLACEMENT      = 12
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix64(x:np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer: a bijective hash of uint64 values"""
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def image_seeds(seed:int, imgidxs) -> np.ndarray:
+    """per-image seeds derived from (split seed, imgidx); all of an image's random draws are a function of its seed alone"""
+    imgidxs = np.asarray(imgidxs, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        return _mix64(_mix64(np.full(imgidxs.shape, seed, dtype=np.uint64)) ^ _mix64(imgidxs + _GOLDEN))
+
+
+def draw_uniform(img_seeds:np.ndarray, stream:int, n_draws:int, first:int=0) -> np.ndarray:
+    """
+    n_images x n_draws uniform random numbers in [0, 1)
+    column c is the (first + c)th draw of the stream, so e.g. later attempts of a rejection sampler can pass first > 0
+    """
+    counters = (np.uint64(stream) << np.uint64(32)) | np.arange(first, first + n_draws, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        x = _mix64(img_seeds[:, None] ^ _mix64(counters + _GOLDEN)[None, :])
+    return (x >> np.uint64(11)).astype(np.float64) * 2.0**-53
+
+
+def draw_choice(img_seeds:np.ndarray, stream:int, n_draws:int, n_choices:int) -> np.ndarray:
+    """n_images x n_draws integers in [0, n_choices)"""
+    return np.minimum((draw_uniform(img_seeds, stream, n_draws) * n_choices).astype(np.int64), n_choices - 1)
+
+
+def generate_config_arrays(split:str, n_images:int=100, seed:int=None, imgidxs=None, n_views:int=1, settings:dict=None) -> dict:
+    """
+    same settings and per-image fields as config_images.generate_config, but per-image fields are numpy arrays
+    and categorical fields are stored as indices (mat_idx, shape_idx, color_idx, size_idx) instead of names
+    - imgidxs: which images to generate (default all n_images); image imgidx comes out the same whichever other images are generated with it
+    - n_views: views per object layout (see config_images.base_config)
+    - settings: overrides of base_config settings, e.g. more objects (n_objects with as many facex, facey and faceparts)
+    """
+    config = base_config(split, n_images, seed, n_views)
+    config.update(settings if settings is not None else {})
+    n_views = image_records.views_per_layout(config)
+    if imgidxs is None:
+        imgidxs = np.arange(config["n_images"])
+    imgidxs = np.asarray(imgidxs, dtype=np.int64)
+    all_views = (np.unique(imgidxs // n_views)[:, None] * n_views + np.arange(n_views)[None, :]).ravel()
+    if not np.array_equal(imgidxs, all_views):
+        # whether a layout must be re-placed depends on all its views (see replace_occluded), so generate whole layouts
+        return select_rows(generate_config_arrays(split, n_images, seed, all_views, n_views, settings), np.searchsorted(all_views, imgidxs))
+    n = len(imgidxs)
+    k = config["n_objects"]
+    view_seeds = image_seeds(config["seed"], imgidxs) # camera and lamp jitter
+    seeds = image_seeds(config["seed"], imgidxs // n_views) # everything else (the same for every view of a layout)
+    config["imgidx"] = imgidxs
+
+    # add random jitter to scene
+    for field, stream, jitter in [("camera_offset", STREAM_CAMERA, config["camera_jitter"]), ("key_light_offset", STREAM_KEY_LIGHT, config["key_light_jitter"]),
+                                  ("fill_light_offset", STREAM_FILL_LIGHT, config["fill_light_jitter"]), ("back_light_offset", STREAM_BACK_LIGHT, config["back_light_jitter"])]:
+        if jitter > 0:
+            config[field] = 2.0 * jitter * (draw_uniform(view_seeds, stream, 3) - 0.5)
+        else:
+            config[field] = np.zeros((n, 3))
+
+    # choose random orientation, material, shape, color and size for every object
+    config["theta"] = 360.0 * draw_uniform(seeds, STREAM_THETA, k)
+    config["mat_idx"] = draw_choice(seeds, STREAM_MATERIAL, k, len(config["materials"])).astype(np.int8)
+    color_names = list(config["colors"].keys())
+    if config["shape_color_combos"] is None:
+        config["shape_idx"] = draw_choice(seeds, STREAM_SHAPE, k, len(config["shapes"])).astype(np.int8)
+        config["color_idx"] = draw_choice(seeds, STREAM_COLOR, k, len(color_names)).astype(np.int8)
+    else:
+        # shape_color_combos is a list of (shape name, list of allowed color names)
+        shape_names = list(config["shapes"].keys())
+        combos = config["shape_color_combos"]
+        combo_idx = draw_choice(seeds, STREAM_SHAPE, k, len(combos))
+        n_colors = np.array([len(colors) for _, colors in combos])
+        combo_colors = np.zeros((len(combos), n_colors.max()), dtype=np.int8)
+        for i, (_, colors) in enumerate(combos):
+            combo_colors[i, :len(colors)] = [color_names.index(c) for c in colors]
+        color_choice = np.minimum((draw_uniform(seeds, STREAM_COLOR, k) * n_colors[combo_idx]).astype(np.int64), n_colors[combo_idx] - 1)
+        config["shape_idx"] = np.array([shape_names.index(shape) for shape, _ in combos], dtype=np.int8)[combo_idx]
+        config["color_idx"] = combo_colors[combo_idx, color_choice]
+    config["size_idx"] = draw_choice(seeds, STREAM_SIZE, k, len(config["sizes"])).astype(np.int8)
+    config["r"] = np.array(list(config["sizes"].values()), dtype=np.float64)[config["size_idx"]]
+    is_cube = np.array([v == "Cube" for v in config["shapes"].values()]) # same check as generate_config
+    config["r"][is_cube[config["shape_idx"]]] /= np.sqrt(2) # for cube, adjust the size a bit
+    config["eyes_same_color"] = config["color_idx"][:, 0] == config["color_idx"][:, 1]
+
+    # choose position: jitter the face, then move one random object in every odd image somewhere random
+    config["pos_planex"] = np.zeros((n, k))
+    config["pos_planey"] = np.zeros((n, k))
+    jitter_face(config, seeds, np.arange(n), 0)
+    randomized = (imgidxs // n_views) % 2 == 1
+    config["randomized_obj_idx"] = np.where(randomized, draw_choice(seeds, STREAM_RANDOMIZED_OBJ, 1, k)[:, 0], 0)
+    n_placed, n_tried = randomize_pos(config, seeds, np.nonzero(randomized)[0])
+    if n_placed > 0:
+        print("placed " + str(n_placed) + " randomized objects (acceptance rate %.3f)" % (n_placed / n_tried))
+    replace_occluded(config, seeds)
+    return config
+
+
+def replace_occluded(config:dict, seeds:np.ndarray):
+    """
+    like config_images.replace_occluded: re-places the objects of every scene where some object would have fewer than
+    min_pixels_per_object visible pixels (see visibility.py). Round v draws from scene attempts v * MAX_SCENE_ATTEMPTS on,
+    so the draws never overlap those of the first placement. modifies config
+    with several views per layout, every view of a layout with a failing view is re-placed, with the same draws (config
+    must hold whole layouts, in order)
+    """
+    n_views = image_records.views_per_layout(config)
+    failing = visibility.failing_images(config)
+    n_failed = len(failing)
+    for round in range(1, placement.MAX_SCENE_ATTEMPTS + 1):
+        if len(failing) == 0:
+            if n_failed > 0:
+                print("re-placed the objects of " + str(n_failed) + " scenes with occluded objects")
+            return
+        first_attempt = round * placement.MAX_SCENE_ATTEMPTS
+        firsts = np.unique(failing - config["imgidx"][failing] % n_views)
+        failing = (firsts[:, None] + np.arange(n_views)[None, :]).ravel()
+        jitter_face(config, seeds, failing, first_attempt)
+        randomize_pos(config, seeds, failing[(config["imgidx"][failing] // n_views) % 2 == 1], first_attempt)
+        failing = visibility.failing_images(config, failing)
+    raise Exception("could not make every object visible in " + str(len(failing)) + " images")
+
+
+def jitter_face(config:dict, seeds:np.ndarray, rows:np.ndarray, scene_attempt:int):
+    """puts the objects of the given rows on the face plus jitter; each scene attempt draws fresh jitter. modifies config"""
+    k = config["n_objects"]
+    jitter = 2.0 * config["pos_jitter"] * (draw_uniform(seeds[rows], STREAM_POS_JITTER, 2 * k, first=2 * k * scene_attempt) - 0.5)
+    config["pos_planex"][rows] = np.asarray(config["facex"], dtype=np.float64)[None, :] + jitter[:, 0::2]
+    config["pos_planey"][rows] = np.asarray(config["facey"], dtype=np.float64)[None, :] + jitter[:, 1::2]
+
+
+def randomize_pos(config:dict, seeds:np.ndarray, rows:np.ndarray, first_attempt:int=0):
+    """
+    moves object randomized_obj_idx of each of the given rows somewhere random, all rows at once (see placement.py)
+    like config_images.randomize_pos, the spot must be min_dist (and, if enforce_margin, margin along the cardinal directions)
+    from every object including where the moved object started; after max_retries rejected spots the face is re-jittered
+    - first_attempt: scene attempt to start drawing from (the faces of the rows must have been jittered with it)
+    modifies config
+    returns (number of objects placed, number of candidate spots tried)
+    """
+    batch = config["max_retries"]
+    dirs = None
+    if config["enforce_margin"]:
+        # relative to the camera of each layout's first view, so every view of a layout is placed the same way
+        first_views = np.arange(len(config["imgidx"])) - config["imgidx"] % image_records.views_per_layout(config)
+        plane_dirs = projection.get_plane_dirs(projection.camera_locations(config)[first_views])
+        dirs = np.stack([plane_dirs["left"][:, :2], plane_dirs["behind"][:, :2]], axis=1)
+
+    n_tried = 0
+    pending = rows
+    for scene_attempt in range(first_attempt, first_attempt + placement.MAX_SCENE_ATTEMPTS):
+        if scene_attempt > first_attempt:
+            jitter_face(config, seeds, pending, scene_attempt) # give up on these scenes and re-place all objects
+        objidx = config["randomized_obj_idx"][pending]
+        first = np.full(len(pending), -1, dtype=np.int64)
+        newx = np.zeros(len(pending))
+        newy = np.zeros(len(pending))
+        for start in range(0, len(pending), placement.CHUNK_SIZE):
+            chunk = slice(start, start + placement.CHUNK_SIZE)
+            rows_chunk = pending[chunk]
+            cand = -2.5 + 5.0 * draw_uniform(seeds[rows_chunk], STREAM_PLACEMENT, 2 * batch, first=2 * batch * scene_attempt)
+            # check a few candidates at a time, so scenes that accept early skip checking the rest of the batch
+            first_chunk = np.full(len(rows_chunk), -1, dtype=np.int64)
+            for c0 in range(0, batch, placement.SUB_BATCH_SIZE):
+                c1 = min(c0 + placement.SUB_BATCH_SIZE, batch)
+                todo = np.nonzero(first_chunk < 0)[0]
+                if len(todo) == 0:
+                    break
+                rows_todo = rows_chunk[todo]
+                valid = placement.valid_candidates(cand[todo, 2*c0:2*c1:2], cand[todo, 2*c0+1:2*c1:2], config["pos_planex"][rows_todo], config["pos_planey"][rows_todo],
+                                                   config["r"][rows_todo], config["r"][rows_todo, objidx[chunk][todo]], config["min_dist"],
+                                                   config["margin"] if config["enforce_margin"] else 0.0, None if dirs is None else dirs[rows_todo])
+                sub_first = placement.first_valid(valid)
+                first_chunk[todo[sub_first >= 0]] = c0 + sub_first[sub_first >= 0]
+            accepted = first_chunk >= 0
+            newx[start:start + len(rows_chunk)][accepted] = cand[accepted, 2 * first_chunk[accepted]]
+            newy[start:start + len(rows_chunk)][accepted] = cand[accepted, 2 * first_chunk[accepted] + 1]
+            first[chunk] = first_chunk
+        n_tried += int(placement.n_tried(first, batch).sum())
+        ok = first >= 0
+        config["pos_planex"][pending[ok], objidx[ok]] = newx[ok]
+        config["pos_planey"][pending[ok], objidx[ok]] = newy[ok]
+        pending = pending[~ok]
+        if len(pending) == 0:
+            return len(rows), n_tried
+    raise Exception("could not place randomized object in " + str(len(pending)) + " images")
+
+
+def select_rows(config:dict, rows:np.ndarray) -> dict:
+    """the config of only the given rows (positions in config["imgidx"])"""
+    out = dict(config)
+    for field in OBJECT_FIELDS + OFFSET_FIELDS + IMAGE_FIELDS + ["imgidx"]:
+        out[field] = config[field][rows]
+    return out
+
+
+def to_json_config(config:dict) -> dict:
+    """compatibility export: the same layout (and key order) that generate_config produces and config_images writes to *_config.json"""
+    material_mapping = [(v, k) for k, v in config["materials"].items()]
+    object_mapping = [(v, k) for k, v in config["shapes"].items()]
+    size_names = list(config["sizes"].keys())
+    color_names = list(config["colors"].keys())
+    n = len(config["imgidx"])
+
+    out = {key:value for key, value in config.items() if key not in OBJECT_FIELDS + OFFSET_FIELDS + IMAGE_FIELDS + ["imgidx", "pixel_coords_x", "pixel_coords_y"]}
+    out["n_images"] = n
+    out["theta"]              = config["theta"].tolist()
+    out["mat_name"]           = [[material_mapping[i][0] for i in row] for row in config["mat_idx"].tolist()]
+    out["mat_name_out"]       = [[material_mapping[i][1] for i in row] for row in config["mat_idx"].tolist()]
+    out["shape_name"]         = [[object_mapping[i][0] for i in row] for row in config["shape_idx"].tolist()]
+    out["shape_name_out"]     = [[object_mapping[i][1] for i in row] for row in config["shape_idx"].tolist()]
+    out["color_name"]         = [[color_names[i] for i in row] for row in config["color_idx"].tolist()]
+    out["size_name"]          = [[size_names[i] for i in row] for row in config["size_idx"].tolist()]
+    out["r"]                  = config["r"].tolist()
+    out["pos_planex"]         = config["pos_planex"].tolist()
+    out["pos_planey"]         = config["pos_planey"].tolist()
+    for field in OFFSET_FIELDS:
+        out[field] = config[field].tolist()
+    out["randomized_obj_idx"] = config["randomized_obj_idx"].tolist()
+    out["eyes_same_color"]    = config["eyes_same_color"].tolist()
+    if "pixel_coords_x" in config:
+        out["pixel_coords_x"] = config["pixel_coords_x"].tolist()
+        out["pixel_coords_y"] = config["pixel_coords_y"].tolist()
+    else:
+        out["pixel_coords_x"] = [[[]]*config["n_objects"] for _ in range(n)] # set in render_scene
+        out["pixel_coords_y"] = [[[]]*config["n_objects"] for _ in range(n)] # set in render_scene
+    return out
+
+
+def from_json_config(json_config:dict) -> dict:
+    """inverse of to_json_config, e.g. to use the array-based tools on a config generated by generate_config"""
+    mat_files = list(json_config["materials"].values())
+    shape_files = list(json_config["shapes"].values())
+    size_names = list(json_config["sizes"].keys())
+    color_names = list(json_config["colors"].keys())
+
+    config = {key:value for key, value in json_config.items() if key not in ["theta", "mat_name", "mat_name_out", "shape_name", "shape_name_out",
+              "color_name", "size_name", "r", "pos_planex", "pos_planey", "pixel_coords_x", "pixel_coords_y"] + OFFSET_FIELDS + IMAGE_FIELDS}
+    config["imgidx"]     = np.arange(json_config["n_images"])
+    config["theta"]      = np.asarray(json_config["theta"], dtype=np.float64)
+    config["mat_idx"]    = np.array([[mat_files.index(v) for v in row] for row in json_config["mat_name"]], dtype=np.int8)
+    config["shape_idx"]  = np.array([[shape_files.index(v) for v in row] for row in json_config["shape_name"]], dtype=np.int8)
+    config["color_idx"]  = np.array([[color_names.index(v) for v in row] for row in json_config["color_name"]], dtype=np.int8)
+    config["size_idx"]   = np.array([[size_names.index(v) for v in row] for row in json_config["size_name"]], dtype=np.int8)
+    config["r"]          = np.asarray(json_config["r"], dtype=np.float64)
+    config["pos_planex"] = np.asarray(json_config["pos_planex"], dtype=np.float64)
+    config["pos_planey"] = np.asarray(json_config["pos_planey"], dtype=np.float64)
+    for field in OFFSET_FIELDS:
+        config[field] = np.asarray(json_config[field], dtype=np.float64)
+    config["randomized_obj_idx"] = np.asarray(json_config["randomized_obj_idx"], dtype=np.int64)
+    config["eyes_same_color"]    = np.asarray(json_config["eyes_same_color"], dtype=bool)
+    if len(json_config["pixel_coords_x"]) > 0 and len(json_config["pixel_coords_x"][0]) > 0 and json_config["pixel_coords_x"][0][0] != []:
+        config["pixel_coords_x"] = np.asarray(json_config["pixel_coords_x"], dtype=np.int64)
+        config["pixel_coords_y"] = np.asarray(json_config["pixel_coords_y"], dtype=np.int64)
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate a (large) customclevr config with numpy")
+    parser.add_argument("--split", type=str, required=True, help="name of the split")
+    parser.add_argument("--n_images", type=int, default=100, help="number of images")
+    parser.add_argument("--seed", type=int, default=None, help="split seed (required unless the split is trnsimple or tstsimple)")
+    parser.add_argument("--n_views", type=int, default=1, help="views per object layout: consecutive images that show the same objects with different camera and lamp jitter")
+    parser.add_argument("--json", type=str, default=None, help="also write the config in the *_config.json layout to this path")
+    parser.add_argument("--records", action="store_true", help="also write the per-image records render_image.py reads (see image_records.py)")
+    parser.add_argument("--columns", action="store_true", help="also compute the scene metadata and write both to ../output/customclevr_<split>_columns/ (see column_store.py)")
+    parser.add_argument("--no_visibility", action="store_true", help="do not check that every object is visible (see visibility.py); the config records min_pixels_per_object 0")
+    args = parser.parse_args()
+
+    start = time.time()
+    config = generate_config_arrays(args.split, args.n_images, args.seed, n_views=args.n_views, settings=NO_VISIBILITY if args.no_visibility else None)
+    print("generated " + str(args.n_images) + " image configs in %.2f s" % (time.time() - start))
+    if args.columns:
+        import column_store # column_store imports this module
+        start = time.time()
+        scene = column_store.compute_scene_columns(config)
+        column_store.save(column_store.store_path(args.split), config, scene)
+        print("computed scene metadata and wrote " + column_store.store_path(args.split) + " in %.2f s" % (time.time() - start))
+    if args.json is not None or args.records:
+        json_config = to_json_config(config)
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(json_config, f)
+        if args.records:
+            image_records.write_records(json_config, image_records.records_path(args.split))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Regression benchmark for the config and metadata pipeline (no blender needed, only numpy):
+# 1) golden checksums: regenerates trnsimple/tstsimple and a fixed array-config sample with the current code and compares
+#    sha256 checksums of their canonical outputs against golden_checksums.json, so an optimization that changes the random
+#    draws (e.g. consumes the global random state of generate_config differently) or the metadata is caught. The regenerated
+#    configs must also match the committed ../output/*_config.json exactly, and the regenerated scenes the committed
+#    (blender-made) ../output/*_scenes.json within SCENE_TOLERANCE (see projection.compare_scenes).
+# 2) timings of config generation, placement, visibility, scene metadata and relationships for every combination of
+#    --sizes and --n_objects, appended with the git commit to ../output/benchmark/config_history.jsonl and compared
+#    against the last run of a different commit.
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import column_store
+import config_arrays
+import config_images
+import projection
+import relationships
+import visibility
+
+
+SIZES = [100, 1000, 10000, 100000, 1000000] # images per timed config
+OBJECT_COUNTS = [6, 10, 20] # objects per scene; beyond the 6 of the face they are placed on a ring around it (see object_settings)
+SEED = 1000 # split seed of the timed configs
+RING_RADIUS = 3.2 # distance of the extra objects from the center of the face
+LEGACY_SPLITS = ["trnsimple", "tstsimple"]
+GOLDEN_SAMPLE = {"split":"golden", "n_images":1000, "seed":12345} # array-config sample whose checksums are golden
+GOLDEN_PATH = "golden_checksums.json"
+HISTORY_PATH = "../output/benchmark/config_history.jsonl"
+SCENE_TOLERANCE = 1e-4 # max abs difference of depth and directions from blender (3d and pixel coords must be identical)
+
+
+def canonical_json(value) -> bytes:
+    """the json encoding checksums are taken of: sorted keys, no whitespace, floats at full precision"""
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def checksum(value) -> str:
+    return hashlib.sha256(canonical_json(value)).hexdigest()
+
+
+def array_checksum(columns:dict) -> str:
+    """sha256 of every column's name, dtype, shape and contents (in the dtypes column_store.py stores them with)"""
+    digest = hashlib.sha256()
+    for name in sorted(columns):
+        values = np.ascontiguousarray(columns[name], dtype=column_store.DTYPES[name])
+        digest.update(canonical_json([name, values.dtype.str, list(values.shape)]))
+        digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+def compute_checksums() -> dict:
+    """checksums of what the current code generates for the legacy splits and GOLDEN_SAMPLE; also returns the legacy outputs"""
+    checksums = {}
+    outputs = {}
+    for split in LEGACY_SPLITS:
+        config, scenes = config_images.generate_split(split, use_blender=False)
+        checksums[split] = {"config":checksum(config), "scenes":checksum(scenes)}
+        outputs[split] = (config, scenes)
+    config = config_arrays.generate_config_arrays(**GOLDEN_SAMPLE)
+    scene = column_store.compute_scene_columns(config)
+    fields = config_arrays.OBJECT_FIELDS + config_arrays.OFFSET_FIELDS + config_arrays.IMAGE_FIELDS + ["imgidx", "pixel_coords_x", "pixel_coords_y"]
+    checksums["arrays"] = {"settings":GOLDEN_SAMPLE, "config":array_checksum({field:config[field] for field in fields}), "scenes":array_checksum(scene)}
+    return checksums, outputs
+
+
+def check_golden(path:str, update:bool) -> bool:
+    """compares (or, with update, rewrites) the golden checksums at path; returns whether everything matched"""
+    checksums, outputs = compute_checksums()
+    ok = True
+    for split, (config, scenes) in outputs.items():
+        # the committed files were made with blender (see config_images.py), so only the config can be compared exactly
+        with open("../output/customclevr_" + split + "_config.json", "r") as f:
+            committed_config = json.load(f)
+        with open("../output/customclevr_" + split + "_scenes.json", "r") as f:
+            committed_scenes = json.load(f)["scenes"]
+        config_ok = checksum(committed_config) == checksums[split]["config"]
+        diffs = projection.compare_scenes(scenes, committed_scenes)
+        relationships_ok = all(scene["relationships"] == committed["relationships"] for scene, committed in zip(scenes, committed_scenes))
+        scenes_ok = diffs["3d_coords"] == 0 and diffs["pixel_coords"] == 0 and max(diffs["depth"], diffs["directions"]) <= SCENE_TOLERANCE and relationships_ok
+        print("%-10s config %s the committed config, scenes %s the committed scenes (max differences: %s)" % (split,
+              "matches" if config_ok else "DIFFERS FROM", "match" if scenes_ok else "DIFFER FROM", ", ".join("%s %.2g" % item for item in diffs.items())))
+        ok = ok and config_ok and scenes_ok
+    if update:
+        with open(path, "w") as f:
+            json.dump(checksums, f, indent=1)
+        print("wrote " + path)
+        return ok
+    with open(path, "r") as f:
+        golden = json.load(f)
+    for name in sorted(golden):
+        for output in ["config", "scenes"]:
+            match = checksums[name][output] == golden[name][output]
+            print("%-10s %-6s checksum %s" % (name, output, "matches" if match else "DIFFERS (" + checksums[name][output][:12] + " != golden " + golden[name][output][:12] + ")"))
+            ok = ok and match
+    return ok
+
+
+def object_settings(n_objects:int) -> dict:
+    """
+    base_config overrides for scenes with n_objects objects: the face, plus n_objects - 6 objects evenly spaced on a ring of
+    RING_RADIUS around it. Without the face's 200 pixel guarantee (min_pixels_per_object 0) and the margin along the cardinal
+    directions, which a 20 object scene often cannot satisfy; visibility is still estimated and min_dist still enforced
+    """
+    base = config_images.base_config("benchmark", seed=SEED)
+    n_extra = n_objects - len(base["faceparts"])
+    if n_extra == 0:
+        return {}
+    assert n_extra > 0, "at least " + str(len(base["faceparts"])) + " objects"
+    angles = 2.0 * np.pi * np.arange(n_extra) / n_extra
+    return {"n_objects":n_objects, "faceparts":base["faceparts"] + ["extra"] * n_extra, "facex":base["facex"] + (RING_RADIUS * np.cos(angles)).tolist(),
+            "facey":base["facey"] + (RING_RADIUS * np.sin(angles)).tolist(), "min_pixels_per_object":0, "enforce_margin":False}
+
+
+def time_stages(n_images:int, n_objects:int) -> dict:
+    """seconds per stage of generating and describing n_images scenes of n_objects objects with the array pipeline"""
+    seconds = {}
+    start = time.time()
+    config = config_arrays.generate_config_arrays("benchmark", n_images, SEED, settings=object_settings(n_objects))
+    seconds["generate_config_arrays"] = time.time() - start # all of the below but the metadata, with placement retries
+
+    # placement alone: re-place the moved object of every odd scene from a fresh face
+    placed = dict(config, pos_planex=config["pos_planex"].copy(), pos_planey=config["pos_planey"].copy())
+    seeds = config_arrays.image_seeds(config["seed"], config["imgidx"])
+    rows = np.nonzero(config["imgidx"] % 2 == 1)[0]
+    start = time.time()
+    config_arrays.jitter_face(placed, seeds, rows, 0)
+    config_arrays.randomize_pos(placed, seeds, rows)
+    seconds["placement"] = time.time() - start
+
+    # the check replace_occluded runs, with the face's threshold even where object_settings turned it off
+    start = time.time()
+    visibility.failing_images(dict(config, min_pixels_per_object=config_images.base_config("benchmark", seed=SEED)["min_pixels_per_object"]))
+    seconds["visibility"] = time.time() - start
+
+    start = time.time()
+    scene = column_store.compute_scene_columns(config)
+    seconds["scene_metadata"] = time.time() - start # projection and relationships
+
+    rel_dirs = scene["directions"][:, [projection.DIRECTION_NAMES.index(name) for name in relationships.RELATIONSHIP_NAMES]]
+    start = time.time()
+    for first in range(0, n_images, relationships.CHUNK_SIZE):
+        chunk = slice(first, first + relationships.CHUNK_SIZE)
+        relationships.relationship_masks(relationships.relationship_dots(scene["coords_3d"][chunk], rel_dirs[chunk]))
+    seconds["relationships"] = time.time() - start
+    return seconds
+
+
+def time_legacy() -> dict:
+    """seconds per stage of the original, random-module based path (100 images of 6 objects)"""
+    seconds = {}
+    start = time.time()
+    config = config_images.generate_config(LEGACY_SPLITS[0])
+    seconds["generate_config"] = time.time() - start
+    scenes = projection.get_scenes(config)
+    start = time.time()
+    for scene in scenes:
+        config_images.compute_all_relationships(scene)
+    seconds["compute_all_relationships"] = time.time() - start
+    return seconds
+
+
+def git_commit() -> dict:
+    """the commit the working tree is at, and whether it has uncommitted changes (None outside a git checkout)"""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+        dirty = len(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no", "."], stderr=subprocess.DEVNULL).strip()) > 0
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit":None, "dirty":None}
+    return {"commit":commit, "dirty":dirty}
+
+
+def previous_run(path:str, commit:str) -> dict:
+    """the last run in the history at path that was made at a different commit (or with uncommitted changes), or None"""
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, "r") as f:
+        for line in f:
+            run = json.loads(line)
+            if run["commit"] != commit or run["dirty"]:
+                previous = run
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description="check the config pipeline against golden checksums and time it (see README.md)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of images to time")
+    parser.add_argument("--n_objects", type=int, nargs="+", default=OBJECT_COUNTS, help="objects per scene to time")
+    parser.add_argument("--golden", type=str, default=GOLDEN_PATH, help="golden checksums file")
+    parser.add_argument("--update_golden", action="store_true", help="write the current checksums to --golden (after an intended change of the outputs)")
+    parser.add_argument("--skip_golden", action="store_true", help="only time")
+    parser.add_argument("--skip_timing", action="store_true", help="only check the checksums")
+    parser.add_argument("--history", type=str, default=HISTORY_PATH, help="jsonl file the timings are appended to")
+    args = parser.parse_args()
+
+    ok = True
+    if not args.skip_golden:
+        ok = check_golden(args.golden, args.update_golden)
+        print("outputs are unchanged" if ok else "OUTPUTS CHANGED")
+    if args.skip_timing:
+        sys.exit(0 if ok else 1)
+
+    run = dict(git_commit(), time=time.strftime("%Y-%m-%d %H:%M:%S"), host=socket.gethostname(), python=platform.python_version(),
+               numpy=np.__version__, golden_ok=ok if not args.skip_golden else None, results=[])
+    previous = previous_run(args.history, run["commit"])
+    before = {(r["stage"], r["n_images"], r["n_objects"]):r["seconds"] for r in previous["results"]} if previous is not None else {}
+    if previous is not None:
+        print("comparing against " + str(previous["commit"])[:12] + (" (uncommitted changes)" if previous["dirty"] else "") + " from " + previous["time"])
+    print("%-26s %9s %9s %10s %16s" % ("stage", "n_images", "n_objects", "seconds", "previous"))
+
+    def report(stage, n_images, n_objects, seconds):
+        run["results"].append({"stage":stage, "n_images":n_images, "n_objects":n_objects, "seconds":seconds})
+        key = (stage, n_images, n_objects)
+        print("%-26s %9d %9d %10.3f %16s" % (stage, n_images, n_objects, seconds, "%.3f (%.2fx)" % (before[key], seconds / before[key]) if key in before and before[key] > 0 else ""))
+        sys.stdout.flush()
+
+    for stage, seconds in time_legacy().items():
+        report(stage, 100, 6, seconds)
+    for n_objects in args.n_objects:
+        for n_images in args.sizes:
+            for stage, seconds in time_stages(n_images, n_objects).items():
+                report(stage, n_images, n_objects, seconds)
+
+    os.makedirs(os.path.dirname(args.history), exist_ok=True)
+    with open(args.history, "a") as f:
+        f.write(json.dumps(run) + "\n")
+    print("appended to " + args.history)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,24 @@
 # Heavy modifications copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
 # see README.md for instructions on running this script
 from __future__ import print_function
+import argparse
 import math
 import random
 import json
 import os
+import sys
 import copy
 
+import numpy as np
+
+import image_records
+import placement
+import projection
+import relationships
+import render_settings
+import timing
+import visibility
+
 
 INSIDE_BLENDER = True
 try:
@@ -20,40 +32,74 @@ try:
 except ImportError as e:
     INSIDE_BLENDER = False
 
+
+# per-image config keys that describe the object layout; every view of a layout has the same values (see copy_layouts)
+LAYOUT_KEYS = ["theta", "mat_name", "mat_name_out", "shape_name", "shape_name_out", "color_name", "size_name", "r", "pos_planex", "pos_planey",
+               "randomized_obj_idx", "eyes_same_color"]
+
     
-def main():
+def main(use_blender:bool=True):
+    """
+    use_blender: compute the metadata by setting up every scene in blender; otherwise compute it with numpy (see projection.py),
+    which gives the same pixel coordinates and agrees with blender to float32 precision elsewhere
+    """
+    args = parse_args()
+    if args.timing_log is not None:
+        timing.open_log(args.timing_log, "config_images")
     for split in {"trnsimple","tstsimple"}:
+        config, all_scenes = generate_split(split, use_blender)
+
+        # output metadata jsons
+        with timing.stage("write_outputs", split=split):
+            with open("../output/customclevr_" + config["split"] + "_config.json", "w") as f:
+                json.dump(config, f)
+            with open("../output/customclevr_" + config["split"] + "_scenes.json", "w") as f:
+                json.dump({"scenes": all_scenes}, f)
+            image_records.write_records(config, image_records.records_path(config["split"])) # per-image index for render_image.py
+    timing.close_log()
+
+
+def generate_split(split:str, use_blender:bool=True):
+    """the config and scene structs main() writes for a split (see main for use_blender)"""
+    with timing.stage("generate_config", split=split):
         config = generate_config(split)
 
-        # set render arguments so we can get pixel coordinates later
+    if use_blender:
+        all_scenes = get_scenes_blender(config)
+    else:
+        print("configuring " + config["split"] + " (" + str(config["n_images"]) + " images) without blender...")
+        with timing.stage("get_scenes", split=split):
+            all_scenes = projection.get_scenes(config)
+    with timing.stage("relationships", split=split):
+        relationships.add_relationships(all_scenes) # same as compute_all_relationships, for all scenes at once
+    with timing.stage("visibility", split=split):
+        visibility.add_visible_pixels(all_scenes, visibility.visible_pixels(config, stride=1)) # recorded, so one ray per pixel
+    return config, all_scenes
+
+
+def parse_args(argv=None):
+    """inside blender, arguments go after "--" (e.g. blender --background --python config_images.py -- --timing_log log.jsonl)"""
+    if argv is None and INSIDE_BLENDER:
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(description="generate the customclevr configs and scene metadata (see README.md)")
+    parser.add_argument("--timing_log", type=str, default=None, help="append per-stage timings to this jsonl file (see timing.py)")
+    return parser.parse_args(argv)
+
+
+def get_scenes_blender(config:dict) -> list:
+    # set render arguments so we can get pixel coordinates later
+    with timing.stage("open_mainfile", split=config["split"]):
         bpy.ops.wm.open_mainfile(filepath=config["base_scene_blendfile"]) # load the main blendfile
-        render_args = bpy.context.scene.render
-        render_args.engine = "CYCLES" # we use functionality specific to the CYCLES renderer so BLENDER_RENDER cannot be used
-        render_args.resolution_x = 320 # the width (in pixels) for the rendered images
-        render_args.resolution_y = 240 # the height (in pixels) for the rendered images
-        render_args.resolution_percentage = 100
-        render_args.tile_x = 512 # the tile size to use for rendering
-        render_args.tile_y = 512 # the tile size to use for rendering
-        bpy.data.worlds["World"].cycles.sample_as_light  = True
-        bpy.context.scene.cycles.blur_glossy             = 2.0
-        bpy.context.scene.cycles.samples                 = 512 # the number of samples to use when rendering. Larger values will result in nicer images but will cause rendering to take longer.
-        bpy.context.scene.cycles.transparent_min_bounces = 8 # the minimum number of bounces to use for rendering
-        bpy.context.scene.cycles.transparent_max_bounces = 8 # the maximum number of bounces to use for rendering
-
-        # compute the final metadata (mostly pixel_cords_*) by setting up the scene in blender (but not rendering)
-        all_scenes = []
-        for imgidx in range(config["n_images"]):
-            print("configuring " + config["split"] + " image " + str(imgidx) + " of " + str(config["n_images"]) + "...")
-            img_path = "../output/images/customclevr_" + config["split"] + "_%06d.png" % imgidx
-            scene_struct = render_scene(config, imgidx, img_path)
-            scene_struct["relationships"] = compute_all_relationships(scene_struct)
-            all_scenes.append(scene_struct)
+    render_settings.apply_render_settings(bpy.context.scene, bpy.data.worlds["World"], bpy.context.view_layer)
 
-        # output metadata jsons
-        with open("../output/customclevr_" + config["split"] + "_config.json", "w") as f:
-            json.dump(config, f)
-        with open("../output/customclevr_" + config["split"] + "_scenes.json", "w") as f:
-            json.dump({"scenes": all_scenes}, f)
+    # compute the final metadata (mostly pixel_cords_*) by setting up the scene in blender (but not rendering)
+    all_scenes = []
+    for imgidx in range(config["n_images"]):
+        print("configuring " + config["split"] + " image " + str(imgidx) + " of " + str(config["n_images"]) + "...")
+        img_path = "../output/images/customclevr_" + config["split"] + "_%06d.png" % imgidx
+        with timing.stage("configure_image", split=config["split"], imgidx=imgidx):
+            all_scenes.append(render_scene(config, imgidx, img_path))
+    return all_scenes
 
 
 def render_scene(config:dict, imgidx:int, img_path:str) -> dict:
@@ -70,6 +116,7 @@ def render_scene(config:dict, imgidx:int, img_path:str) -> dict:
     # must be after camera location is finalized
     scene_struct = {"split":config["split"], "image_index":imgidx, "image_filename":os.path.basename(img_path), "objects":[], "directions":{}}
     scene_struct["directions"] = get_plane_dirs() # save all six axis-aligned directions in the scene struct
+    add_view_index(scene_struct, config, imgidx)
 
     # prepare to add objects
     camera = bpy.data.objects["Camera"]
@@ -108,6 +155,14 @@ def render_scene(config:dict, imgidx:int, img_path:str) -> dict:
     return scene_struct
 
 
+def add_view_index(scene_struct:dict, config:dict, imgidx:int):
+    """with several views per layout, records which layout an image shows and from which of its views. modifies scene_struct"""
+    n_views = image_records.views_per_layout(config)
+    if n_views > 1:
+        scene_struct["layout_index"] = imgidx // n_views
+        scene_struct["view_index"] = imgidx % n_views
+
+
 def add_object(object_dir, name, scale, x, y, theta) -> str:
     """
     Load an object from a file. We assume that in the directory object_dir, there
@@ -138,10 +193,19 @@ def add_object(object_dir, name, scale, x, y, theta) -> str:
     return new_name
 
 
-def generate_config(split:str) -> dict:
+def base_config(split:str, n_images:int=100, seed:int=None, n_views:int=1) -> dict:
+    """
+    settings shared by every image of a split (everything generate_config outputs except the per-image fields)
+    - seed: defaults to the fixed seed of the split; required for any other split name
+    - n_views: number of consecutive images that show the same object layout, each with its own camera and lamp jitter
+      (see image_records.views_per_layout); must divide n_images
+    """
     config = {}
-    config["n_images"] = 100 # number of images to render
+    config["n_images"] = n_images # number of images to render
     config["split"] = split # name of the split for which we are rendering
+    if n_views > 1: # left out otherwise, so existing configs are unchanged
+        assert n_images % n_views == 0, "n_images must be a multiple of n_views"
+        config["n_views"] = n_views # images imgidx // n_views * n_views ... + n_views - 1 share their objects
     config["shape_dir"]            = "data/shapes" # directory where .blend files for object models are stored
     config["material_dir"]         = "data/materials" # directory where .blend files for materials are stored
     config["base_scene_blendfile"] = "data/base_scene.blend" # Base blender file on which all scenes are based; includes ground plane, lights, and camera
@@ -153,9 +217,13 @@ def generate_config(split:str) -> dict:
     config["margin"] = 0.4
     # ^ Along all cardinal directions (left, right, front, back), all objects will be at least this distance apart.
     # This makes resolving spatial relationships slightly less ambiguous
+    config["enforce_margin"] = split not in ["trnsimple", "tstsimple"]
+    # ^ whether placement checks margin as well as min_dist. trnsimple and tstsimple were generated checking only min_dist;
+    # keep them reproducible. New splits check both, which rejects about 9 in 10 random spots instead of about half
+    # (randomize_pos then draws about 5 times as many candidates)
     config["min_pixels_per_object"] = 200
     # ^ All objects will have at least this many visible pixels in the final rendered images;
-    # this ensures that no objects are fully occluded by other objects
+    # this ensures that no objects are fully occluded by other objects (estimated before rendering, see visibility.py)
     config["max_retries"] = 50 # The number of times to try placing an object before giving up and re-placing all objects in the scene.")
   
     config["faceparts"] = ["eye","eye","nose","mouth","mouth","mouth"]
@@ -190,13 +258,23 @@ def generate_config(split:str) -> dict:
     config["camera_location"]   = [3,0,8] # camera seems to always look toward the origin
     # config["camera_location"]   = [7.4811,-6.5076,5.3437] # seems to be the default somehow
 
-    if config["split"] == "trnsimple":
+    if seed is not None:
+        config["seed"] = seed
+    elif config["split"] == "trnsimple":
         config["seed"] = 100
     elif config["split"] == "tstsimple":
         config["seed"] = 101
     else:
         raise Exception("unexpected split")
+    return config
+
 
+def generate_config(split:str, n_views:int=1) -> dict:
+    """
+    - n_views: views per object layout (see base_config); the other views of a layout only draw their camera and lamp jitter
+    """
+    config = base_config(split, n_views=n_views)
+    n_views = image_records.views_per_layout(config)
     material_mapping = [(v, k) for k, v in config["materials"].items()] # e.g. [("Rubber","rubber"), ("MyMetal","metal")]
     object_mapping = [(v, k) for k, v in config["shapes"].items()] # e.g. [("SmoothCube_v2","cube"), ("Sphere","sphere"), ("SmoothCylinder","cylinder")]
     size_mapping = list(config["sizes"].items()) # e.g. [("large",0.7), ("small",0.35)]
@@ -219,6 +297,8 @@ def generate_config(split:str) -> dict:
     config["back_light_offset"]  = [[]]*config["n_images"] # n_images x 3
     config["randomized_obj_idx"] = [0]*config["n_images"] # n_images x 1
     config["eyes_same_color"]    = [False]*config["n_images"] # n_images x 1
+    n_placed = 0
+    n_tried = 0
     for imgidx in range(config["n_images"]):
         # add random jitter to scene
         config["camera_offset"][imgidx]     = [0,0,0]
@@ -234,6 +314,8 @@ def generate_config(split:str) -> dict:
                 config["fill_light_offset"][imgidx][i] = myrand(config["fill_light_jitter"])
             if config["back_light_jitter"] > 0:
                 config["back_light_offset"][imgidx][i] = myrand(config["back_light_jitter"])
+        if imgidx % n_views > 0:
+            continue # another view of the previous layout (see copy_layouts)
 
         config["theta"][imgidx]          = [[]]*config["n_objects"]
         config["mat_name"][imgidx]       = [[]]*config["n_objects"]
@@ -269,14 +351,15 @@ def generate_config(split:str) -> dict:
         config["eyes_same_color"][imgidx] = (config["color_name"][imgidx][0] == config["color_name"][imgidx][1])
 
         # choose position
-        config["pos_planex"][imgidx] = copy.deepcopy(config["facex"]) # init to a face
-        config["pos_planey"][imgidx] = copy.deepcopy(config["facey"]) # init to a face
-        for objidx in range(config["n_objects"]):
-            config["pos_planex"][imgidx][objidx] += myrand(config["pos_jitter"]) # jitter said face
-            config["pos_planey"][imgidx][objidx] += myrand(config["pos_jitter"]) # jitter said face
-        if imgidx % 2 == 1:
+        jitter_face(config, imgidx)
+        if (imgidx // n_views) % 2 == 1:
             config["randomized_obj_idx"][imgidx] = random.randint(0, config["n_objects"] - 1) # pick a random object
-            randomize_pos(config, imgidx, config["randomized_obj_idx"][imgidx]) # choose a random object to randomly place
+            n_tried += randomize_pos(config, imgidx, config["randomized_obj_idx"][imgidx]) # choose a random object to randomly place
+            n_placed += 1
+    if n_placed > 0:
+        print("placed " + str(n_placed) + " randomized objects (acceptance rate %.3f)" % (n_placed / n_tried))
+    copy_layouts(config, range(0, config["n_images"], n_views))
+    replace_occluded(config)
 
     # randomize the order of the objects (future work)
     # for imgidx in range(config["n_images"]):
@@ -300,29 +383,103 @@ def generate_config(split:str) -> dict:
     return config
 
 
-def randomize_pos(config:dict, imgidx:int, randomized_obj_idx:int):
+def replace_occluded(config:dict):
+    """
+    modifies config, uses rng (only if some scene fails)
+    re-places the objects of every scene where some object would have fewer than min_pixels_per_object visible pixels
+    (estimated without rendering, see visibility.py), until every scene passes
+    with several views per layout, a layout is re-placed (from its first view) if any of its views fails
+    """
+    n_views = image_records.views_per_layout(config)
+    failing = visibility.failing_images(config)
+    n_failed = len(failing)
+    for _ in range(placement.MAX_SCENE_ATTEMPTS):
+        if len(failing) == 0:
+            if n_failed > 0:
+                print("re-placed the objects of " + str(n_failed) + " scenes with occluded objects")
+            return
+        firsts = np.unique(failing // n_views * n_views)
+        for imgidx in firsts.tolist():
+            jitter_face(config, imgidx)
+            if (imgidx // n_views) % 2 == 1:
+                randomize_pos(config, imgidx, config["randomized_obj_idx"][imgidx])
+        copy_layouts(config, firsts.tolist())
+        failing = visibility.failing_images(config, (firsts[:, None] + np.arange(n_views)[None, :]).ravel())
+    raise Exception("could not make every object visible in images " + str(failing.tolist()))
+
+
+def copy_layouts(config:dict, firsts):
+    """modifies config: gives the other views of each layout (given by the imgidx of its first view) the objects of the first view"""
+    n_views = image_records.views_per_layout(config)
+    for first in firsts:
+        for imgidx in range(first + 1, first + n_views):
+            for key in LAYOUT_KEYS:
+                config[key][imgidx] = copy.deepcopy(config[key][first])
+
+
+def jitter_face(config:dict, imgidx:int):
     """modifies config, uses rng"""
-    randx = random.uniform(-2.5, 2.5)
-    randy = random.uniform(-2.5, 2.5)
-
-    # check to make sure the new object is further than min_dist from all other objects
-    is_dist_good = True # no objects "intersect"
+    config["pos_planex"][imgidx] = copy.deepcopy(config["facex"]) # init to a face
+    config["pos_planey"][imgidx] = copy.deepcopy(config["facey"]) # init to a face
     for objidx in range(config["n_objects"]):
-        x = config["pos_planex"][imgidx][objidx]
-        y = config["pos_planey"][imgidx][objidx]
-        dx = x - randx
-        dy = y - randy
-        dist = math.sqrt(dx * dx + dy * dy)
-        rr = config["r"][imgidx][randomized_obj_idx]
-        if dist - config["r"][imgidx][objidx] - rr < config["min_dist"]:
-            is_dist_good = False
-            break
-    
-    if is_dist_good:
-        config["pos_planex"][imgidx][randomized_obj_idx] = randx
-        config["pos_planey"][imgidx][randomized_obj_idx] = randy
-    else:
-        randomize_pos(config, imgidx, randomized_obj_idx) # try again
+        config["pos_planex"][imgidx][objidx] += myrand(config["pos_jitter"]) # jitter said face
+        config["pos_planey"][imgidx][objidx] += myrand(config["pos_jitter"]) # jitter said face
+
+
+def randomize_pos(config:dict, imgidx:int, randomized_obj_idx:int) -> int:
+    """
+    modifies config, uses rng
+    moves the object to a random spot at least min_dist (and, if enforce_margin, margin along the cardinal directions) from every object,
+    including where it started. After max_retries rejected spots the face is re-jittered and placement starts over.
+    Consumes exactly the random numbers that drawing one candidate at a time would, so existing splits are reproduced.
+    returns the number of candidate spots tried
+    """
+    dirs = None
+    if config["enforce_margin"]:
+        # relative to the camera of the image (with several views per layout: of the layout's first view, which imgidx is)
+        camera_location = np.asarray(config["camera_location"], dtype=np.float64) + np.asarray(config["camera_offset"][imgidx])
+        plane_dirs = projection.get_plane_dirs(camera_location[None, :])
+        dirs = np.stack([plane_dirs["left"][:, :2], plane_dirs["behind"][:, :2]], axis=1)
+
+    n_tried = 0
+    for _ in range(placement.MAX_SCENE_ATTEMPTS):
+        x = np.asarray(config["pos_planex"][imgidx], dtype=np.float64)[None, :]
+        y = np.asarray(config["pos_planey"][imgidx], dtype=np.float64)[None, :]
+        r = np.asarray(config["r"][imgidx], dtype=np.float64)[None, :]
+        rr = r[:, randomized_obj_idx]
+
+        def first_accepted(spots):
+            valid = placement.valid_candidates(spots[None, :, 0], spots[None, :, 1], x, y, r, rr, config["min_dist"], config["margin"] if config["enforce_margin"] else 0.0, dirs)
+            return int(placement.first_valid(valid)[0])
+        spots, first, n = draw_spots(config["max_retries"], first_accepted)
+        n_tried += n
+
+        if first >= 0:
+            config["pos_planex"][imgidx][randomized_obj_idx] = float(spots[first, 0])
+            config["pos_planey"][imgidx][randomized_obj_idx] = float(spots[first, 1])
+            return n_tried
+        jitter_face(config, imgidx) # give up and re-place all objects
+    raise Exception("could not place randomized object in image " + str(imgidx))
+
+
+def draw_spots(n_spots:int, first_accepted) -> tuple:
+    """
+    uses rng: draws n_spots random spots on the plane (n_spots x 2) and checks them as one batch with first_accepted(spots),
+    which returns the index of the first acceptable spot or -1.
+    returns the spots, that index, and the number of spots a one-at-a-time sampler would have drawn
+    """
+    # The original randomize_pos drew one spot at a time and stopped at the first acceptable one, and every later draw of
+    # generate_config (the rest of the image, the following images) continues the same random stream. trnsimple and tstsimple
+    # were generated that way, so the spots after the accepted one must not be consumed: rewind the rng and replay only the
+    # draws of the spots up to it. random.uniform consumes exactly one random.random() per call.
+    state = random.getstate()
+    spots = np.array([random.uniform(-2.5, 2.5) for _ in range(2 * n_spots)]).reshape(-1, 2)
+    first = first_accepted(spots)
+    n = int(placement.n_tried(np.array([first]), n_spots)[0])
+    random.setstate(state)
+    for _ in range(2 * n):
+        random.random()
+    return spots, first, n
 
 
 def myrand(L:float) -> float:
@@ -372,8 +529,9 @@ def compute_all_relationships(scene_struct) -> dict:
     Returns a dictionary mapping string relationship names to lists of lists of integers,
     where output[rel][i] gives a list of object indices that have the relationship rel with object i.
     For example if j is in output["left"][i] then object j is left of object i.
+    See relationships.py for a version that handles all scenes at once.
     """
-    eps = 0.2
+    eps = relationships.EPS
     all_relationships = {}
     for name, direction_vec in scene_struct["directions"].items():
         if name == "above" or name == "below":
@@ -420,4 +578,4 @@ if __name__ == "__main__":
     if INSIDE_BLENDER:
         main() # run normally
     else:
-        print("this script is intended to be called by blender - see README.md")
+        main(use_blender=False) # no blender, so compute the metadata with numpy
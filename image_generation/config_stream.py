@@ -0,0 +1,130 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Streaming, sharded version of config_arrays.py + column_store.py for splits too large to hold in memory at once.
+# Images [shardidx * shard_size, (shardidx + 1) * shard_size) are generated together with their scene metadata by one of
+# several processes, and written as soon as they are done to ../output/customclevr_<split>_stream/shard_<shardidx>/
+# (a column store, see column_store.py), so memory is bounded by the shard size times the number of processes.
+# Every image only depends on (split seed, imgidx) (see config_arrays.py), so the result is the same for any shard size
+# or number of processes. Shards are written to a temporary directory and renamed when complete, so an interrupted run
+# can be resumed: complete shards are skipped.
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+
+import column_store
+import config_arrays
+import image_records
+
+
+SHARD_SIZE = 100000 # images per shard; a worker needs roughly 1 GB per 100000 images
+
+
+def stream_path(split:str) -> str:
+    return "../output/customclevr_" + split + "_stream"
+
+
+def shard_path(path:str, shardidx:int) -> str:
+    return os.path.join(path, "shard_%06d" % shardidx)
+
+
+def shard_rows(n_images:int, shard_size:int, shardidx:int) -> np.ndarray:
+    """the imgidx of every image of a shard"""
+    return np.arange(shardidx * shard_size, min((shardidx + 1) * shard_size, n_images))
+
+
+def generate_shard(job:tuple) -> tuple:
+    """generates and writes one shard (unless it is already complete); job is (split, n_images, seed, n_views, settings, shard_size, shardidx, path)"""
+    split, n_images, seed, n_views, settings, shard_size, shardidx, path = job
+    final = shard_path(path, shardidx)
+    if os.path.exists(final):
+        return shardidx, 0.0
+    start = time.time()
+    config = config_arrays.generate_config_arrays(split, n_images, seed, shard_rows(n_images, shard_size, shardidx), n_views, settings)
+    scene = column_store.compute_scene_columns(config)
+    tmp = final + ".tmp%d" % os.getpid()
+    shutil.rmtree(tmp, ignore_errors=True)
+    column_store.save(tmp, config, scene)
+    os.rename(tmp, final)
+    return shardidx, time.time() - start
+
+
+def generate(split:str, n_images:int, seed:int=None, path:str=None, shard_size:int=SHARD_SIZE, n_procs:int=0, records:bool=False, n_views:int=1,
+             visibility:bool=True):
+    """
+    generates every shard of a split at path (default stream_path(split)) with n_procs processes (0 = one per core)
+    - records: also write the split's image records (see image_records.py), appended shard by shard in imgidx order
+    - n_views: views per object layout (see config_images.base_config); layouts may straddle shards
+    - visibility: check that every object is visible (see config_arrays.replace_occluded)
+    """
+    if path is None:
+        path = stream_path(split)
+    settings = {"split":split, "n_images":n_images, "seed":config_arrays.base_config(split, n_images, seed, n_views)["seed"], "n_views":n_views,
+                "shard_size":shard_size, "n_shards":(n_images + shard_size - 1) // shard_size}
+    settings_override = None if visibility else config_arrays.NO_VISIBILITY
+    if not visibility:
+        settings["no_visibility"] = True # only recorded when set, so existing manifests still match
+    os.makedirs(path, exist_ok=True)
+    manifest = os.path.join(path, "manifest.json")
+    if os.path.exists(manifest):
+        with open(manifest, "r") as f:
+            if json.load(f) != settings:
+                raise Exception(path + " holds shards of different settings; remove it or choose another path")
+    else:
+        with open(manifest, "w") as f:
+            json.dump(settings, f, indent=1)
+
+    jobs = [(split, n_images, seed, n_views, settings_override, shard_size, shardidx, path) for shardidx in range(settings["n_shards"])]
+    pool = multiprocessing.Pool(n_procs if n_procs > 0 else os.cpu_count())
+    start = time.time()
+    for shardidx, seconds in pool.imap(generate_shard, jobs): # in shard order, so records can be appended as shards finish
+        rows = shard_rows(n_images, shard_size, shardidx)
+        if records:
+            json_config = config_arrays.to_json_config(column_store.load(shard_path(path, shardidx), mmap=False)[0])
+            if shardidx == 0:
+                image_records.write_header(dict(json_config, n_images=n_images), image_records.records_path(split))
+            image_records.append_records(json_config, image_records.records_path(split), int(rows[0]))
+        print("shard " + str(shardidx + 1) + " of " + str(settings["n_shards"]) + " (images " + str(rows[0]) + "-" + str(rows[-1]) + ")"
+              + (" generated in %.1f s" % seconds if seconds > 0 else " was already complete") + " (%.1f s so far)" % (time.time() - start))
+    pool.close()
+    pool.join()
+
+
+def locate(path:str, imgidx:int) -> tuple:
+    """(shard directory, row in the shard) of image imgidx"""
+    with open(os.path.join(path, "manifest.json"), "r") as f:
+        shard_size = json.load(f)["shard_size"]
+    return shard_path(path, imgidx // shard_size), imgidx % shard_size
+
+
+def iterate_shards(path:str, mmap:bool=True):
+    """yields (config, scene) of every shard in imgidx order (see column_store.load), one shard in memory at a time"""
+    with open(os.path.join(path, "manifest.json"), "r") as f:
+        n_shards = json.load(f)["n_shards"]
+    for shardidx in range(n_shards):
+        yield column_store.load(shard_path(path, shardidx), mmap)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate a very large customclevr split in shards, in parallel (see README.md)")
+    parser.add_argument("--split", type=str, required=True, help="name of the split")
+    parser.add_argument("--n_images", type=int, required=True, help="number of images")
+    parser.add_argument("--seed", type=int, default=None, help="split seed (required unless the split is trnsimple or tstsimple)")
+    parser.add_argument("--n_views", type=int, default=1, help="views per object layout (see config_arrays.py)")
+    parser.add_argument("--shard_size", type=int, default=SHARD_SIZE, help="images per shard")
+    parser.add_argument("--n_procs", type=int, default=0, help="number of worker processes (0 = one per core)")
+    parser.add_argument("--path", type=str, default=None, help="where to write the shards (default ../output/customclevr_<split>_stream)")
+    parser.add_argument("--records", action="store_true", help="also write the per-image records render_image.py reads (see image_records.py)")
+    parser.add_argument("--no_visibility", action="store_true", help="do not check that every object is visible (see visibility.py)")
+    args = parser.parse_args()
+
+    generate(args.split, args.n_images, args.seed, args.path, args.shard_size, args.n_procs, args.records, args.n_views, not args.no_visibility)
+
+
+if __name__ == "__main__":
+    main()
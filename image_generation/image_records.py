@@ -0,0 +1,90 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# Per-image indexed copy of a split's config, so a render job can read the one image it renders in O(1)
+# instead of parsing the whole *_config.json (whose size grows with the split).
+# customclevr_<split>_records.jsonl: line 0 is the header (every config key that is not per-image), then one json record per image.
+# customclevr_<split>_records.idx: little-endian uint64 byte offsets into the .jsonl; entry imgidx is where image imgidx's record starts.
+# Only uses the standard library, so it works both inside blender and in any python.
+from __future__ import print_function
+import json
+import struct
+
+
+# config keys with one entry per image (see config_images.generate_config)
+PER_IMAGE_KEYS = ["theta", "mat_name", "mat_name_out", "shape_name", "shape_name_out", "color_name", "size_name", "r", "pos_planex", "pos_planey",
+                  "camera_offset", "key_light_offset", "fill_light_offset", "back_light_offset", "randomized_obj_idx", "eyes_same_color",
+                  "pixel_coords_x", "pixel_coords_y"]
+OFFSET_SIZE = 8 # bytes per entry of the .idx file
+
+
+def views_per_layout(config:dict) -> int:
+    """
+    number of consecutive images that show the same object layout from different camera and lamp positions
+    (image imgidx shows layout imgidx // views_per_layout, see config_images.base_config); 1 for configs without views
+    """
+    return config.get("n_views", 1)
+
+
+def records_path(split:str) -> str:
+    """prefix of the record files of a split"""
+    return "../output/customclevr_" + split + "_records"
+
+
+def get_image_params(config:dict, imgidx:int) -> dict:
+    """the per-image fields of image imgidx of a (*_config.json layout) config, i.e. its record"""
+    params = {"imgidx":imgidx}
+    for key in PER_IMAGE_KEYS:
+        params[key] = config[key][imgidx]
+    return params
+
+
+def write_records(config:dict, path:str):
+    """writes path.jsonl and path.idx for a config in the *_config.json layout"""
+    write_header(config, path)
+    append_records(config, path)
+
+
+def write_header(config:dict, path:str):
+    """starts path.jsonl (and an empty path.idx) with the split-wide settings of config; records are added with append_records"""
+    header = {key:value for key, value in config.items() if key not in PER_IMAGE_KEYS}
+    with open(path + ".jsonl", "wb") as f:
+        f.write((json.dumps(header) + "\n").encode("utf-8"))
+    with open(path + ".idx", "wb") as f:
+        pass
+
+
+def append_records(config:dict, path:str, first_imgidx:int=0):
+    """
+    appends the records of the images of a config in the *_config.json layout to path.jsonl and path.idx
+    - first_imgidx: imgidx of the config's first image (e.g. of a shard, see config_stream.py); records must be appended in imgidx order
+    """
+    offsets = []
+    with open(path + ".jsonl", "ab") as f:
+        f.seek(0, 2)
+        for row in range(config["n_images"]):
+            offsets.append(f.tell())
+            params = get_image_params(config, row)
+            params["imgidx"] = first_imgidx + row
+            f.write((json.dumps(params) + "\n").encode("utf-8"))
+    with open(path + ".idx", "ab") as f:
+        f.write(struct.pack("<%dQ" % len(offsets), *offsets))
+
+
+def read_header(path:str) -> dict:
+    """the split-wide settings (everything but the per-image fields)"""
+    with open(path + ".jsonl", "rb") as f:
+        return json.loads(f.readline().decode("utf-8"))
+
+
+def read_record(path:str, imgidx:int) -> dict:
+    """the per-image fields of image imgidx (same as get_image_params on the full config); reads one index entry and one line"""
+    with open(path + ".idx", "rb") as f:
+        f.seek(OFFSET_SIZE * imgidx)
+        entry = f.read(OFFSET_SIZE)
+    if len(entry) != OFFSET_SIZE:
+        raise IndexError("image " + str(imgidx) + " is not in " + path + ".jsonl")
+    offset = struct.unpack("<Q", entry)[0]
+    with open(path + ".jsonl", "rb") as f:
+        f.seek(offset)
+        params = json.loads(f.readline().decode("utf-8"))
+    assert params["imgidx"] == imgidx
+    return params
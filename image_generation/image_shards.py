@@ -0,0 +1,141 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Packs a split's rendered images into a few memory-mappable shards, so training can read any image without opening and
+# decoding a png: ../output/customclevr_<split>_shards/ holds
+#   images_<shard>.npy  shard_size x height x width x channels uint8 images (the last shard may be shorter)
+#   index.npy           n_images x 2 int64: imgidx and its position in ../output/customclevr_<split>_scenes.json ("scenes"), in packed order
+#   header.json         image shape, shard size and file names; written last, so a store without it is incomplete
+# The image at packed position i is row i % shard_size of shard i // shard_size.
+# Run this file directly to pack splits; read_image(split, imgidx) returns a read-only view into the memory-mapped shard.
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import pngio
+from render_image import image_file_path
+
+
+FORMAT_VERSION = 1
+SHARD_SIZE = 1024 # images per shard (~240 MB of 320 x 240 RGB images)
+BATCH_SIZE = 32 # images decoded together (see pngio.read_pngs)
+CHANNELS = 3 # blender's alpha channel is opaque everywhere (film is not transparent), so it is dropped
+
+open_stores = {} # split -> store (see load), opened by read_image the first time it is needed
+
+
+def store_path(split:str) -> str:
+    return "../output/customclevr_" + split + "_shards"
+
+
+def decode_batch(paths:list) -> np.ndarray:
+    """n x height x width x CHANNELS uint8 images"""
+    images = pngio.read_pngs(paths)
+    if images.dtype == np.uint16:
+        images = (images >> 8).astype(np.uint8)
+    if images.shape[-1] == 1:
+        images = np.repeat(images, 3, axis=-1)
+    return images[..., :CHANNELS]
+
+
+def pack(split:str, img_dir:str, path:str, n_procs:int=0, shard_size:int=SHARD_SIZE) -> int:
+    """
+    decodes the images of every scene in the split's scenes.json that has one in img_dir into shards at path, with n_procs
+    processes (0 = one per core); returns the number of images packed
+    """
+    with open("../output/customclevr_" + split + "_scenes.json", "r") as f:
+        scenes = json.load(f)["scenes"]
+    index = np.array([[scene["image_index"], row] for row, scene in enumerate(scenes) if os.path.exists(os.path.join(img_dir, scene["image_filename"]))], dtype=np.int64).reshape(-1, 2)
+    if len(index) < len(scenes):
+        print(split + ": " + str(len(scenes) - len(index)) + " of " + str(len(scenes)) + " images are not rendered and are left out")
+    if len(index) == 0:
+        return 0
+    index = index[np.argsort(index[:, 0], kind="stable")]
+    paths = [image_file_path(img_dir, split, imgidx) for imgidx in index[:, 0]]
+
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, "header.json")):
+        os.remove(os.path.join(path, "header.json")) # the store is incomplete until the new header is written
+    image_shape = list(decode_batch(paths[:1]).shape[1:])
+    n_shards = (len(paths) + shard_size - 1) // shard_size
+    shard_files = ["images_%04d.npy" % shardidx for shardidx in range(n_shards)]
+    shards = [np.lib.format.open_memmap(os.path.join(path, shard_files[shardidx]), mode="w+", dtype=np.uint8,
+                                        shape=tuple([min(shard_size, len(paths) - shardidx * shard_size)] + image_shape)) for shardidx in range(n_shards)]
+
+    # batches never straddle a shard, so every decoded batch is one slice assignment
+    batches = []
+    for shard_start in range(0, len(paths), shard_size):
+        shard_stop = min(shard_start + shard_size, len(paths))
+        batches += [(start, min(start + BATCH_SIZE, shard_stop)) for start in range(shard_start, shard_stop, BATCH_SIZE)]
+    pool = multiprocessing.Pool(n_procs if n_procs > 0 else os.cpu_count())
+    for (start, stop), images in zip(batches, pool.imap(decode_batch, [paths[start:stop] for start, stop in batches])):
+        if list(images.shape[1:]) != image_shape:
+            raise ValueError(paths[start] + ": images of a split must all have the same size")
+        shards[start // shard_size][start % shard_size:start % shard_size + stop - start] = images
+    pool.close()
+    pool.join()
+    for shard in shards:
+        shard.flush()
+    del shards
+
+    np.save(os.path.join(path, "index.npy"), index)
+    header = {"format_version":FORMAT_VERSION, "split":split, "n_images":len(index), "image_shape":image_shape, "dtype":"uint8",
+              "shard_size":shard_size, "shards":shard_files}
+    with open(os.path.join(path, "header.json"), "w") as f:
+        json.dump(header, f, indent=1)
+    return len(index)
+
+
+def load(path:str) -> dict:
+    """
+    opens a store written by pack(): its header, index, read-only memory maps of its shards (nothing is read until used), and
+    "positions", a dict imgidx -> packed position
+    """
+    with open(os.path.join(path, "header.json"), "r") as f:
+        header = json.load(f)
+    assert header["format_version"] == FORMAT_VERSION
+    store = {"header":header, "index":np.load(os.path.join(path, "index.npy"))}
+    store["shards"] = [np.load(os.path.join(path, name), mmap_mode="r") for name in header["shards"]]
+    store["positions"] = {imgidx:position for position, imgidx in enumerate(store["index"][:, 0].tolist())}
+    return store
+
+
+def get_image(store:dict, imgidx:int) -> np.ndarray:
+    """height x width x channels read-only view of image imgidx (no copy: the pages are read when the view is used)"""
+    position = store["positions"][imgidx]
+    shard_size = store["header"]["shard_size"]
+    return store["shards"][position // shard_size][position % shard_size]
+
+
+def scene_row(store:dict, imgidx:int) -> int:
+    """position of image imgidx's scene struct in the split's scenes.json "scenes" list"""
+    return int(store["index"][store["positions"][imgidx], 1])
+
+
+def read_image(split:str, imgidx:int) -> np.ndarray:
+    """get_image() from the split's store at store_path(split), opened the first time it is needed"""
+    if split not in open_stores:
+        open_stores[split] = load(store_path(split))
+    return get_image(open_stores[split], imgidx)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pack rendered images into memory-mappable shards at ../output/customclevr_<split>_shards/")
+    parser.add_argument("--splits", type=str, nargs="+", default=["trnsimple", "tstsimple"], help="which splits")
+    parser.add_argument("--img_dir", type=str, default="../output/images", help="where the rendered images are")
+    parser.add_argument("--n_procs", type=int, default=0, help="number of decoding processes (0 = one per core)")
+    parser.add_argument("--shard_size", type=int, default=SHARD_SIZE, help="images per shard")
+    args = parser.parse_args()
+
+    for split in args.splits:
+        start = time.time()
+        n_images = pack(split, args.img_dir, store_path(split), args.n_procs, args.shard_size)
+        print("packed " + str(n_images) + " " + split + " images into " + store_path(split) + " in %.1f s" % (time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
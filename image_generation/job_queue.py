@@ -0,0 +1,307 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Render job queue on a shared filesystem (e.g. NFS), so any number of render hosts can pull (split, imgidx) jobs from one queue.
+# Every job is one file that moves between directories with atomic renames, so exactly one worker wins each move:
+#   <queue>/pending/<split>_<imgidx>.job  waiting to be rendered
+#   <queue>/leases/<split>_<imgidx>.job   claimed by a worker (whose host/pid/attempt are in the file); the file's mtime is the
+#                                          lease heartbeat, and a lease not renewed for lease_seconds is moved back to pending
+#   <queue>/done/<split>_<imgidx>.job     rendered
+#   <queue>/failed/<split>_<imgidx>.job   gave up after max_attempts claims
+# While a job is being rendered, a heartbeat thread (see start_heartbeat) renews its lease every lease_seconds / 3.
+# Only uses the standard library, so it works both inside blender and in any python.
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+
+STATES = ["pending", "leases", "done", "failed"]
+LEASE_SECONDS = 900 # a worker that doesn't renew its lease for this long is presumed dead; must be longer than one render
+MAX_ATTEMPTS = 3
+
+
+def job_name(split:str, imgidx:int) -> str:
+    return split + "_%06d.job" % imgidx
+
+
+def parse_job_name(name:str) -> tuple:
+    split, imgidx = name[:-len(".job")].rsplit("_", 1)
+    return split, int(imgidx)
+
+
+def create(queue_dir:str, jobs:list) -> int:
+    """adds jobs to the queue (jobs already in it, in any state, are left alone); returns the number added"""
+    for state in STATES:
+        os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+    existing = set()
+    for state in STATES:
+        existing.update(os.listdir(os.path.join(queue_dir, state)))
+    n_added = 0
+    for split, imgidx in jobs:
+        name = job_name(split, imgidx)
+        if name in existing:
+            continue
+        try:
+            fd = os.open(os.path.join(queue_dir, "pending", name), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue # another process added it at the same time
+        os.write(fd, json.dumps({"attempts":0}).encode("utf-8"))
+        os.close(fd)
+        n_added += 1
+    return n_added
+
+
+def fs_now(queue_dir:str) -> float:
+    """the shared filesystem's current time (file mtimes are set by the file server, whose clock may differ from ours)"""
+    probe = os.path.join(queue_dir, "leases", ".clock_%s_%d" % (socket.gethostname(), os.getpid()))
+    with open(probe, "w"):
+        pass
+    now = os.path.getmtime(probe)
+    os.remove(probe)
+    return now
+
+
+def read_job_file(path:str) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return {"attempts":0} # written by a worker that died mid-write
+
+
+def claim(queue_dir:str, lease_seconds:float=LEASE_SECONDS, max_attempts:int=MAX_ATTEMPTS):
+    """
+    takes one pending job and leases it to this process, reclaiming expired leases if nothing is pending
+    returns (split, imgidx), or None if every job is done, failed or leased to a live worker
+    """
+    for _ in range(2):
+        names = [name for name in os.listdir(os.path.join(queue_dir, "pending")) if name.endswith(".job")]
+        random.shuffle(names) # so concurrent workers rarely race for the same job
+        for name in names:
+            lease = os.path.join(queue_dir, "leases", name)
+            try:
+                # start the lease before the rename, so reclaim() never sees a fresh lease with the old mtime of the pending file
+                os.utime(os.path.join(queue_dir, "pending", name))
+                os.rename(os.path.join(queue_dir, "pending", name), lease)
+            except FileNotFoundError:
+                continue # another worker got it first
+            if os.path.exists(os.path.join(queue_dir, "done", name)):
+                os.remove(lease) # completed by a worker whose lease had expired (see complete)
+                continue
+            info = read_job_file(lease)
+            info.update({"attempts":info.get("attempts", 0) + 1, "host":socket.gethostname(), "pid":os.getpid(), "claimed":time.time()})
+            if info["attempts"] > max_attempts:
+                os.replace(lease, os.path.join(queue_dir, "failed", name))
+                continue
+            with open(lease, "w") as f: # also renews the lease (mtime)
+                json.dump(info, f)
+            return parse_job_name(name)
+        if reclaim(queue_dir, lease_seconds) == 0:
+            return None
+    return None
+
+
+def reclaim(queue_dir:str, lease_seconds:float=LEASE_SECONDS) -> int:
+    """moves leases that have not been renewed for lease_seconds back to pending; returns how many"""
+    now = fs_now(queue_dir)
+    n_reclaimed = 0
+    for name in os.listdir(os.path.join(queue_dir, "leases")):
+        if not name.endswith(".job"):
+            continue
+        lease = os.path.join(queue_dir, "leases", name)
+        try:
+            expired = now - os.path.getmtime(lease) > lease_seconds
+            if expired and os.path.exists(os.path.join(queue_dir, "done", name)):
+                os.remove(lease) # completed meanwhile by the worker that lost it (see complete)
+            elif expired:
+                os.rename(lease, os.path.join(queue_dir, "pending", name))
+                n_reclaimed += 1
+        except FileNotFoundError:
+            continue # completed or reclaimed by someone else meanwhile
+    return n_reclaimed
+
+
+def renew(queue_dir:str, split:str, imgidx:int) -> bool:
+    """extends this process's lease on a job; False if it was lost (reclaimed after expiring)"""
+    try:
+        os.utime(os.path.join(queue_dir, "leases", job_name(split, imgidx)))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def holds_lease(queue_dir:str, name:str, pid:int=None) -> bool:
+    """whether process pid (default this process) on this host holds the lease on job file name, i.e. it has not expired and been claimed by another worker"""
+    try:
+        info = read_job_file(os.path.join(queue_dir, "leases", name))
+    except FileNotFoundError:
+        return False
+    return info.get("host") == socket.gethostname() and info.get("pid") == (os.getpid() if pid is None else pid)
+
+
+def complete(queue_dir:str, split:str, imgidx:int):
+    name = job_name(split, imgidx)
+    if holds_lease(queue_dir, name):
+        try:
+            os.replace(os.path.join(queue_dir, "leases", name), os.path.join(queue_dir, "done", name))
+            return
+        except FileNotFoundError:
+            pass # reclaimed just now
+    # the lease expired, and another worker may be rendering the job now under its own lease, which is left alone; the image is
+    # rendered anyway, so just record it as done, and take the job out of pending/ if it is waiting there (a worker that holds it
+    # leases its done/ file away, see claim and reclaim) and out of failed/ if the other attempts gave up on it
+    with open(os.path.join(queue_dir, "done", name), "w") as f:
+        json.dump({"host":socket.gethostname(), "pid":os.getpid()}, f)
+    for state in ["pending", "failed"]:
+        try:
+            os.remove(os.path.join(queue_dir, state, name))
+        except FileNotFoundError:
+            pass # e.g. claimed by another worker, or never requeued
+
+
+def start_heartbeat(queue_dir:str, split:str, imgidx:int, lease_seconds:float=LEASE_SECONDS) -> dict:
+    """
+    renews this process's lease on a job every lease_seconds / 3 from a background thread until stop_heartbeat(), so a job
+    may take longer than lease_seconds; beat() renews it from elsewhere too (at most as often), e.g. from a render progress
+    callback in case something keeps the thread from running
+    """
+    heartbeat = {"queue_dir":queue_dir, "job":(split, imgidx), "interval":lease_seconds / 3, "last":time.time(), "lost":False, "stop":threading.Event()}
+    heartbeat["thread"] = threading.Thread(target=heartbeat_loop, args=(heartbeat,), daemon=True)
+    heartbeat["thread"].start()
+    return heartbeat
+
+
+def heartbeat_loop(heartbeat:dict):
+    while not heartbeat["stop"].wait(heartbeat["interval"] / 4):
+        beat(heartbeat)
+
+
+def beat(heartbeat:dict):
+    """renews the heartbeat's lease if it was last renewed more than its interval ago (and has not been lost)"""
+    if not heartbeat["lost"] and time.time() - heartbeat["last"] >= heartbeat["interval"]:
+        heartbeat["last"] = time.time()
+        heartbeat["lost"] = not renew(heartbeat["queue_dir"], *heartbeat["job"])
+
+
+def stop_heartbeat(heartbeat:dict):
+    heartbeat["stop"].set()
+    heartbeat["thread"].join()
+
+
+def release(queue_dir:str, split:str, imgidx:int, pid:int=None):
+    """
+    gives a job back (e.g. its render failed) so another attempt can claim it
+    pid: the process holding the lease (default this process), e.g. a hung worker that was killed
+    does nothing if the lease was lost: the job is already back in pending/ or leased to another worker
+    """
+    name = job_name(split, imgidx)
+    if not holds_lease(queue_dir, name, pid):
+        return
+    try:
+        os.rename(os.path.join(queue_dir, "leases", name), os.path.join(queue_dir, "pending", name))
+    except FileNotFoundError:
+        pass
+
+
+def status(queue_dir:str) -> dict:
+    return {state:len([name for name in os.listdir(os.path.join(queue_dir, state)) if name.endswith(".job")]) for state in STATES}
+
+
+def iterate(queue_dir:str, lease_seconds:float=LEASE_SECONDS, max_attempts:int=MAX_ATTEMPTS, poll_seconds:float=30.0):
+    """
+    yields claimed jobs until the queue is drained; the caller must complete() or release() each one
+    waits (polling) while jobs are still leased to other workers, since their leases may expire
+    """
+    while True:
+        job = claim(queue_dir, lease_seconds, max_attempts)
+        if job is not None:
+            yield job
+            continue
+        counts = status(queue_dir)
+        if counts["pending"] == 0 and counts["leases"] == 0:
+            return
+        time.sleep(poll_seconds)
+
+
+def simulate_worker(queue_dir:str, seconds:float, crash_rate:float, stall_rate:float, fail_rate:float, lease_seconds:float, seed:int):
+    """
+    a worker that "renders" by sleeping, for testing the queue without blender; it sometimes dies holding its lease,
+    sometimes stalls without renewing it for longer than lease_seconds, then finishes the job someone else has reclaimed,
+    and sometimes fails and releases the job
+    """
+    random.seed(seed)
+    for split, imgidx in iterate(queue_dir, lease_seconds, MAX_ATTEMPTS, poll_seconds=lease_seconds / 4):
+        if random.random() < crash_rate:
+            os._exit(1) # no cleanup, like a killed process
+        if random.random() < stall_rate:
+            time.sleep(2 * lease_seconds) # e.g. a host that was suspended
+        else:
+            heartbeat = start_heartbeat(queue_dir, split, imgidx, lease_seconds)
+            time.sleep(seconds)
+            stop_heartbeat(heartbeat)
+        if random.random() < fail_rate:
+            release(queue_dir, split, imgidx)
+            continue
+        with open(os.path.join(queue_dir, "renders.log"), "a") as f:
+            f.write(split + " " + str(imgidx) + "\n")
+        complete(queue_dir, split, imgidx)
+
+
+def jobs_in_several_states(queue_dir:str) -> list:
+    """names of jobs that are in more than one state directory at once (should be none once the queue is drained)"""
+    seen = {}
+    for state in STATES:
+        for name in os.listdir(os.path.join(queue_dir, state)):
+            if name.endswith(".job"):
+                seen.setdefault(name, []).append(state)
+    return sorted(name for name, states in seen.items() if len(states) > 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="shared-filesystem render job queue (see README.md)")
+    parser.add_argument("command", choices=["create", "status", "reclaim", "simulate"], help="create: add --jobs to the queue; status: count jobs per state; "
+                        + "reclaim: requeue expired leases now; simulate: run --n_workers fake workers (some crash) until the queue is drained")
+    parser.add_argument("--queue", type=str, required=True, help="queue directory, on a filesystem every render host can see")
+    parser.add_argument("--jobs", type=str, nargs="+", default=[], help="images as split:indices, e.g. trnsimple:0-99 tstsimple:0-99 (ranges are inclusive-inclusive)")
+    parser.add_argument("--lease_seconds", type=float, default=LEASE_SECONDS, help="how long a lease lasts without renewal")
+    parser.add_argument("--n_workers", type=int, default=4, help="simulate: number of worker processes")
+    parser.add_argument("--crash_rate", type=float, default=0.1, help="simulate: probability that a worker dies holding a job")
+    parser.add_argument("--stall_rate", type=float, default=0.1, help="simulate: probability that a worker stalls past its lease and completes the job late")
+    parser.add_argument("--fail_rate", type=float, default=0.1, help="simulate: probability that a fake render fails and its job is released")
+    parser.add_argument("--seconds", type=float, default=0.01, help="simulate: seconds per fake render")
+    args = parser.parse_args()
+
+    if args.command == "create":
+        from render_image import parse_jobs
+        print("added " + str(create(args.queue, parse_jobs(args.jobs))) + " jobs to " + args.queue)
+    elif args.command == "reclaim":
+        print("reclaimed " + str(reclaim(args.queue, args.lease_seconds)) + " expired leases")
+    elif args.command == "simulate":
+        workers = []
+        seed = 0
+        while status(args.queue)["pending"] + status(args.queue)["leases"] > 0:
+            workers = [w for w in workers if w.is_alive()]
+            while len(workers) < args.n_workers: # replace crashed workers, like a cluster scheduler would
+                seed += 1
+                workers.append(multiprocessing.Process(target=simulate_worker, args=(args.queue, args.seconds, args.crash_rate, args.stall_rate, args.fail_rate, args.lease_seconds, seed)))
+                workers[-1].start()
+            time.sleep(args.lease_seconds / 4)
+        for w in workers:
+            w.join()
+        duplicated = jobs_in_several_states(args.queue)
+        print(json.dumps(status(args.queue)))
+        if len(duplicated) > 0:
+            print("jobs in more than one state: " + " ".join(duplicated))
+            sys.exit(1)
+        return
+    print(json.dumps(status(args.queue)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# Vectorized checks for placing an object among already-placed objects, shared by config_images.randomize_pos and config_arrays.randomize_pos.
+# Candidates are drawn in batches (one batch = max_retries candidates) and checked against every placed object at once;
+# the first valid candidate of a batch is the one a one-at-a-time rejection sampler would have accepted.
+from __future__ import print_function
+
+import numpy as np
+
+
+MAX_SCENE_ATTEMPTS = 100 # how many times to re-place a whole scene (each after max_retries rejected candidates) before giving up
+CHUNK_SIZE = 16384 # scenes checked per call to valid_candidates, to bound memory (n_scenes x n_candidates x n_objects temporaries)
+SUB_BATCH_SIZE = 10 # candidates checked at once; scenes that accept one skip checking the rest of their batch
+
+
+def valid_candidates(cand_x:np.ndarray, cand_y:np.ndarray, x:np.ndarray, y:np.ndarray, r:np.ndarray, rr:np.ndarray, min_dist:float, margin:float=0.0, dirs:np.ndarray=None) -> np.ndarray:
+    """
+    which candidate positions keep the new object clear of all placed objects
+    - cand_x, cand_y: n_scenes x n_candidates candidate positions on the ground plane
+    - x, y, r: n_scenes x n_objects positions and sizes of the objects to keep clear of
+    - rr: n_scenes sizes of the object being placed
+    - min_dist: minimum gap between the objects' edges
+    - margin, dirs: if margin > 0, the candidate must also be at least margin from every object along each of the
+      n_scenes x n_dirs x 2 (ground-plane) directions, e.g. left and behind (as in the original CLEVR code)
+    returns n_scenes x n_candidates bool
+    """
+    dx = x[:, None, :] - cand_x[:, :, None] # n_scenes x n_candidates x n_objects
+    dy = y[:, None, :] - cand_y[:, :, None]
+    gap = np.sqrt(dx * dx + dy * dy) - r[:, None, :] - rr[:, None, None]
+    ok = gap >= min_dist
+    if margin > 0:
+        for diridx in range(dirs.shape[1]):
+            along = dx * dirs[:, None, None, diridx, 0] + dy * dirs[:, None, None, diridx, 1]
+            ok &= ~((along != 0) & (np.abs(along) < margin))
+    return np.all(ok, axis=2)
+
+
+def first_valid(valid:np.ndarray) -> np.ndarray:
+    """index of the first valid candidate of each scene (n_scenes x n_candidates bool), or -1 where none is valid"""
+    return np.where(valid.any(axis=1), valid.argmax(axis=1), -1)
+
+
+def n_tried(first:np.ndarray, batch_size:int) -> np.ndarray:
+    """number of candidates a one-at-a-time sampler would have drawn from each batch"""
+    return np.where(first >= 0, first + 1, batch_size)
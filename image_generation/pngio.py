@@ -0,0 +1,169 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# Minimal PNG reader (numpy + zlib) for the images blender writes, so rendered images can be analysed outside blender
+# without an imaging library. Supports non-interlaced 8/16-bit grayscale, gray+alpha, RGB and RGBA images.
+# write_png() writes the same kinds of images (unfiltered), e.g. the masks and depth maps of annotations.py.
+from __future__ import print_function
+import struct
+import zlib
+
+import numpy as np
+
+
+SIGNATURE = b"\x89PNG\r\n\x1a\n"
+CHANNELS = {0:1, 2:3, 4:2, 6:4} # color type -> samples per pixel
+
+
+def read_png(path:str) -> np.ndarray:
+    """returns the image as a height x width x channels uint8 or uint16 array"""
+    return read_pngs([path])[0]
+
+
+def read_pngs(paths:list) -> np.ndarray:
+    """
+    returns the images as an n x height x width x channels uint8 or uint16 array; they must all have the same size and format
+    decoding several images at once is much faster per image than read_png() (see unfilter_wavefront)
+    """
+    header = None
+    raws = []
+    for path in paths:
+        path_header, raw = read_scanlines(path)
+        if header is not None and path_header != header:
+            raise ValueError(path + " has a different size or format than " + paths[0])
+        header = path_header
+        raws.append(raw)
+    width, height, bit_depth, color_type = header
+    raw = np.stack(raws)
+    rows = unfilter(raw[:, :, 1:], raw[:, :, 0], CHANNELS[color_type] * bit_depth // 8)
+    if bit_depth == 16:
+        rows = rows.view(">u2").astype(np.uint16)
+    return rows.reshape(len(paths), height, width, CHANNELS[color_type])
+
+
+def read_scanlines(path:str):
+    """returns (width, height, bit depth, color type) and the decompressed, still filtered height x (1 + bytes per row) scanlines"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:8] != SIGNATURE:
+        raise ValueError(path + " is not a png file")
+
+    pos = 8
+    idat = []
+    header = None
+    while pos < len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos+8])
+        chunk = data[pos+8:pos+8+length]
+        pos += 12 + length # length, type, data, crc
+        if kind == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif kind == b"IDAT":
+            idat.append(chunk)
+        elif kind == b"IEND":
+            break
+    width, height, bit_depth, color_type, _, _, interlace = header
+    if bit_depth not in [8, 16] or color_type not in CHANNELS or interlace != 0:
+        raise ValueError(path + ": unsupported png (bit depth " + str(bit_depth) + ", color type " + str(color_type) + ", interlace " + str(interlace) + ")")
+
+    stride = width * CHANNELS[color_type] * bit_depth // 8
+    raw = np.frombuffer(zlib.decompress(b"".join(idat)), dtype=np.uint8).reshape(height, stride + 1)
+    return (width, height, bit_depth, color_type), raw
+
+
+def write_png(path:str, image:np.ndarray, level:int=6):
+    """writes a height x width (grayscale) or height x width x channels uint8 or uint16 array as a png"""
+    if image.ndim == 2:
+        image = image[:, :, None]
+    height, width, channels = image.shape
+    color_type = {v:k for k, v in CHANNELS.items()}[channels]
+    bit_depth = {np.dtype(np.uint8):8, np.dtype(np.uint16):16}[image.dtype]
+    rows = image.astype(">u2" if bit_depth == 16 else np.uint8).reshape(height, -1).view(np.uint8)
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), rows]) # filter type 0 (None) on every scanline
+    with open(path, "wb") as f:
+        f.write(SIGNATURE)
+        for kind, chunk in [(b"IHDR", struct.pack(">IIBBBBB", width, height, bit_depth, color_type, 0, 0, 0)),
+                            (b"IDAT", zlib.compress(raw.tobytes(), level)), (b"IEND", b"")]:
+            f.write(struct.pack(">I", len(chunk)) + kind + chunk + struct.pack(">I", zlib.crc32(kind + chunk) & 0xffffffff))
+
+
+def check_png(path:str, size:tuple=None) -> bool:
+    """
+    whether path is a complete png (every chunk's crc matches, up to IEND) without decoding it, e.g. to catch partially written renders
+    - size: expected (width, height)
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return False
+    if data[:8] != SIGNATURE:
+        return False
+    pos = 8
+    while pos + 12 <= len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos+8])
+        if pos + 12 + length > len(data):
+            return False
+        crc = struct.unpack(">I", data[pos+8+length:pos+12+length])[0]
+        if zlib.crc32(data[pos+4:pos+8+length]) & 0xffffffff != crc:
+            return False
+        if kind == b"IHDR" and size is not None and struct.unpack(">II", data[pos+8:pos+16]) != tuple(size):
+            return False
+        if kind == b"IEND":
+            return True
+        pos += 12 + length
+    return False
+
+
+def unfilter(scanlines:np.ndarray, filters:np.ndarray, bpp:int) -> np.ndarray:
+    """
+    undoes the per-scanline png filters (https://www.w3.org/TR/png/#9Filters)
+    - scanlines: (n x) height x bytes per row, filters: (n x) height filter types, for n images at once
+    """
+    if np.isin(filters, [3, 4]).any():
+        return unfilter_wavefront(scanlines, filters, bpp)
+    out = np.zeros_like(scanlines)
+    prev = np.zeros(scanlines.shape[:-2] + scanlines.shape[-1:], dtype=np.uint8)
+    for y in range(scanlines.shape[-2]):
+        line = scanlines[..., y, :]
+        kind = filters[..., y, None]
+        sub = np.cumsum(line.reshape(line.shape[:-1] + (-1, bpp)), axis=-2, dtype=np.uint8).reshape(line.shape) # running sum (mod 256) of every bpp-th byte
+        cur = np.where(kind == 1, sub, line + np.where(kind == 2, prev, 0).astype(np.uint8)) # 0: None, 1: Sub, 2: Up
+        if not np.isin(kind, [0, 1, 2]).all():
+            raise ValueError("unknown png filter type " + str(kind[~np.isin(kind, [0, 1, 2])][0]))
+        out[..., y, :] = cur
+        prev = cur
+    return out
+
+
+def unfilter_wavefront(scanlines:np.ndarray, filters:np.ndarray, bpp:int) -> np.ndarray:
+    """
+    unfilter() for images with Average or Paeth scanlines, whose bytes depend on the unfiltered pixel to their left:
+    pixel (y, x) only depends on pixels (y, x-1), (y-1, x) and (y-1, x-1), so all pixels on one anti-diagonal y + x = d
+    (of all n images) are unfiltered at once, in height + width - 1 vectorized steps instead of one python step per byte.
+    Pixel (y, x) is kept at skewed[y + x + 2, :, y + 1], so every diagonal and its neighbors are contiguous slices
+    (the first two diagonals and the first row are zero padding for the pixels left of and above the image).
+    """
+    if not np.isin(filters, [0, 1, 2, 3, 4]).all():
+        raise ValueError("unknown png filter type " + str(filters[~np.isin(filters, [0, 1, 2, 3, 4])][0]))
+    shape = scanlines.shape
+    scanlines = scanlines.reshape((-1,) + shape[-2:])
+    filters = filters.reshape(-1, shape[-2])
+    n, height, stride = scanlines.shape
+    width = stride // bpp
+    ys = np.arange(height)[:, None]
+    diags = ys + np.arange(width)[None, :] + 2
+    lines = np.zeros((height + width + 2, n, height, bpp), dtype=np.int16)
+    lines[diags, :, ys] = scanlines.reshape(n, height, width, bpp).transpose(1, 2, 0, 3) # lines[d + 2, :, y] is the filtered pixel (y, d - y)
+    kinds = [(filters == kind)[:, :, None].astype(np.int16) for kind in range(5)] # 0/1 factors per row (cheaper than np.where)
+    skewed = np.zeros((height + width + 2, n, height + 1, bpp), dtype=np.int16)
+    for d in range(height + width - 1):
+        lo, hi = max(0, d - width + 1), min(height, d + 1)
+        a = skewed[d+1, :, lo+1:hi+1] # left
+        b = skewed[d+1, :, lo:hi] # up
+        c = skewed[d, :, lo:hi] # up left
+        ac, bc = a - c, b - c
+        pa, pb, pc = np.abs(bc), np.abs(ac), np.abs(ac + bc) # distances of p = a + b - c to a, b and c
+        use_a = (pa <= pb) & (pa <= pc)
+        paeth = c + use_a * ac + (~use_a & (pb <= pc)) * bc
+        predictor = kinds[1][:, lo:hi] * a + kinds[2][:, lo:hi] * b + kinds[3][:, lo:hi] * ((a + b) >> 1) + kinds[4][:, lo:hi] * paeth
+        skewed[d+2, :, lo+1:hi+1] = (lines[d+2, :, lo:hi] + predictor) & 0xff
+    out = skewed[diags, :, ys + 1] # height x width x n x bpp
+    return out.transpose(2, 0, 1, 3).astype(np.uint8).reshape(shape)
@@ -0,0 +1,155 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# Blender-free version of the metadata that config_images.render_scene computes by setting up each scene in blender:
+# per-object 3d_coords and pixel_coords and the per-image cardinal directions.
+# Everything follows from the config and the camera in data/base_scene.blend, so all images are computed at once with numpy.
+# Run this file directly to compare against the blender-generated ../output/*_scenes.json.
+from __future__ import print_function
+import json
+import sys
+
+import numpy as np
+
+import image_records
+
+
+# camera intrinsics of the "Camera" object in data/base_scene.blend
+CAMERA_LENS         = 35.0 # focal length (mm)
+CAMERA_SENSOR_WIDTH = 32.0 # sensor width (mm); sensor fit is AUTO, so the sensor spans the wider (x) axis of the image
+CAMERA_TARGET       = (0.0, 0.0, 0.0) # the camera has a Track To constraint (-Z forward, Y up) that keeps it aimed at the origin
+RESOLUTION          = (320, 240) # must match render_args.resolution_x/y (at resolution_percentage = 100)
+
+DIRECTION_NAMES = ["behind", "front", "left", "right", "above", "below"] # order of scene_struct["directions"]
+
+
+def camera_locations(config:dict) -> np.ndarray:
+    """n_images x 3 world-space camera positions (camera_location plus the per-image jitter)"""
+    locs = np.tile(np.asarray(config["camera_location"], dtype=np.float64), (len(config["camera_offset"]), 1))
+    if config["camera_jitter"] > 0:
+        locs += np.asarray(config["camera_offset"], dtype=np.float64)
+    return locs
+
+
+def camera_basis(cam_locs:np.ndarray):
+    """
+    world-space axes of a camera tracking CAMERA_TARGET with world Z up, for each row of cam_locs (n x 3)
+    returns (forward, right, up), each n x 3; forward is the camera's -Z axis, right its +X axis, up its +Y axis
+    """
+    forward = np.asarray(CAMERA_TARGET)[None, :] - cam_locs
+    forward /= np.linalg.norm(forward, axis=1, keepdims=True)
+    right = np.cross(forward, np.array([0.0, 0.0, 1.0])[None, :])
+    right /= np.linalg.norm(right, axis=1, keepdims=True)
+    up = np.cross(right, forward)
+    return forward, right, up
+
+
+def get_plane_dirs(cam_locs:np.ndarray) -> dict:
+    """same as config_images.get_plane_dirs(), for every camera position at once; maps direction name to an n x 3 array"""
+    forward, right, up = camera_basis(cam_locs)
+    plane_normal = np.array([0.0, 0.0, 1.0])
+    plane_behind = forward - (forward @ plane_normal)[:, None] * plane_normal[None, :]
+    plane_behind /= np.linalg.norm(plane_behind, axis=1, keepdims=True)
+    plane_left = -right - (-right @ plane_normal)[:, None] * plane_normal[None, :]
+    plane_left /= np.linalg.norm(plane_left, axis=1, keepdims=True)
+    plane_up = (up @ plane_normal)[:, None] * plane_normal[None, :]
+    plane_up /= np.linalg.norm(plane_up, axis=1, keepdims=True)
+
+    plane_dirs = {}
+    plane_dirs["behind"] = plane_behind
+    plane_dirs["front"]  = -plane_behind
+    plane_dirs["left"]   = plane_left
+    plane_dirs["right"]  = -plane_left
+    plane_dirs["above"]  = plane_up
+    plane_dirs["below"]  = -plane_up
+    return plane_dirs
+
+
+def object_coords(config:dict) -> np.ndarray:
+    """
+    n_images x n_objects x 3 world-space object locations, as add_object() places them: (pos_planex, pos_planey, r)
+    rounded to float32 like blender's object locations, so pixel coords round the same way
+    """
+    coords = np.stack([np.asarray(config["pos_planex"], dtype=np.float64),
+                       np.asarray(config["pos_planey"], dtype=np.float64),
+                       np.asarray(config["r"], dtype=np.float64)], axis=-1)
+    return coords.astype(np.float32).astype(np.float64)
+
+
+def get_camera_coords(cam_locs:np.ndarray, coords:np.ndarray):
+    """
+    same as config_images.get_camera_coords() (i.e. bpy_extras.object_utils.world_to_camera_view), vectorized
+    - cam_locs: n_images x 3 camera positions
+    - coords: n_images x n_objects x 3 world-space points
+    returns (px, py, depth), each n_images x n_objects; px and py are integer pixel coordinates, depth is the distance along the view axis
+    """
+    forward, right, up = camera_basis(cam_locs)
+    diff = coords - cam_locs[:, None, :]
+    depth = np.einsum("ijk,ik->ij", diff, forward)
+    w, h = RESOLUTION
+    half_width = 0.5 * CAMERA_SENSOR_WIDTH / CAMERA_LENS # half the view frame width at unit depth (the sensor spans x since w >= h)
+    half_height = half_width * h / w
+    x = 0.5 + np.einsum("ijk,ik->ij", diff, right) / depth / (2.0 * half_width)
+    y = 0.5 + np.einsum("ijk,ik->ij", diff, up) / depth / (2.0 * half_height)
+    px = np.round(x * w).astype(np.int64)
+    py = np.round(h - y * h).astype(np.int64)
+    return px, py, depth
+
+
+def get_scenes(config:dict) -> list:
+    """
+    the scene structs config_images.render_scene() would produce for every image (without relationships)
+    like render_scene, fills in config["pixel_coords_x"] and config["pixel_coords_y"]
+    """
+    cam_locs = camera_locations(config)
+    plane_dirs = get_plane_dirs(cam_locs)
+    coords = object_coords(config)
+    px, py, depth = get_camera_coords(cam_locs, coords)
+    n_views = image_records.views_per_layout(config)
+
+    all_scenes = []
+    for imgidx in range(config["n_images"]):
+        for objidx1 in range(config["n_objects"]):
+            for objidx2 in range(objidx1+1, config["n_objects"]): # for each other object
+                assert not ((px[imgidx,objidx1] == px[imgidx,objidx2]) and (py[imgidx,objidx1] == py[imgidx,objidx2]))
+        scene_struct = {"split":config["split"], "image_index":imgidx, "image_filename":"customclevr_" + config["split"] + "_%06d.png" % imgidx, "objects":[], "directions":{}}
+        scene_struct["directions"] = {name:tuple(plane_dirs[name][imgidx].tolist()) for name in DIRECTION_NAMES}
+        if n_views > 1: # same as config_images.add_view_index
+            scene_struct["layout_index"] = imgidx // n_views
+            scene_struct["view_index"] = imgidx % n_views
+        for objidx in range(config["n_objects"]):
+            scene_struct["objects"].append({
+                "shape": config["shape_name_out"][imgidx][objidx],
+                "size": config["size_name"][imgidx][objidx],
+                "material": config["mat_name_out"][imgidx][objidx],
+                "3d_coords": tuple(coords[imgidx,objidx].tolist()),
+                "rotation": config["theta"][imgidx][objidx],
+                "pixel_coords": (int(px[imgidx,objidx]), int(py[imgidx,objidx]), float(depth[imgidx,objidx])),
+                "color": config["color_name"][imgidx][objidx],
+            })
+        all_scenes.append(scene_struct)
+    config["pixel_coords_x"] = px.tolist()
+    config["pixel_coords_y"] = py.tolist()
+    return all_scenes
+
+
+def compare_scenes(scenes_a:list, scenes_b:list) -> dict:
+    """max absolute differences between two lists of scene structs, e.g. projection vs blender"""
+    diffs = {"3d_coords":0.0, "pixel_coords":0.0, "depth":0.0, "directions":0.0}
+    assert len(scenes_a) == len(scenes_b)
+    for scene_a, scene_b in zip(scenes_a, scenes_b):
+        for obj_a, obj_b in zip(scene_a["objects"], scene_b["objects"]):
+            diffs["3d_coords"]    = max(diffs["3d_coords"], float(np.abs(np.subtract(obj_a["3d_coords"], obj_b["3d_coords"])).max()))
+            diffs["pixel_coords"] = max(diffs["pixel_coords"], float(np.abs(np.subtract(obj_a["pixel_coords"][:2], obj_b["pixel_coords"][:2])).max()))
+            diffs["depth"]        = max(diffs["depth"], abs(obj_a["pixel_coords"][2] - obj_b["pixel_coords"][2]))
+        for name in DIRECTION_NAMES:
+            diffs["directions"] = max(diffs["directions"], float(np.abs(np.subtract(scene_a["directions"][name], scene_b["directions"][name])).max()))
+    return diffs
+
+
+if __name__ == "__main__":
+    # check against the blender-generated metadata, e.g. after changing base_scene.blend
+    for split in sys.argv[1:] if len(sys.argv) > 1 else ["trnsimple", "tstsimple"]:
+        with open("../output/customclevr_" + split + "_config.json", "r") as f:
+            config = json.load(f)
+        with open("../output/customclevr_" + split + "_scenes.json", "r") as f:
+            blender_scenes = json.load(f)["scenes"]
+        print(split + ": max abs difference from blender:", compare_scenes(get_scenes(config), blender_scenes))
@@ -0,0 +1,59 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Rebuilds the .blend file of any rendered image from the split's records (see image_records.py), without rendering,
+# for when someone needs to inspect a scene; render_image.py only saves them with --save_blend.
+# By default each scene is built from data/base_scene.blend and the asset files, as render_image.py --no_template builds it, so
+# the file holds only the scene's own shapes and materials. With --template it starts from the prepared scene template (see
+# scene_template.py), as render_image.py does by default: the scene renders the same, but the file also holds every other shape
+# and material of the split.
+# Run with blender, e.g. blender --background --python rebuild_blend.py -- --jobs trnsimple:5 tstsimple:40-42
+from __future__ import print_function
+import argparse
+import os
+import sys
+
+import image_records
+import render_image
+import render_settings
+
+INSIDE_BLENDER = True
+try:
+    import bpy
+except ImportError as e:
+    INSIDE_BLENDER = False
+
+
+def main():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(description="rebuild the .blend files of customclevr images (see README.md)")
+    parser.add_argument("--jobs", type=str, nargs="+", required=True, help="images as split:indices, e.g. trnsimple:0-99 or tstsimple:0,5,10-19 (ranges are inclusive-inclusive)")
+    parser.add_argument("--profile", type=str, default=render_settings.DEFAULT_PROFILE, choices=sorted(render_settings.PROFILES.keys()), help="render profile the images were rendered with (see render_settings.py)")
+    parser.add_argument("--template", action="store_true", help="start from the prepared scene template, as render_image.py does without --no_template (see scene_template.py)")
+    parser.add_argument("--annotations", action="store_true", help="images were rendered with --annotations: also set up the object index and depth passes")
+    parser.add_argument("--outdir", type=str, default=None, help="where to write the .blend files (default ../output/blendfiles, where render_image.py --save_blend puts them)")
+    args = parser.parse_args(argv)
+
+    jobs = render_image.parse_jobs(args.jobs)
+    configs = {}
+    for split in sorted(set(split for split, _ in jobs)):
+        configs[split] = image_records.read_header(image_records.records_path(split))
+
+    for split, imgidx in jobs:
+        config = configs[split]
+        params = image_records.read_record(image_records.records_path(split), imgidx)
+        blend_path = render_image.blend_file_path(split, imgidx)
+        if args.outdir is not None:
+            blend_path = os.path.join(args.outdir, os.path.basename(blend_path))
+        print("rebuilding " + blend_path + "...")
+        # each scene starts from a freshly opened base scene, as the first image of a render_image.py --save_blend run is saved
+        base_state = render_image.setup_scene(config, profile=args.profile, annotation_passes=args.annotations, use_template=args.template)
+        render_image.build_scene(config, params, base_state)
+        bpy.context.scene.render.filepath = "../output/images/customclevr_" + split + "_%06d.png" % imgidx
+        bpy.ops.wm.save_as_mainfile(filepath=blend_path)
+
+
+if __name__ == "__main__":
+    if INSIDE_BLENDER:
+        main()
+    else:
+        print("this script is intended to be called by blender - see README.md")
@@ -0,0 +1,106 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# Batched version of config_images.compute_all_relationships: every pairwise relationship of every scene at once,
+# as an n_images x n_relationships x n_objects x n_objects tensor of dot products, plus a compact bitmask encoding.
+# Run this file directly to recompute the relationships in ../output/*_scenes.json, e.g. for a different eps.
+from __future__ import print_function
+import argparse
+import json
+
+import numpy as np
+
+
+RELATIONSHIP_NAMES = ["behind", "front", "left", "right"] # the directions relationships are computed for, in scene_struct["directions"] order
+CHUNK_SIZE = 65536 # scenes per relationship_dots call, to bound memory
+EPS = 0.2 # object j has relationship rel with object i if (coords_j - coords_i) . direction_rel > EPS
+
+
+def scenes_to_arrays(scenes:list):
+    """
+    pulls what relationships depend on out of a list of scene structs
+    returns (coords, dirs): n_images x n_objects x 3 object 3d_coords, n_images x n_relationships x 3 direction vectors
+    """
+    coords = np.array([[obj["3d_coords"] for obj in scene["objects"]] for scene in scenes], dtype=np.float64)
+    dirs = np.array([[scene["directions"][name] for name in RELATIONSHIP_NAMES] for scene in scenes], dtype=np.float64)
+    return coords, dirs
+
+
+def relationship_dots(coords:np.ndarray, dirs:np.ndarray) -> np.ndarray:
+    """
+    n_images x n_relationships x n_objects x n_objects tensor; [img, rel, i, j] = (coords_j - coords_i) . direction_rel
+    computed in the same order as compute_all_relationships so it thresholds identically
+    """
+    diff = coords[:, None, :, :] - coords[:, :, None, :] # n_images x n_objects(i) x n_objects(j) x 3
+    return (diff[:, None, :, :, 0] * dirs[:, :, None, None, 0] + diff[:, None, :, :, 1] * dirs[:, :, None, None, 1]) + diff[:, None, :, :, 2] * dirs[:, :, None, None, 2]
+
+
+def relationship_masks(dots:np.ndarray, eps:float=EPS) -> np.ndarray:
+    """thresholds relationship_dots(); [img, rel, i, j] is True if object j has relationship rel with object i (never for i == j)"""
+    masks = dots > eps
+    k = masks.shape[-1]
+    masks[..., np.arange(k), np.arange(k)] = False
+    return masks
+
+
+def to_lists(masks:np.ndarray) -> list:
+    """per-scene dicts in the compute_all_relationships format: output[rel][i] is the sorted list of objects j with relationship rel with object i"""
+    return [{name:[np.nonzero(row)[0].tolist() for row in masks[imgidx, relidx]] for relidx, name in enumerate(RELATIONSHIP_NAMES)} for imgidx in range(masks.shape[0])]
+
+
+def to_bits(masks:np.ndarray) -> np.ndarray:
+    """n_images x n_relationships x n_objects uint64; bit j of [img, rel, i] is set if object j has relationship rel with object i"""
+    k = masks.shape[-1]
+    assert k <= 64
+    return (masks.astype(np.uint64) << np.arange(k, dtype=np.uint64)).sum(axis=-1, dtype=np.uint64)
+
+
+def from_bits(bits:np.ndarray, n_objects:int) -> np.ndarray:
+    """inverse of to_bits"""
+    return ((bits[..., None] >> np.arange(n_objects, dtype=np.uint64)) & np.uint64(1)).astype(bool)
+
+
+def bits_to_dicts(bits:np.ndarray) -> list:
+    """per-scene dicts of the compact encoding: output[rel][i] is an int whose bit j is set if object j has relationship rel with object i"""
+    return [{name:bits[imgidx, relidx].tolist() for relidx, name in enumerate(RELATIONSHIP_NAMES)} for imgidx in range(bits.shape[0])]
+
+
+def add_relationships(scenes:list, eps:float=EPS, lists:bool=True, bits:bool=False):
+    """
+    (re)computes scene["relationships"] (the list format) and/or scene["relationship_bits"] (the compact format) for every scene
+    modifies scenes
+    """
+    for start in range(0, len(scenes), CHUNK_SIZE):
+        chunk = scenes[start:start + CHUNK_SIZE]
+        coords, dirs = scenes_to_arrays(chunk)
+        masks = relationship_masks(relationship_dots(coords, dirs), eps)
+        if lists:
+            for scene, rels in zip(chunk, to_lists(masks)):
+                scene["relationships"] = rels
+        if bits:
+            for scene, rels in zip(chunk, bits_to_dicts(to_bits(masks))):
+                scene["relationship_bits"] = rels
+
+
+def main():
+    parser = argparse.ArgumentParser(description="recompute the relationships in ../output/customclevr_<split>_scenes.json")
+    parser.add_argument("--splits", type=str, nargs="+", default=["trnsimple", "tstsimple"], help="which splits")
+    parser.add_argument("--eps", type=float, default=EPS, help="minimum dot product for a relationship")
+    parser.add_argument("--bits", action="store_true", help="also write the compact relationship_bits encoding")
+    parser.add_argument("--no_lists", action="store_true", help="drop the list format (only with --bits)")
+    args = parser.parse_args()
+    assert args.bits or not args.no_lists
+
+    for split in args.splits:
+        path = "../output/customclevr_" + split + "_scenes.json"
+        with open(path, "r") as f:
+            scenes = json.load(f)["scenes"]
+        add_relationships(scenes, args.eps, not args.no_lists, args.bits)
+        if args.no_lists:
+            for scene in scenes:
+                scene.pop("relationships", None)
+        with open(path, "w") as f:
+            json.dump({"scenes": scenes}, f)
+        print("recomputed relationships of " + str(len(scenes)) + " " + split + " scenes (eps " + str(args.eps) + ")")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Finds the render tile size, Cycles threads per blender process and number of concurrent blender processes with the
+# highest throughput on this host, by rendering a small calibration set with every combination (see render_parallel.py).
+# The best combination per render profile goes to host_profiles/<hostname>.json, which render_parallel.py and
+# render_image.py then use by default (see render_settings.read_host_profile).
+# Throughput is measured in steady state from the workers' timing logs (see timing.py): blender startup, loading the base
+# scene and each process's first image (shape loading, cold caches) are left out, as they are amortized over long runs.
+# Needs numpy (no bpy): it runs blender through render_parallel.py.
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+import numpy as np
+
+import render_parallel
+import render_settings
+import timing_report
+from render_image import parse_jobs
+
+
+TILES = [16, 32, 64, 128, 256, 512]
+IMAGES_PER_PROC = 3 # the first image of every process is not counted, so at least 2
+
+
+def powers_of_two(n:int) -> list:
+    """1, 2, 4, ... up to n, and n itself"""
+    values = [1 << i for i in range(n.bit_length()) if (1 << i) <= n]
+    return values + ([n] if values[-1] != n else [])
+
+
+def steady_throughput(events:list) -> float:
+    """images per second of all processes together, from each process's mean time per image after its first one"""
+    per_process = {}
+    for e in events:
+        if e["stage"] == "image":
+            per_process.setdefault(e["pid"], []).append((e["start"], e["seconds"]))
+    rates = []
+    for images in per_process.values():
+        seconds = [s for _, s in sorted(images)[1:]]
+        if len(seconds) > 0:
+            rates.append(1.0 / np.mean(seconds))
+    return float(np.sum(rates)) if len(rates) > 0 else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="find the tile size, threads and processes that render fastest on this host (see README.md)")
+    parser.add_argument("--jobs", type=str, nargs="+", default=["trnsimple:0-99"], help="calibration images as split:indices; every combination renders the first n_procs x --images_per_proc of them")
+    parser.add_argument("--profile", type=str, default=render_settings.DEFAULT_PROFILE, choices=sorted(render_settings.PROFILES.keys()), help="render profile to tune for")
+    parser.add_argument("--tiles", type=int, nargs="+", default=TILES, help="tile sizes to try")
+    parser.add_argument("--threads", type=int, nargs="+", default=None, help="Cycles threads per process to try (default 1, 2, 4, ... up to the number of cores)")
+    parser.add_argument("--n_procs", type=int, nargs="+", default=None, help="numbers of concurrent processes to try (default 1, 2, 4, ... up to the number of cores)")
+    parser.add_argument("--images_per_proc", type=int, default=IMAGES_PER_PROC, help="images each process renders per combination")
+    parser.add_argument("--blender", type=str, default=render_parallel.DEFAULT_BLENDER, help="path to the blender executable")
+    parser.add_argument("--dry_run", action="store_true", help="only list the combinations that would be tried")
+    args = parser.parse_args()
+
+    n_cores = os.cpu_count()
+    thread_counts = args.threads if args.threads is not None else powers_of_two(n_cores)
+    proc_counts = args.n_procs if args.n_procs is not None else powers_of_two(n_cores)
+    # every combination that uses more than half the cores but not more threads than cores, all tile sizes for each
+    grid = [(tile, threads, n_procs) for threads in thread_counts for n_procs in proc_counts if n_cores // 2 < threads * n_procs <= n_cores for tile in args.tiles]
+    jobs = parse_jobs(args.jobs)
+    assert max(n_procs for _, _, n_procs in grid) * args.images_per_proc <= len(jobs), "need at least max(n_procs) x --images_per_proc calibration images"
+    print(str(len(grid)) + " combinations of tile size, threads per process and processes on " + str(n_cores) + " cores")
+    if args.dry_run:
+        for tile, threads, n_procs in grid:
+            print("tile %4d, %3d threads x %3d processes" % (tile, threads, n_procs))
+        return
+
+    workdir = tempfile.mkdtemp(prefix="customclevr_autotune_")
+    results = []
+    for tile, threads, n_procs in grid:
+        outdir = os.path.join(workdir, "images")
+        timing_dir = os.path.join(workdir, "timing")
+        os.makedirs(outdir, exist_ok=True)
+        start = time.time()
+        calibration = jobs[:n_procs * args.images_per_proc]
+        failed = render_parallel.render_parallel(calibration, n_procs, n_procs * threads, args.blender, False,
+                                                 ["--profile", args.profile, "--tile", str(tile)], timing_dir, outdir=outdir, max_attempts=1)
+        elapsed = time.time() - start
+        result = {"tile":tile, "threads":threads, "n_procs":n_procs, "images_per_second":steady_throughput(timing_report.read_events([timing_dir])),
+                  "wall_images_per_second":len(calibration) / elapsed, "failed":len(failed) > 0}
+        results.append(result)
+        print("tile %4d, %3d threads x %3d processes: %.3f images/s (%.3f including startup)%s"
+              % (tile, threads, n_procs, result["images_per_second"], result["wall_images_per_second"], " FAILED" if result["failed"] else ""))
+        shutil.rmtree(outdir)
+        shutil.rmtree(timing_dir)
+    shutil.rmtree(workdir)
+
+    ok = [r for r in results if not r["failed"] and r["images_per_second"] > 0]
+    assert len(ok) > 0, "every combination failed"
+    best = max(ok, key=lambda r: r["images_per_second"])
+    default = [r for r in ok if r["tile"] == render_settings.DEFAULT_TILE and r["threads"] * r["n_procs"] == n_cores and r["n_procs"] == max(1, n_cores // 4)]
+    print("best: tile %d, %d threads x %d processes, %.3f images/s" % (best["tile"], best["threads"], best["n_procs"], best["images_per_second"])
+          + (" (%.2fx the defaults)" % (best["images_per_second"] / default[0]["images_per_second"]) if len(default) > 0 else ""))
+
+    path = render_settings.host_profile_path()
+    host = {"hostname":socket.gethostname(), "n_cores":n_cores, "profiles":{}}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            host = json.load(f)
+        if host["n_cores"] != n_cores:
+            host = {"hostname":socket.gethostname(), "n_cores":n_cores, "profiles":{}} # tuned for different hardware
+    host["profiles"][args.profile] = {"tile":best["tile"], "threads":best["threads"], "n_procs":best["n_procs"], "images_per_second":best["images_per_second"],
+                                      "tuned":time.strftime("%Y-%m-%d %H:%M:%S"), "blender":args.blender, "jobs":args.jobs, "results":results}
+    os.makedirs(render_settings.HOST_PROFILE_DIR, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(host, f, indent=1)
+    print("wrote " + path)
+
+
+if __name__ == "__main__":
+    main()
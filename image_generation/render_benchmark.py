@@ -0,0 +1,118 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Renders a fixed set of images under each render profile (see render_settings.py) and reports seconds per image
+# and PSNR/SSIM against the reference profile, to pick the cheapest profile that still gives good enough stimuli.
+# Needs numpy (no bpy): it runs blender through render_parallel.py.
+from __future__ import print_function
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import pngio
+import render_parallel
+import render_settings
+from render_image import parse_jobs
+
+
+SSIM_WINDOW = 11 # gaussian window of Wang et al. 2004
+SSIM_SIGMA = 1.5
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compare render profiles by time per image and PSNR/SSIM against the reference profile")
+    parser.add_argument("--jobs", type=str, nargs="+", default=["trnsimple:0-9"], help="images to render as split:indices (see render_image.py)")
+    parser.add_argument("--profiles", type=str, nargs="+", default=sorted(render_settings.PROFILES.keys()), choices=sorted(render_settings.PROFILES.keys()), help="profiles to compare")
+    parser.add_argument("--outdir", type=str, default="../output/benchmark", help="renders go to <outdir>/<profile>/")
+    parser.add_argument("--reference_dir", type=str, default=None, help="existing renders with the reference profile (e.g. ../output/images) instead of rendering them again")
+    parser.add_argument("--n_procs", type=int, default=1, help="number of concurrent blender processes per profile")
+    parser.add_argument("--n_cores", type=int, default=0, help="number of cores to spread over the processes (0 = all cores on this machine)")
+    parser.add_argument("--blender", type=str, default=render_parallel.DEFAULT_BLENDER, help="path to the blender executable")
+    parser.add_argument("--skip_render", action="store_true", help="only compare images already in <outdir>")
+    args = parser.parse_args()
+
+    jobs = parse_jobs(args.jobs)
+    n_cores = args.n_cores if args.n_cores > 0 else os.cpu_count()
+    reference_dir = args.reference_dir
+    profiles = list(args.profiles)
+    if reference_dir is None:
+        reference_dir = os.path.join(args.outdir, render_settings.DEFAULT_PROFILE)
+        if render_settings.DEFAULT_PROFILE not in profiles:
+            profiles.append(render_settings.DEFAULT_PROFILE)
+
+    seconds = {}
+    if not args.skip_render:
+        for profile in profiles:
+            profile_dir = os.path.join(args.outdir, profile)
+            os.makedirs(profile_dir, exist_ok=True)
+            start = time.time()
+            failed = render_parallel.render_parallel(jobs, args.n_procs, n_cores, args.blender, False, ["--profile", profile], outdir=profile_dir)
+            assert len(failed) == 0, "rendering with profile " + profile + " failed"
+            seconds[profile] = (time.time() - start) / len(jobs) # includes blender startup, amortised over the jobs
+
+    report = {"jobs":args.jobs, "n_procs":args.n_procs, "n_cores":n_cores, "reference_dir":reference_dir, "profiles":{}}
+    print("%-10s %10s %10s %10s %10s" % ("profile", "s/image", "PSNR (dB)", "SSIM", "min SSIM"))
+    for profile in profiles:
+        psnrs = []
+        ssims = []
+        for split, imgidx in jobs:
+            name = "customclevr_" + split + "_%06d.png" % imgidx
+            test = luminance(pngio.read_png(os.path.join(args.outdir, profile, name)))
+            reference = luminance(pngio.read_png(os.path.join(reference_dir, name)))
+            psnrs.append(psnr(test, reference))
+            ssims.append(ssim(test, reference))
+        report["profiles"][profile] = {"settings":render_settings.profile_settings(profile), "seconds_per_image":seconds.get(profile),
+                                       "psnr":psnrs, "ssim":ssims}
+        print("%-10s %10s %10.2f %10.4f %10.4f" % (profile, "%.2f" % seconds[profile] if profile in seconds else "-",
+                                                   np.mean(np.minimum(psnrs, 100.0)), np.mean(ssims), np.min(ssims)))
+        # ^ identical images have infinite PSNR; cap it so the mean stays readable
+
+    with open(os.path.join(args.outdir, "report.json"), "w") as f:
+        json.dump(report, f, indent=1)
+    print("wrote " + os.path.join(args.outdir, "report.json"))
+
+
+def luminance(img:np.ndarray) -> np.ndarray:
+    """height x width float64 luma (ITU-R BT.601 weights) in [0,1] of a pngio.read_png image; alpha is ignored"""
+    scale = float(np.iinfo(img.dtype).max)
+    img = img.astype(np.float64) / scale
+    if img.shape[2] < 3: # grayscale (+ alpha)
+        return img[:, :, 0]
+    return 0.299 * img[:, :, 0] + 0.587 * img[:, :, 1] + 0.114 * img[:, :, 2]
+
+
+def psnr(test:np.ndarray, reference:np.ndarray) -> float:
+    """peak signal-to-noise ratio in dB of two images in [0,1]"""
+    mse = np.mean((test - reference) ** 2)
+    return float("inf") if mse == 0 else float(10.0 * np.log10(1.0 / mse))
+
+
+def gaussian_filter(img:np.ndarray) -> np.ndarray:
+    """separable gaussian blur (SSIM_WINDOW x SSIM_WINDOW, SSIM_SIGMA) keeping only fully covered pixels ("valid" mode)"""
+    x = np.arange(SSIM_WINDOW) - (SSIM_WINDOW - 1) / 2.0
+    kernel = np.exp(-x**2 / (2 * SSIM_SIGMA**2))
+    kernel /= kernel.sum()
+    h, w = img.shape
+    rows = sum(kernel[i] * img[i:h - SSIM_WINDOW + 1 + i, :] for i in range(SSIM_WINDOW))
+    return sum(kernel[i] * rows[:, i:w - SSIM_WINDOW + 1 + i] for i in range(SSIM_WINDOW))
+
+
+def ssim(test:np.ndarray, reference:np.ndarray) -> float:
+    """mean structural similarity (Wang et al. 2004) of two images in [0,1]"""
+    c1 = SSIM_K1 ** 2
+    c2 = SSIM_K2 ** 2
+    mu_x = gaussian_filter(test)
+    mu_y = gaussian_filter(reference)
+    var_x = gaussian_filter(test * test) - mu_x * mu_x
+    var_y = gaussian_filter(reference * reference) - mu_y * mu_y
+    cov = gaussian_filter(test * reference) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x**2 + mu_y**2 + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
+
+
+if __name__ == "__main__":
+    main()
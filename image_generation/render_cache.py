@@ -0,0 +1,147 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# Content-addressed render cache: every image is keyed by a hash of exactly what its pixels depend on (the resolved per-image
+# parameters that render_image.build_scene reads, the render profile, and the hashes of the asset files it loads), so
+# render_parallel.py only renders images whose key has no validated render yet. Changing e.g. one color only changes the keys
+# of images that use that color.
+# ../output/render_cache/manifest.jsonl: one line per validated render (key, split, imgidx, png sha256 and size);
+# ../output/render_cache/images/<key>.png: the renders themselves, copied to the output path on a hit.
+from __future__ import print_function
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import image_records
+import pngio
+import render_settings
+
+
+CACHE_VERSION = 1 # bump when render_image.py changes how a scene is built, to invalidate every key
+CACHE_DIR = "../output/render_cache"
+
+asset_hashes = {} # path -> sha256 of the file, computed once per process
+
+
+def file_sha256(path:str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def asset_sha256(path:str) -> str:
+    if path not in asset_hashes:
+        asset_hashes[path] = file_sha256(path)
+    return asset_hashes[path]
+
+
+def render_inputs(config:dict, params:dict, profile:str) -> dict:
+    """everything the rendered pixels of one image depend on, resolved from the split settings config and the image's record params"""
+    camera = list(config["camera_location"])
+    offsets = {}
+    for name, jitter, offset_key in [("Camera", config["camera_jitter"], "camera_offset"), ("Lamp_Key", config["key_light_jitter"], "key_light_offset"),
+                                     ("Lamp_Fill", config["fill_light_jitter"], "fill_light_offset"), ("Lamp_Back", config["back_light_jitter"], "back_light_offset")]:
+        offsets[name] = list(params[offset_key]) if jitter > 0 else [0.0, 0.0, 0.0] # see render_image.set_view
+    camera = [c + o for c, o in zip(camera, offsets.pop("Camera"))]
+
+    objects = []
+    for objidx in range(config["n_objects"]):
+        shape = params["shape_name"][objidx]
+        material = params["mat_name"][objidx]
+        objects.append({
+            "shape": asset_sha256(os.path.join(config["shape_dir"], shape + ".blend")),
+            "material": [material, asset_sha256(os.path.join(config["material_dir"], material + ".blend"))],
+            "color": config["colors"][params["color_name"][objidx]],
+            "r": params["r"][objidx],
+            "x": params["pos_planex"][objidx],
+            "y": params["pos_planey"][objidx],
+            "theta": params["theta"][objidx],
+        })
+    return {"version":CACHE_VERSION, "base_scene":asset_sha256(config["base_scene_blendfile"]), "render":render_settings.profile_settings(profile),
+            "camera":camera, "lights":offsets, "objects":objects}
+
+
+def image_key(config:dict, params:dict, profile:str) -> str:
+    return hashlib.sha256(json.dumps(render_inputs(config, params, profile), sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def job_keys(jobs:list, profile:str) -> dict:
+    """(split, imgidx) -> key for every job, reading each image's record (see image_records.py)"""
+    headers = {}
+    keys = {}
+    for split, imgidx in jobs:
+        path = image_records.records_path(split)
+        if split not in headers:
+            headers[split] = image_records.read_header(path)
+        keys[(split, imgidx)] = image_key(headers[split], image_records.read_record(path, imgidx), profile)
+    return keys
+
+
+def read_manifest(cache_dir:str=CACHE_DIR) -> dict:
+    """key -> manifest entry of every validated render; a truncated last line (e.g. from a killed driver) is skipped"""
+    entries = {}
+    path = os.path.join(cache_dir, "manifest.jsonl")
+    if not os.path.exists(path):
+        return entries
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry["key"]] = entry
+    return entries
+
+
+def cached_image_path(key:str, cache_dir:str=CACHE_DIR) -> str:
+    return os.path.join(cache_dir, "images", key + ".png")
+
+
+def restore(keys:dict, img_path, cache_dir:str=CACHE_DIR) -> list:
+    """
+    puts the cached render of every job whose key has one at img_path(split, imgidx), skipping files that are already right
+    returns the jobs that still need rendering
+    """
+    manifest = read_manifest(cache_dir)
+    misses = []
+    for job, key in keys.items():
+        cached = cached_image_path(key, cache_dir)
+        if key not in manifest or not os.path.exists(cached) or file_sha256(cached) != manifest[key]["sha256"]:
+            misses.append(job)
+            continue
+        dst = img_path(*job)
+        if os.path.exists(dst) and file_sha256(dst) == manifest[key]["sha256"]:
+            continue
+        copy_file(cached, dst)
+    return misses
+
+
+def record(keys:dict, img_path, since:float, cache_dir:str=CACHE_DIR) -> list:
+    """
+    validates the rendered image of every job, adds the valid ones to the cache and its manifest
+    - since: when rendering started; older files at img_path(split, imgidx) were not rendered with the current key
+    returns the jobs whose image is missing, stale or invalid
+    """
+    os.makedirs(os.path.join(cache_dir, "images"), exist_ok=True)
+    failed = []
+    with open(os.path.join(cache_dir, "manifest.jsonl"), "a") as f:
+        for (split, imgidx), key in keys.items():
+            src = img_path(split, imgidx)
+            if not os.path.exists(src) or os.path.getmtime(src) < since or not pngio.check_png(src, render_settings.RESOLUTION):
+                failed.append((split, imgidx))
+                continue
+            copy_file(src, cached_image_path(key, cache_dir))
+            entry = {"key":key, "split":split, "imgidx":imgidx, "sha256":file_sha256(src), "bytes":os.path.getsize(src), "time":time.time()}
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+    return failed
+
+
+def copy_file(src:str, dst:str):
+    """copies src to dst, replacing dst atomically (not a hard link: blender overwrites images in place when re-rendering)"""
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    tmp = dst + ".tmp%d" % os.getpid()
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
@@ -5,8 +5,21 @@
 # Heavy modifications copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
 # see README.md for instructions on running this script
 from __future__ import print_function
-import json
+import argparse
 import os
+import sys
+import time
+import traceback
+
+import numpy as np
+
+import annotations
+import image_records
+import job_queue
+import pngio
+import render_settings
+import scene_template
+import timing
 
 
 INSIDE_BLENDER = True
@@ -17,8 +30,193 @@ try:
 except ImportError as e:
     INSIDE_BLENDER = False
 
+
+RENDER_ATTEMPTS = 2 # tries of bpy.ops.render.render() per image before the job fails (blender crashes are handled by render_parallel.py)
+PROGRESS_PREFIX = "customclevr_job" # starts the progress lines render_parallel.py watches (see report_progress)
+
     
 def main():
+    args = parse_args()
+    if args.timing_log is not None:
+        timing.open_log(args.timing_log, "render_image")
+    if args.queue is not None:
+        jobs = job_queue.iterate(args.queue, args.lease_seconds) # claimed one at a time until the queue is drained
+        n_jobs = "?"
+    else:
+        if args.jobs is None and args.jobfile is None:
+            jobs = read_legacy_job() # single image via img2render.txt / split.txt (see renderscript.sh history)
+        else:
+            jobs = []
+            if args.jobs is not None:
+                jobs += parse_jobs(args.jobs)
+            if args.jobfile is not None:
+                jobs += read_jobfile(args.jobfile)
+        if len(jobs) == 0:
+            print("no images to render")
+            return
+        n_jobs = str(len(jobs))
+
+    # read each split's settings once; each image's own fields are then read from the split's indexed records,
+    # so the cost per job does not depend on how many images the split has
+    configs = {}
+    base_state = None
+    pool = None
+    assembled = None # (split, layout index, object names) of a layout whose objects are left in the scene for its next view
+
+    n_failed = 0
+    for jobidx, (split, img2render) in enumerate(jobs):
+        report_progress("start", split, img2render)
+        if args.queue is not None:
+            # keep the lease while the job runs, however long the render takes
+            active_heartbeat["heartbeat"] = job_queue.start_heartbeat(args.queue, split, img2render, args.lease_seconds)
+        img_path = image_file_path(args.outdir, split, img2render)
+        try:
+            if split not in configs:
+                configs[split] = image_records.read_header(image_records.records_path(split))
+            config = configs[split]
+            if base_state is None:
+                # load the base scene and materials once for the whole batch
+                base_state = setup_scene(config, args.threads, args.profile, args.annotations, args.tile, not args.no_template)
+                if args.queue is not None and hasattr(bpy.app.handlers, "render_stats"):
+                    bpy.app.handlers.render_stats.append(renew_lease) # after setup_scene: opening a file clears the handlers
+                if args.incremental:
+                    pool = {}
+            image_start = time.time()
+            with timing.stage("read_record", split=split, imgidx=img2render):
+                params = image_records.read_record(image_records.records_path(split), img2render)
+            blend_path = blend_file_path(config["split"], img2render) if args.save_blend else None
+            print("rendering " + config["split"] + " image " + str(img2render) + " of " + str(config["n_images"]) + " (job " + str(jobidx + 1) + " of " + n_jobs + ")...")
+            # several views per layout: the objects are built for the first view of a layout that is rendered and kept for
+            # the views that follow it, which only move the camera and lamps
+            n_views = image_records.views_per_layout(config)
+            layout = (split, img2render // n_views)
+            if assembled is not None and assembled[:2] != layout:
+                if pool is None:
+                    with timing.stage("reset_scene", split=split, imgidx=img2render):
+                        reset_scene(base_state)
+                assembled = None
+            # let Cycles keep the BVH and shaders between renders that reuse the scene: the objects of an --incremental pool, or
+            # the views of a layout; set for every job, so a split after one with several views does not keep them
+            bpy.context.scene.render.use_persistent_data = pool is not None or n_views > 1
+            objnames = render_scene(config, params, img_path, blend_path, base_state, pool, args.annotations,
+                                    assembled[2] if assembled is not None else None, n_views > 1)
+            if n_views > 1:
+                assembled = layout + (objnames,)
+            elif pool is None:
+                with timing.stage("reset_scene", split=split, imgidx=img2render):
+                    reset_scene(base_state)
+            timing.event("image", image_start, time.time() - image_start, split=split, imgidx=img2render, peak_rss_mb=timing.peak_rss_mb())
+            ok = output_complete(img_path, args.annotations)
+        except Exception:
+            traceback.print_exc() # one bad image must not take down the rest of the batch
+            ok = False
+            assembled = None
+            if base_state is not None:
+                reset_scene(base_state) # remove whatever the failed job added (including reusable objects)
+                if pool is not None:
+                    pool.clear()
+        report_progress("done" if ok else "failed", split, img2render)
+        if args.queue is not None:
+            heartbeat = active_heartbeat.pop("heartbeat")
+            job_queue.stop_heartbeat(heartbeat)
+            if ok:
+                job_queue.complete(args.queue, split, img2render) # leaves the lease alone if another worker has it now
+            elif heartbeat["lost"]:
+                print("lost the lease on " + split + " image " + str(img2render) + "; not releasing it") # reclaimed, maybe leased again
+            else:
+                job_queue.release(args.queue, split, img2render) # retried later, up to job_queue.MAX_ATTEMPTS claims
+        n_failed += 0 if ok else 1
+    timing.close_log()
+    if n_failed > 0:
+        print(str(n_failed) + " images failed to render")
+        sys.exit(1)
+
+
+active_heartbeat = {} # with --queue: "heartbeat" of the job being rendered (see job_queue.start_heartbeat)
+
+
+def renew_lease(*args):
+    """render_stats handler: renews the job's lease from the render's progress updates too, in case the render keeps the heartbeat thread from running"""
+    if "heartbeat" in active_heartbeat:
+        job_queue.beat(active_heartbeat["heartbeat"])
+
+
+def report_progress(status:str, split:str, imgidx:int):
+    """
+    prints a line like "customclevr_job start trnsimple 5" (status start, done or failed) and flushes it right away, so the
+    process running this one (render_parallel.py) knows which job it is on, e.g. to kill it if the job hangs
+    """
+    print(PROGRESS_PREFIX + " " + status + " " + split + " " + str(imgidx), flush=True)
+
+
+def output_complete(img_path:str, annotation_passes:bool=False) -> bool:
+    """whether an image (and, with annotation_passes, its annotations) was written completely"""
+    return pngio.check_png(img_path, render_settings.RESOLUTION) and (not annotation_passes or os.path.exists(annotations.annotations_path(img_path)))
+
+
+def parse_args(argv=None):
+    """
+    Blender passes everything after "--" on its own command line through to the script, e.g.
+    blender --background --python render_image.py -- --jobs trnsimple:0-99 tstsimple:0-99
+    """
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(description="render customclevr images (see README.md)")
+    parser.add_argument("--jobs", type=str, nargs="+", default=None, help="images to render as split:indices, e.g. trnsimple:0-99 or tstsimple:0,5,10-19 (ranges are inclusive-inclusive)")
+    parser.add_argument("--jobfile", type=str, default=None, help="file with one \"split imgidx\" job per line")
+    parser.add_argument("--queue", type=str, default=None, help="pull jobs from this shared job queue until it is drained (see job_queue.py) instead of --jobs/--jobfile")
+    parser.add_argument("--lease_seconds", type=float, default=job_queue.LEASE_SECONDS, help="with --queue: how long a claimed job stays leased to this process")
+    parser.add_argument("--incremental", action="store_true", help="reuse objects between images, only updating transforms and materials, and keep Cycles render data between renders")
+    parser.add_argument("--profile", type=str, default=render_settings.DEFAULT_PROFILE, choices=sorted(render_settings.PROFILES.keys()), help="render quality profile (see render_settings.py)")
+    parser.add_argument("--outdir", type=str, default="../output/images", help="where to write the rendered images")
+    parser.add_argument("--annotations", action="store_true", help="also write each image's instance mask, depth map and per-object pixel counts and bounding boxes (see annotations.py)")
+    parser.add_argument("--save_blend", action="store_true", help="also save each image's scene to ../output/blendfiles (rebuild_blend.py can make them later instead)")
+    parser.add_argument("--timing_log", type=str, default=None, help="append per-stage timings to this jsonl file (see timing.py)")
+    parser.add_argument("--threads", type=int, default=0, help="number of Cycles render threads (0 = let blender use all cores)")
+    parser.add_argument("--tile", type=int, default=0, help="render tile size (0 = the one render_autotune.py found fastest on this host, or " + str(render_settings.DEFAULT_TILE) + ")")
+    parser.add_argument("--no_template", action="store_true", help="load the base scene and every asset file even if scene_template.py has prepared a template")
+    args = parser.parse_args(argv)
+    if args.tile == 0:
+        host = render_settings.read_host_profile(args.profile)
+        args.tile = host["tile"] if host is not None else render_settings.DEFAULT_TILE
+    return args
+
+
+def image_file_path(outdir:str, split:str, imgidx:int) -> str:
+    return os.path.join(outdir, "customclevr_" + split + "_%06d.png" % imgidx)
+
+
+def blend_file_path(split:str, imgidx:int) -> str:
+    return "../output/blendfiles/customclevr_" + split + "_%06d.blend" % imgidx
+
+
+def parse_jobs(specs) -> list:
+    """converts e.g. ["trnsimple:0-2", "tstsimple:7"] to [("trnsimple",0), ("trnsimple",1), ("trnsimple",2), ("tstsimple",7)]"""
+    jobs = []
+    for spec in specs:
+        split, indices = spec.split(":")
+        for part in indices.split(","):
+            if "-" in part:
+                first, last = part.split("-")
+                jobs += [(split, i) for i in range(int(first), int(last) + 1)] # inclusive-inclusive
+            else:
+                jobs.append((split, int(part)))
+    return jobs
+
+
+def read_jobfile(path:str) -> list:
+    jobs = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            split, imgidx = line.split()
+            jobs.append((split, int(imgidx)))
+    return jobs
+
+
+def read_legacy_job() -> list:
     assert os.path.exists("img2render.txt")
     with open("img2render.txt", "r") as f:
         img2render = int(f.read().strip())
@@ -26,88 +224,222 @@ def main():
     assert os.path.exists("split.txt")
     with open("split.txt", "r") as f:
         split = f.read().strip()
+    return [(split, img2render)]
 
-    with open("../output/customclevr_" + split + "_config.json", "r") as f:
-        config = json.load(f)
 
-    # set render arguments so we can get pixel coordinates later
-    bpy.ops.wm.open_mainfile(filepath=config["base_scene_blendfile"]) # load the main blendfile
-    load_materials(config["material_dir"]) # load materials
+def setup_scene(config:dict, threads:int=0, profile:str=render_settings.DEFAULT_PROFILE, annotation_passes:bool=False, tile:int=render_settings.DEFAULT_TILE,
+                use_template:bool=True) -> dict:
+    """
+    load the base blendfile and materials and set render arguments (see render_settings.py)
+    annotation_passes: also render the object index and depth passes (see setup_annotation_passes)
+    use_template: if scene_template.py has prepared a template with all of this, open just that instead
+    returns the pristine state of everything render_scene modifies in place, for reset_scene()
+    """
+    template = scene_template.find_template(config, profile, annotation_passes) if use_template else None
+    shape_templates.clear() # cached datablocks belonged to the previously open file
+    shape_counts.clear()
+    material_cache.clear()
+    if template is not None:
+        # shapes and node groups are already in the file (load_shape finds the shapes there), and so are the render settings
+        with timing.stage("open_template"):
+            bpy.ops.wm.open_mainfile(filepath=template, load_ui=False)
+        render_settings.apply_throughput_settings(bpy.context.scene, threads, tile)
+    else:
+        with timing.stage("open_mainfile"):
+            bpy.ops.wm.open_mainfile(filepath=config["base_scene_blendfile"]) # load the main blendfile
+        with timing.stage("load_materials"):
+            load_materials(config["material_dir"]) # load materials
+        render_settings.apply_render_settings(bpy.context.scene, bpy.data.worlds["World"], bpy.context.view_layer, profile, threads, tile)
+        if annotation_passes:
+            setup_annotation_passes(bpy.context.scene, bpy.context.view_layer)
+
+    base_state = {}
+    base_state["locations"] = {name:tuple(bpy.data.objects[name].location) for name in ["Camera", "Lamp_Key", "Lamp_Fill", "Lamp_Back"]}
+    base_state["objects"]   = set(o.name for o in bpy.data.objects)
+    base_state["meshes"]    = set(m.name for m in bpy.data.meshes)
+    base_state["materials"] = set(m.name for m in bpy.data.materials)
+    return base_state
+
+
+def setup_annotation_passes(scene, view_layer):
+    """
+    enables the object index and depth passes and sends them through the compositor to the viewer image (object index in
+    the red channel, depth in the green channel), where read_annotation_passes() finds them after each render.
+    The composite output (the saved image) stays the unmodified render.
+    """
+    view_layer.use_pass_object_index = True
+    view_layer.use_pass_z = True
+    scene.use_nodes = True
+    scene.render.use_compositing = True
+    tree = scene.node_tree
+    for node in list(tree.nodes):
+        tree.nodes.remove(node)
+    layers = tree.nodes.new("CompositorNodeRLayers")
+    composite = tree.nodes.new("CompositorNodeComposite")
+    combine = tree.nodes.new("CompositorNodeCombRGBA")
+    viewer = tree.nodes.new("CompositorNodeViewer")
+    viewer.use_alpha = False
+    tree.links.new(layers.outputs["Image"], composite.inputs["Image"])
+    tree.links.new(layers.outputs["IndexOB"], combine.inputs["R"])
+    tree.links.new(layers.outputs["Depth"], combine.inputs["G"])
+    tree.links.new(combine.outputs["Image"], viewer.inputs["Image"])
+
+
+def read_annotation_passes():
+    """the object index and depth passes of the last render as height x width arrays, top row first"""
+    viewer = bpy.data.images["Viewer Node"]
+    w, h = viewer.size
+    pixels = np.empty(w * h * 4, dtype=np.float32)
+    viewer.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(h, w, 4)[::-1] # blender images start at the bottom row
+    return pixels[:, :, 0], pixels[:, :, 1]
+
+
+def reset_scene(base_state:dict):
+    """undo everything render_scene did, so the next image starts from the freshly loaded base scene"""
+    for name,location in base_state["locations"].items():
+        bpy.data.objects[name].location = location
+    keep_objects = base_state["objects"] | set(template.name for template in shape_templates.values())
+    for obj in [o for o in bpy.data.objects if o.name not in keep_objects]:
+        bpy.data.objects.remove(obj, do_unlink=True)
+    # cached shape meshes and materials are kept for the next image
+    keep_meshes = base_state["meshes"] | set(template.data.name for template in shape_templates.values())
+    keep_materials = base_state["materials"] | set(mat.name for mat in material_cache.values())
+    for mesh in [m for m in bpy.data.meshes if m.name not in keep_meshes]:
+        bpy.data.meshes.remove(mesh, do_unlink=True)
+    for mat in [m for m in bpy.data.materials if m.name not in keep_materials]:
+        bpy.data.materials.remove(mat, do_unlink=True)
+
+
+def render_scene(config:dict, params:dict, img_path:str, blend_path:str, base_state:dict, pool:dict=None, annotation_passes:bool=False,
+                 objnames:list=None, keep_objects:bool=False) -> list:
+    """
+    - config: the split-wide settings
+    - params: the per-image fields of the image to render (see image_records.py)
+    - blend_path: where to save the scene as a .blend file, or None to not save it
+    - base_state: from setup_scene()
+    - pool: object slots reused between images (see update_pool), or None to add fresh objects and remove them afterwards
+    - annotation_passes: also write the image's annotations (see annotations.py); setup_scene() must have enabled the passes
+    - objnames: the objects of this image's layout if they are already in the scene (rendered for another of its views);
+      then only the camera and lamps are moved
+    - keep_objects: leave the objects in the scene (for the next view of the layout) even if pool is None
+    returns the names of the image's objects
+    """
+    image = {"split":config["split"], "imgidx":params["imgidx"]} # for the timing log
+    if objnames is not None:
+        with timing.stage("set_view", **image):
+            set_view(config, params, base_state)
+    else:
+        with timing.stage("build_scene", **image):
+            objnames = build_scene(config, params, base_state, pool)
+
+    # render the scene
     render_args = bpy.context.scene.render
-    render_args.engine = "CYCLES" # we use functionality specific to the CYCLES renderer so BLENDER_RENDER cannot be used
-    render_args.resolution_x = 320 # the width (in pixels) for the rendered images
-    render_args.resolution_y = 240 # the height (in pixels) for the rendered images
-    render_args.resolution_percentage = 100
-    render_args.tile_x = 512 # the tile size to use for rendering
-    render_args.tile_y = 512 # the tile size to use for rendering
-    # ^ render tile size should not affect the quality of the rendered image but may affect the speed;
-    # CPU-based rendering may achieve better performance using smaller tile sizes,
-    # while larger tile sizes may be optimal for GPU-based rendering.
-    bpy.data.worlds["World"].cycles.sample_as_light  = True
-    bpy.context.scene.cycles.blur_glossy             = 2.0
-    bpy.context.scene.cycles.samples                 = 512 # the number of samples to use when rendering. Larger values will result in nicer images but will cause rendering to take longer.
-    bpy.context.scene.cycles.transparent_min_bounces = 8 # the minimum number of bounces to use for rendering
-    bpy.context.scene.cycles.transparent_max_bounces = 8 # the maximum number of bounces to use for rendering
-    # for GPU (doesn't work rn)
-    # bpy.context.scene.cycles.device = "GPU"
-    # cycles_prefs = bpy.context.user_preferences.addons["cycles"].preferences
-    # cycles_prefs.compute_device_type = "CUDA"
-    
-    # render
-    img_path   = "../output/images/customclevr_" + config["split"] + "_%06d.png" % img2render
-    blend_path = "../output/blendfiles/customclevr_" + config["split"] + "_%06d.blend" % img2render
-    print("rendering " + config["split"] + " image " + str(img2render) + " of " + str(config["n_images"]) + "...")
-    render_scene(config, img2render, img_path, blend_path)
-
-
-def render_scene(config:dict, imgidx:int, img_path:str, blend_path:str):
-    # set camera position
-    bpy.data.objects["Camera"].location[0] = config["camera_location"][0]
-    bpy.data.objects["Camera"].location[1] = config["camera_location"][1]
-    bpy.data.objects["Camera"].location[2] = config["camera_location"][2]
-    if config["camera_jitter"] > 0:
-        for i in range(3):
-            bpy.data.objects["Camera"].location[i] += config["camera_offset"][imgidx][i]
+    render_args.filepath = img_path
+    for attempt in range(RENDER_ATTEMPTS):
+        try:
+            with timing.stage("render", **image):
+                bpy.ops.render.render()
+            break
+        except Exception as e:
+            print(e)
+            if attempt == RENDER_ATTEMPTS - 1:
+                raise
+    with timing.stage("write_png", **image):
+        bpy.data.images["Render Result"].save_render(filepath=img_path) # what write_still=True does, timed separately
+    if annotation_passes:
+        with timing.stage("annotations", **image):
+            index, depth = read_annotation_passes()
+            annotations.write_annotations(img_path, config["split"], params["imgidx"], index, depth, config["n_objects"])
+    if blend_path is not None:
+        with timing.stage("save_blend", **image):
+            bpy.ops.wm.save_as_mainfile(filepath=blend_path)
+
+    if pool is None and not keep_objects:
+        # remove objects
+        with timing.stage("remove_objects", **image):
+            for name in objnames:
+                objs = bpy.data.objects
+                objs.remove(objs[name], do_unlink=True) # delete object based on name
+    return objnames
+
+
+def set_view(config:dict, params:dict, base_state:dict):
+    """
+    sets the camera position and adds random jitter to the lamp positions of one image
+    (absolute positions, so it doesn't matter what was rendered before)
+    """
+    for name, jitter, offset_key in [("Camera", config["camera_jitter"], "camera_offset"), ("Lamp_Key", config["key_light_jitter"], "key_light_offset"),
+                                     ("Lamp_Fill", config["fill_light_jitter"], "fill_light_offset"), ("Lamp_Back", config["back_light_jitter"], "back_light_offset")]:
+        location = list(config["camera_location"]) if name == "Camera" else list(base_state["locations"][name])
+        if jitter > 0:
+            for i in range(3):
+                location[i] += params[offset_key][i]
+        bpy.data.objects[name].location = location
+
+
+def build_scene(config:dict, params:dict, base_state:dict, pool:dict=None) -> list:
+    """sets up the scene of one image (see render_scene); returns the names of its objects"""
+    set_view(config, params, base_state)
 
     # prepare to add objects
     color_name_to_rgba = {}
     for name,rgb in config["colors"].items():
         color_name_to_rgba[name] = [float(c) / 255.0 for c in rgb] + [1.0]
     
+    if pool is not None:
+        return update_pool(pool, config, params, color_name_to_rgba)
+
     # add objects to the current blender scene
     objnames = [[]]*config["n_objects"]
     for objidx in range(config["n_objects"]):
-        x = config["pos_planex"][imgidx][objidx]
-        y = config["pos_planey"][imgidx][objidx]
-        objnames[objidx] = add_object(config["shape_dir"], config["shape_name"][imgidx][objidx], config["r"][imgidx][objidx], x, y, config["theta"][imgidx][objidx])
-
-        rgba = color_name_to_rgba[config["color_name"][imgidx][objidx]]
-        add_material(config["mat_name"][imgidx][objidx], Color=rgba)
-
-    # add random jitter to lamp positions
-    for i in range(3):
-        if config["key_light_jitter"] > 0:
-            bpy.data.objects["Lamp_Key"].location[i] += config["key_light_offset"][imgidx][i]
-        if config["fill_light_jitter"] > 0:
-            bpy.data.objects["Lamp_Fill"].location[i] += config["fill_light_offset"][imgidx][i]
-        if config["back_light_jitter"] > 0:
-            bpy.data.objects["Lamp_Back"].location[i] += config["back_light_offset"][imgidx][i]
+        x = params["pos_planex"][objidx]
+        y = params["pos_planey"][objidx]
+        with timing.stage("add_object", split=config["split"], imgidx=params["imgidx"], objidx=objidx, shape=params["shape_name"][objidx]):
+            objnames[objidx] = add_object(config["shape_dir"], params["shape_name"][objidx], params["r"][objidx], x, y, params["theta"][objidx])
+            bpy.data.objects[objnames[objidx]].pass_index = objidx + 1 # its value in the object index pass (see annotations.py)
 
-    # render the scene
-    render_args = bpy.context.scene.render
-    render_args.filepath = img_path
-    while True:
-        try:
-            bpy.ops.render.render(write_still=True)
-            break
-        except Exception as e:
-            print(e)
-    bpy.ops.wm.save_as_mainfile(filepath=blend_path)
+        rgba = color_name_to_rgba[params["color_name"][objidx]]
+        with timing.stage("add_material", split=config["split"], imgidx=params["imgidx"], objidx=objidx, material=params["mat_name"][objidx]):
+            add_material(params["mat_name"][objidx], Color=rgba)
+    return objnames
 
-    # remove objects
-    for name in objnames:
-        objs = bpy.data.objects
-        objs.remove(objs[name], do_unlink=True) # delete object based on name
+
+def update_pool(pool:dict, config:dict, params:dict, color_name_to_rgba:dict) -> list:
+    """
+    incremental alternative to adding and removing objects for every image:
+    pool maps shape name -> names of objects ("slots") of that shape made for earlier images. Slots are reused by only
+    changing their transform and material, new slots are only made when an image needs more objects of a shape than
+    any before it, and leftover slots are hidden from the render. modifies pool
+    returns the names of the objects of this image
+    """
+    objnames = [[]]*config["n_objects"]
+    n_used = {}
+    for objidx in range(config["n_objects"]):
+        shape = params["shape_name"][objidx]
+        slots = pool.setdefault(shape, [])
+        slotidx = n_used.get(shape, 0)
+        n_used[shape] = slotidx + 1
+        if slotidx == len(slots):
+            slots.append(add_object(config["shape_dir"], shape, 1.0, 0.0, 0.0, 0.0))
+        obj = bpy.data.objects[slots[slotidx]]
+        obj.hide_render = False
+        obj.pass_index = objidx + 1
+        set_transform(obj, shape_templates[shape], params["r"][objidx], params["pos_planex"][objidx], params["pos_planey"][objidx], params["theta"][objidx])
+        obj.material_slots[0].link = "OBJECT"
+        obj.material_slots[0].material = get_material(params["mat_name"][objidx], Color=color_name_to_rgba[params["color_name"][objidx]])
+        objnames[objidx] = obj.name
+    for shape, slots in pool.items():
+        for name in slots[n_used.get(shape, 0):]:
+            bpy.data.objects[name].hide_render = True
+    return objnames
+
+
+# session-level asset cache: every shape and material .blend file is read once per blender process,
+# and objects/materials are then made from the cached datablocks without operators or file appends
+shape_templates = {} # shape name -> template object loaded from object_dir (not linked to the scene)
+shape_counts = {} # shape name -> number of objects made from it so far, for unique object names
+material_cache = {} # (material name, rgba) -> material
 
 
 def add_object(object_dir, name, scale, x, y, theta) -> str:
@@ -115,35 +447,52 @@ def add_object(object_dir, name, scale, x, y, theta) -> str:
     Load an object from a file. We assume that in the directory object_dir, there
     is a file named "$name.blend" which contains a single object named "$name"
     that has unit size and is centered at the origin.
+    The file is only read the first time; after that the new object shares the mesh of the cached template (like a linked duplicate).
 
     - scale: scalar giving the size that the object should be in the scene
     - x,y: the coordinates on the ground plane where the object should be placed
     """
-    # first figure out how many of this object are already in the scene so we can give the new object a unique name
-    count = 0
-    for obj in bpy.data.objects:
-        if obj.name.startswith(name):
-            count += 1
-
-    filename = os.path.join(object_dir, name + ".blend", "Object", name)
-    bpy.ops.wm.append(filename=filename)
+    template = load_shape(object_dir, name)
 
     # give it a new name to avoid conflicts
+    count = shape_counts.get(name, 0)
+    shape_counts[name] = count + 1
     new_name = "%s_%d" % (name, count)
-    bpy.data.objects[name].name = new_name
+    obj = bpy.data.objects.new(new_name, template.data)
+    bpy.context.collection.objects.link(obj)
 
     # set the new object as active, then rotate, scale, and translate it
-    bpy.context.view_layer.objects.active = bpy.data.objects[new_name]
-    # or (https://github.com/IBM/photorealistic-blocksworld/commit/3908f36d117cfb2b5cc4a0c50e7267ef576376bc):
-    # o.select_set(state=True, view_layer=bpy.context.view_layer)
-    # bpy.context.view_layer.objects.active = o
-    bpy.context.object.rotation_euler[2] = theta
-    bpy.ops.transform.resize(value=(scale, scale, scale))
-    bpy.ops.transform.translate(value=(x, y, scale))
-    # bpy.data.collections["collection0"].objects.link(bpy.data.objects[new_name])
+    bpy.context.view_layer.objects.active = obj
+    set_transform(obj, template, scale, x, y, theta)
     return new_name
 
 
+def set_transform(obj, template, scale, x, y, theta):
+    """same result as bpy.ops.transform.resize / translate on a freshly appended copy of template"""
+    obj.rotation_euler = template.rotation_euler
+    obj.rotation_euler[2] = theta
+    obj.scale = template.scale * scale
+    obj.location = template.location + Vector((x, y, scale))
+
+
+def load_shape(object_dir, name):
+    """the cached template object for shape name, loading it from object_dir the first time (unless a prepared template has it)"""
+    if name not in shape_templates:
+        preloaded = bpy.data.objects.get(name)
+        if preloaded is not None and preloaded.use_fake_user and len(preloaded.users_collection) == 0:
+            shape_templates[name] = preloaded # see scene_template.prepare
+            return preloaded
+        with bpy.data.libraries.load(os.path.join(object_dir, name + ".blend"), link=False) as (data_from, data_to):
+            data_to.objects = [name]
+        template = data_to.objects[0]
+        template.use_fake_user = True
+        # every object made from this template shares its mesh, so materials go in a per-object slot instead of on the mesh
+        assert len(template.data.materials) == 0
+        template.data.materials.append(None)
+        shape_templates[name] = template
+    return shape_templates[name]
+
+
 def load_materials(material_dir):
     """
     Load materials from a directory. We assume that the directory contains .blend
@@ -154,35 +503,41 @@ def load_materials(material_dir):
         if not fn.endswith(".blend"):
             continue
         name = os.path.splitext(fn)[0]
-        filepath = os.path.join(material_dir, fn, "NodeTree", name)
-        bpy.ops.wm.append(filename=filepath)
+        if name in bpy.data.node_groups:
+            continue # already loaded in this session
+        with bpy.data.libraries.load(os.path.join(material_dir, fn), link=False) as (data_from, data_to):
+            data_to.node_groups = [name]
 
 
 def add_material(name, **properties):
     """
-    Create a new material and assign it to the active object. "name" should be the
+    Assign a material to the active object. "name" should be the
     name of a material that has been previously loaded using load_materials.
+    Objects with the same material name and properties share one material, made the first time it is needed.
     """
-    assert type(name) is str
+    # attach the material to the active object
+    obj = bpy.context.active_object
+    slot = obj.material_slots[0]
+    slot.link = "OBJECT" # the mesh is shared with other objects of the same shape
+    assert slot.material is None # make sure it doesn't already have materials
+    slot.material = get_material(name, **properties)
 
-    # figure out how many materials are already in the scene
-    mat_count = len(bpy.data.materials)
 
-    # create a new material; it is not attached to anything and it will be called "Material"
-    bpy.ops.material.new()
+def get_material(name, **properties):
+    """the cached material for node group name with the given properties, made the first time it is needed"""
+    assert type(name) is str
+    key = (name, tuple(sorted((k, tuple(v) if isinstance(v, (list, tuple)) else v) for k, v in properties.items())))
+    if key not in material_cache:
+        material_cache[key] = new_material(name, **properties)
+    return material_cache[key]
 
-    # Get a reference to the material we just created and rename it;
-    # then the next time we make a new material it will still be called
-    # "Material" and we will still be able to look it up by name
-    mat = bpy.data.materials["Material"]
-    mat.name = "Material_%d" % mat_count
 
-    # attach the new material to the active object
-    obj = bpy.context.active_object
-    assert len(obj.data.materials) == 0 # make sure it doesn't already have materials
-    obj.data.materials.append(mat)
+def new_material(name, **properties):
+    # create a new material; it is not attached to anything
+    mat = bpy.data.materials.new("Material_%d" % len(bpy.data.materials))
+    mat.use_nodes = True
 
-    # Add a new GroupNode to the node tree of the active material,
+    # Add a new GroupNode to the node tree of the new material,
     # and copy the node tree from the preloaded node group to the new group node.
     # This copying seems to happen by-value, so we can create multiple
     # materials of the same type without them clobbering each other
@@ -204,6 +559,7 @@ def add_material(name, **properties):
 
     # wire the output of the new group node to the input of the MaterialOutput node
     mat.node_tree.links.new(group_node.outputs["Shader"], output_node.inputs["Surface"])
+    return mat
 
 
 if __name__ == "__main__":
@@ -0,0 +1,298 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Spreads (split, imgidx) render jobs over several concurrent blender processes (each running render_image.py in worker mode).
+# Needs numpy (no bpy), so it can be run with any python 3 that has numpy, e.g. the one packed with blender.
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from render_image import PROGRESS_PREFIX, image_file_path, output_complete, parse_jobs
+import annotations
+import image_records
+import job_queue
+import render_cache
+import render_settings
+
+
+DEFAULT_BLENDER = "../blender-2.83.20-linux-x64/blender"
+JOB_TIMEOUT = job_queue.LEASE_SECONDS # seconds a process may spend on one image (or starting up) before it is presumed hung
+MAX_ATTEMPTS = 3 # tries per image
+BACKOFF_SECONDS = 10 # wait before retrying a failed image; doubles with every attempt
+POLL_SECONDS = 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="render customclevr images with several blender processes at once")
+    parser.add_argument("--jobs", type=str, nargs="+", default=None, help="images to render as split:indices, e.g. trnsimple:0-99 tstsimple:0-99 (ranges are inclusive-inclusive)")
+    parser.add_argument("--queue", type=str, default=None, help="instead of --jobs, let every process pull jobs from this shared job queue (see job_queue.py)")
+    parser.add_argument("--n_procs", type=int, default=0, help="number of concurrent blender processes (0 = what render_autotune.py found fastest on this host, or one per 4 cores)")
+    parser.add_argument("--n_cores", type=int, default=0, help="number of cores to spread over the processes (0 = as tuned for this host, or all cores on this machine)")
+    parser.add_argument("--tile", type=int, default=0, help="render tile size (0 = as tuned for this host, or " + str(render_settings.DEFAULT_TILE) + ")")
+    parser.add_argument("--blender", type=str, default=DEFAULT_BLENDER, help="path to the blender executable")
+    parser.add_argument("--profile", type=str, default=render_settings.DEFAULT_PROFILE, choices=sorted(render_settings.PROFILES.keys()), help="render quality profile (see render_settings.py)")
+    parser.add_argument("--outdir", type=str, default="../output/images", help="where to write the rendered images")
+    parser.add_argument("--no_cache", action="store_true", help="render every job, even if the render cache (see render_cache.py) has it")
+    parser.add_argument("--incremental", action="store_true", help="run the workers in incremental mode (see render_image.py)")
+    parser.add_argument("--timing_dir", type=str, default=None, help="write each process's per-stage timings (see timing.py) to a jsonl file in this directory")
+    parser.add_argument("--annotations", action="store_true", help="also write each image's mask, depth map and bounding boxes (see annotations.py)")
+    parser.add_argument("--save_blend", action="store_true", help="also save each image's scene as a .blend file (see render_image.py)")
+    parser.add_argument("--timeout", type=float, default=JOB_TIMEOUT, help="seconds a blender process may spend on one image (or starting up) before it is killed")
+    parser.add_argument("--max_attempts", type=int, default=MAX_ATTEMPTS, help="tries per image before giving up on it")
+    parser.add_argument("--keep_logs", action="store_true", help="keep the per-process job files and logs even if every process succeeds")
+    args = parser.parse_args()
+
+    host = render_settings.read_host_profile(args.profile)
+    if host is not None and args.n_procs == 0 and args.n_cores == 0:
+        print("using this host's tuned settings for profile " + args.profile + " (" + render_settings.host_profile_path() + "): "
+              + str(host["n_procs"]) + " processes x " + str(host["threads"]) + " threads, tile " + str(host["tile"]))
+        args.n_procs = host["n_procs"]
+        args.n_cores = host["n_procs"] * host["threads"]
+    if args.tile == 0:
+        args.tile = host["tile"] if host is not None else render_settings.DEFAULT_TILE
+    n_cores = args.n_cores if args.n_cores > 0 else os.cpu_count()
+    n_procs = args.n_procs if args.n_procs > 0 else max(1, n_cores // 4)
+    assert (args.jobs is None) != (args.queue is None), "pass either --jobs or --queue"
+    jobs = parse_jobs(args.jobs) if args.jobs is not None else []
+    worker_args = ["--profile", args.profile, "--tile", str(args.tile)] + (["--incremental"] if args.incremental else [])
+    if args.save_blend:
+        worker_args.append("--save_blend")
+    if args.annotations:
+        worker_args.append("--annotations")
+    img_path = lambda split, imgidx: image_file_path(args.outdir, split, imgidx)
+
+    supervision = {"outdir":args.outdir, "timeout":args.timeout, "max_attempts":args.max_attempts}
+
+    if args.queue is not None: # e.g. one render_parallel.py per host, all pulling from the same queue
+        if len(render_parallel([], n_procs, n_cores, args.blender, args.keep_logs, worker_args, args.timing_dir, args.queue, **supervision)) > 0:
+            sys.exit(1)
+        return
+    if args.no_cache:
+        if len(render_parallel(jobs, n_procs, n_cores, args.blender, args.keep_logs, worker_args, args.timing_dir, **supervision)) > 0:
+            sys.exit(1)
+        return
+
+    keys = render_cache.job_keys(jobs, args.profile)
+    todo = render_cache.restore(keys, img_path)
+    print(str(len(jobs) - len(todo)) + " of " + str(len(jobs)) + " images are in the render cache")
+    if args.annotations:
+        # the cache only has the images, so cached images without annotations are rendered again to get them
+        missing = [job for job in keys if job not in todo and not os.path.exists(annotations.annotations_path(img_path(*job)))]
+        if len(missing) > 0:
+            print(str(len(missing)) + " of them have no annotations yet and are rendered again")
+            todo += missing
+    if len(todo) == 0:
+        return
+    start = time.time()
+    render_parallel(todo, n_procs, n_cores, args.blender, args.keep_logs, worker_args, args.timing_dir, **supervision)
+    failed = render_cache.record({job:keys[job] for job in todo}, img_path, start)
+    if args.annotations:
+        stale = lambda path: not os.path.exists(path) or os.path.getmtime(path) < start
+        failed += [job for job in todo if job not in failed and stale(annotations.annotations_path(img_path(*job)))]
+    if len(failed) > 0:
+        # every image that was written and is valid is in the cache now, so rerunning renders only these
+        print(str(len(failed)) + " images are missing or invalid: " + " ".join(split + ":" + str(imgidx) for split, imgidx in failed))
+        sys.exit(1)
+
+
+def render_parallel(jobs:list, n_procs:int, n_cores:int, blender:str=DEFAULT_BLENDER, keep_logs:bool=False, worker_args:list=[], timing_dir:str=None,
+                    queue_dir:str=None, outdir:str="../output/images", timeout:float=JOB_TIMEOUT, max_attempts:int=MAX_ATTEMPTS) -> list:
+    """
+    renders jobs (a list of (split, imgidx) tuples) to outdir using up to n_procs blender processes at a time, whose Cycles thread counts
+    add up to n_cores, and supervises them through the progress lines they print (see render_image.report_progress):
+    - a process that spends more than timeout seconds on one job (or, without queue_dir, on starting up) is presumed hung and killed
+    - a job fails if its process dies or is killed while rendering it, reports that it failed, or leaves no complete png
+    - failed jobs are retried in a new process after BACKOFF_SECONDS (doubling with every attempt), up to max_attempts tries;
+      jobs a dead process had not started yet go to another process without counting as an attempt
+    each process gets its own job file and log in a private temporary directory, so several drivers can share a directory
+    worker_args are passed on to every render_image.py process
+    timing_dir: if given, each process writes its timing log there (named after the temporary directory, so drivers don't collide)
+    queue_dir: if given, jobs is ignored and every process pulls jobs from this job queue (see job_queue.py) until it is drained;
+      hung processes are killed and their job released, and processes that die are replaced while the queue has jobs
+      (the queue itself limits the attempts per job, see job_queue.MAX_ATTEMPTS)
+    returns the jobs that failed every attempt (with queue_dir: the jobs in the queue's failed/ directory)
+    """
+    if queue_dir is None:
+        n_procs = max(1, min(n_procs, len(jobs)))
+    threads = split_threads(n_cores, n_procs)
+    workdir = tempfile.mkdtemp(prefix="customclevr_render_")
+    worker_args = ["--outdir", outdir] + worker_args
+    annotation_passes = "--annotations" in worker_args
+    attempts = {job:0 for job in jobs}
+    ready_at = {job:0.0 for job in jobs} # when each pending job may be (re)tried
+    pending = list(jobs)
+    gave_up = []
+    n_failures = 0
+    workers = [None] * n_procs # per slot: the running process (see launch_worker), or None
+    slot_exits = [0] * n_procs # with queue_dir: exits of the slot's processes in a row that finished no job
+    slot_ready_at = [0.0] * n_procs # with queue_dir: when the slot may start a new process
+    n_launched = 0
+    n_views = {} # split -> views per layout, read from the split's records when first needed
+    what = str(len(jobs)) + " images" if queue_dir is None else "jobs from " + queue_dir
+    print("rendering " + what + " with " + str(n_procs) + " blender processes (threads per process: " + str(threads) + ")...")
+
+    start = time.time()
+    while True:
+        now = time.time()
+        for slot, worker in enumerate(workers):
+            if worker is None:
+                continue
+            read_progress(worker)
+            # a process between jobs of a queue may be waiting (printing nothing) for other workers' leases to expire
+            busy_since = worker["job_start"] if worker["job"] is not None else (worker["last_progress"] if queue_dir is None else now)
+            if worker["proc"].poll() is None and now - busy_since > timeout:
+                print("killing blender process " + worker["name"] + ": no progress for " + str(int(now - busy_since)) + " s on "
+                      + (job_label(worker["job"]) if worker["job"] is not None else "startup"))
+                worker["proc"].kill()
+                worker["proc"].wait()
+                worker["timed_out"] = True
+            if worker["proc"].poll() is None:
+                continue
+            read_progress(worker) # lines written right before exiting
+            worker["log"].close()
+            workers[slot] = None
+            if queue_dir is not None:
+                if worker["timed_out"] and worker["job"] is not None:
+                    job_queue.release(queue_dir, *worker["job"], pid=worker["proc"].pid) # counts as an attempt when it is claimed again
+                slot_exits[slot] = 0 if len(worker["done"]) > 0 else slot_exits[slot] + 1
+                if worker["proc"].returncode != 0:
+                    n_failures += 1
+                    slot_ready_at[slot] = now + BACKOFF_SECONDS * 2**max(0, slot_exits[slot] - 1)
+                    print("blender process " + worker["name"] + " exited with code " + str(worker["proc"].returncode) + " (log: " + worker["log"].name + ")")
+                continue
+            for job in worker["jobs"]:
+                img_path = image_file_path(outdir, *job)
+                if job in worker["done"] and output_complete(img_path, annotation_passes) and os.path.getmtime(img_path) >= worker["launched"]:
+                    continue
+                if job not in worker["started"]:
+                    pending.append(job) # its process died before getting to it
+                    continue
+                n_failures += 1
+                attempts[job] += 1
+                if worker["timed_out"] and job == worker["job"]:
+                    reason = "timed out"
+                elif job in worker["failed"]:
+                    reason = "failed to render"
+                elif job in worker["done"]:
+                    reason = "left a missing or incomplete image"
+                else:
+                    reason = "crashed blender (exit code " + str(worker["proc"].returncode) + ")"
+                if attempts[job] >= max_attempts:
+                    gave_up.append(job)
+                    print(job_label(job) + " " + reason + " on attempt " + str(attempts[job]) + " of " + str(max_attempts) + ", giving up (log: " + worker["log"].name + ")")
+                else:
+                    ready_at[job] = now + BACKOFF_SECONDS * 2**(attempts[job] - 1)
+                    pending.append(job)
+                    print(job_label(job) + " " + reason + " on attempt " + str(attempts[job]) + " of " + str(max_attempts) + ", retrying in "
+                          + str(int(ready_at[job] - now)) + " s (log: " + worker["log"].name + ")")
+
+        free = [slot for slot in range(n_procs) if workers[slot] is None]
+        if queue_dir is None:
+            # deal the jobs that are ready out round-robin, so every process gets a similar mix of splits and scenes
+            # (whole layouts at a time, so a process renders all the views of a layout after building it once)
+            ready = group_layouts([job for job in pending if ready_at[job] <= now], n_views)
+            free = free[:len(ready)]
+            for i, slot in enumerate(free):
+                workers[slot] = launch_worker(workdir, n_launched, [job for group in ready[i::len(free)] for job in group], None, blender, threads[slot], worker_args, timing_dir)
+                n_launched += 1
+            pending = [job for job in pending if ready_at[job] > now] if len(free) > 0 else pending
+            if len(pending) == 0 and all(worker is None for worker in workers):
+                break
+        else:
+            counts = job_queue.status(queue_dir)
+            has_jobs = counts["pending"] + counts["leases"] > 0
+            for slot in free:
+                if has_jobs and slot_exits[slot] < max_attempts and slot_ready_at[slot] <= now:
+                    workers[slot] = launch_worker(workdir, n_launched, None, queue_dir, blender, threads[slot], worker_args, timing_dir)
+                    n_launched += 1
+            if all(worker is None for worker in workers) and (not has_jobs or all(n >= max_attempts for n in slot_exits)):
+                break
+        time.sleep(POLL_SECONDS)
+
+    elapsed = time.time() - start
+    if queue_dir is None:
+        print("rendered " + str(len(jobs) - len(gave_up)) + " of " + str(len(jobs)) + " images in %.1f s (%.2f s per image)" % (elapsed, elapsed / len(jobs)))
+    else:
+        print("queue drained after %.1f s" % elapsed if not has_jobs else "gave up on the queue after %.1f s: its workers keep failing" % elapsed)
+        gave_up = [job_queue.parse_job_name(name) for name in sorted(os.listdir(os.path.join(queue_dir, "failed"))) if name.endswith(".job")]
+    if len(gave_up) > 0:
+        print(str(len(gave_up)) + " images failed every attempt: " + " ".join(job_label(job) for job in gave_up))
+
+    if n_failures == 0 and not keep_logs:
+        shutil.rmtree(workdir)
+    else:
+        print("job files and logs are in " + workdir)
+    return gave_up
+
+
+def launch_worker(workdir:str, workeridx:int, jobs:list, queue_dir:str, blender:str, threads:int, worker_args:list, timing_dir:str) -> dict:
+    """starts one render_image.py process on jobs (or pulling from queue_dir) and returns what render_parallel tracks about it"""
+    name = "%03d" % workeridx
+    if queue_dir is None:
+        jobfile = os.path.join(workdir, "jobs_" + name + ".txt")
+        with open(jobfile, "w") as f:
+            for split, imgidx in jobs:
+                f.write(split + " " + str(imgidx) + "\n")
+        job_args = ["--jobfile", jobfile]
+    else:
+        job_args = ["--queue", queue_dir]
+    cmd = [blender, "--background", "--python", "render_image.py", "--"] + job_args + ["--threads", str(threads)] + worker_args
+    if timing_dir is not None:
+        cmd += ["--timing_log", os.path.join(timing_dir, os.path.basename(workdir) + "_" + name + ".jsonl")]
+    log = open(os.path.join(workdir, "log_" + name + ".txt"), "w")
+    now = time.time()
+    return {"name":name, "jobs":jobs, "log":log, "proc":subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT), "launched":now,
+            "read_pos":0, "partial":"", "last_progress":now, "job":None, "job_start":now, "started":set(), "done":set(), "failed":set(), "timed_out":False}
+
+
+def read_progress(worker:dict):
+    """reads the progress lines (see render_image.report_progress) the worker printed since the last call. modifies worker"""
+    with open(worker["log"].name, "r", errors="replace") as f:
+        f.seek(worker["read_pos"])
+        text = worker["partial"] + f.read()
+        worker["read_pos"] = f.tell()
+    lines = text.split("\n")
+    worker["partial"] = lines.pop() # not terminated yet
+    for line in lines:
+        parts = line.split()
+        if len(parts) != 4 or parts[0] != PROGRESS_PREFIX:
+            continue
+        job = (parts[2], int(parts[3]))
+        worker["last_progress"] = time.time()
+        if parts[1] == "start":
+            worker["job"] = job
+            worker["job_start"] = worker["last_progress"]
+            worker["started"].add(job)
+        else:
+            worker["job"] = None
+            worker[parts[1]].add(job) # done or failed
+
+
+def group_layouts(jobs:list, n_views:dict) -> list:
+    """
+    jobs grouped by the object layout they show (see image_records.views_per_layout), each group in imgidx order; every job
+    is its own group unless its split has several views per layout. n_views caches the views per layout of each split
+    """
+    groups = {}
+    for split, imgidx in jobs:
+        if split not in n_views:
+            n_views[split] = image_records.views_per_layout(image_records.read_header(image_records.records_path(split)))
+        groups.setdefault((split, imgidx // n_views[split]), []).append((split, imgidx))
+    return [sorted(group) for group in groups.values()]
+
+
+def job_label(job:tuple) -> str:
+    return job[0] + ":" + str(job[1])
+
+
+def split_threads(n_cores:int, n_procs:int) -> list:
+    """per-process thread counts that add up to n_cores (at least one thread each)"""
+    return [max(1, n_cores // n_procs + (1 if procidx < n_cores % n_procs else 0)) for procidx in range(n_procs)]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# Render settings shared by config_images.py and render_image.py, and named quality profiles selectable per run.
+# Does not import bpy itself, so the profiles can be read outside blender (e.g. by render_benchmark.py).
+# Also reads the per-host throughput settings (tile size, threads and processes) that render_autotune.py writes.
+from __future__ import print_function
+import json
+import os
+import socket
+
+
+RESOLUTION = (320, 240) # the width and height (in pixels) for the rendered images
+DEFAULT_PROFILE = "reference" # what every image so far was rendered with
+DEFAULT_TILE = 512 # render tile size when this host has no tuned one
+HOST_PROFILE_DIR = "host_profiles" # <hostname>.json per host, written by render_autotune.py
+
+# None means keep whatever data/base_scene.blend has
+PROFILES = {
+    "draft": {
+        "samples": 64, # the number of samples to use when rendering. Larger values will result in nicer images but will cause rendering to take longer.
+        "adaptive_sampling": True, # stop sampling pixels whose noise is below adaptive_threshold
+        "adaptive_threshold": 0.05,
+        "adaptive_min_samples": 16,
+        "denoise": True,
+        "max_bounces": 4,
+        "diffuse_bounces": 2,
+        "glossy_bounces": 2,
+        "transmission_bounces": 2,
+        "transparent_bounces": 4,
+    },
+    "standard": {
+        "samples": 256,
+        "adaptive_sampling": True,
+        "adaptive_threshold": 0.01,
+        "adaptive_min_samples": 32,
+        "denoise": True,
+        "max_bounces": 8,
+        "diffuse_bounces": 4,
+        "glossy_bounces": 4,
+        "transmission_bounces": 8,
+        "transparent_bounces": 8,
+    },
+    "reference": { # the settings the original code hard-coded
+        "samples": 512,
+        "adaptive_sampling": False,
+        "adaptive_threshold": None,
+        "adaptive_min_samples": None,
+        "denoise": False,
+        "max_bounces": None,
+        "diffuse_bounces": None,
+        "glossy_bounces": None,
+        "transmission_bounces": None,
+        "transparent_bounces": 8, # the minimum and maximum number of transparent bounces to use for rendering
+    },
+}
+
+
+def apply_render_settings(scene, world, view_layer, profile:str=DEFAULT_PROFILE, threads:int=0, tile:int=DEFAULT_TILE):
+    """
+    sets up Cycles on a blender scene (e.g. bpy.context.scene, bpy.data.worlds["World"], bpy.context.view_layer)
+    - profile: key of PROFILES
+    - threads: number of render threads (0 = let blender use all cores)
+    - tile: the tile size to use for rendering
+    """
+    settings = PROFILES[profile]
+    render_args = scene.render
+    render_args.engine = "CYCLES" # we use functionality specific to the CYCLES renderer so BLENDER_RENDER cannot be used
+    render_args.resolution_x = RESOLUTION[0]
+    render_args.resolution_y = RESOLUTION[1]
+    render_args.resolution_percentage = 100
+    apply_throughput_settings(scene, threads, tile)
+    world.cycles.sample_as_light = True
+    scene.cycles.blur_glossy     = 2.0
+    # for GPU (doesn't work rn)
+    # scene.cycles.device = "GPU"
+    # cycles_prefs = bpy.context.user_preferences.addons["cycles"].preferences
+    # cycles_prefs.compute_device_type = "CUDA"
+
+    scene.cycles.samples = settings["samples"]
+    scene.cycles.use_adaptive_sampling = settings["adaptive_sampling"]
+    if settings["adaptive_threshold"] is not None:
+        scene.cycles.adaptive_threshold = settings["adaptive_threshold"]
+    if settings["adaptive_min_samples"] is not None:
+        scene.cycles.adaptive_min_samples = settings["adaptive_min_samples"]
+    view_layer.cycles.use_denoising = settings["denoise"]
+    if settings["denoise"] and hasattr(scene.cycles, "denoiser"): # blender >= 2.90
+        scene.cycles.denoiser = "OPENIMAGEDENOISE"
+    for key in ["max_bounces", "diffuse_bounces", "glossy_bounces", "transmission_bounces"]:
+        if settings[key] is not None:
+            setattr(scene.cycles, key, settings[key])
+    scene.cycles.transparent_min_bounces = settings["transparent_bounces"]
+    scene.cycles.transparent_max_bounces = settings["transparent_bounces"]
+
+
+def apply_throughput_settings(scene, threads:int=0, tile:int=DEFAULT_TILE):
+    """the settings of apply_render_settings that only affect speed, e.g. to set per process on a prepared scene (see scene_template.py)"""
+    render_args = scene.render
+    render_args.tile_x = tile
+    render_args.tile_y = tile
+    # ^ render tile size should not affect the quality of the rendered image but may affect the speed;
+    # CPU-based rendering may achieve better performance using smaller tile sizes,
+    # while larger tile sizes may be optimal for GPU-based rendering.
+    if threads > 0: # e.g. when several blender processes share one machine (see render_parallel.py)
+        render_args.threads_mode = "FIXED"
+        render_args.threads = threads
+
+
+def profile_settings(profile:str=DEFAULT_PROFILE) -> dict:
+    """everything apply_render_settings sets that can change the rendered pixels, e.g. to record alongside renders"""
+    settings = dict(PROFILES[profile])
+    settings["profile"] = profile
+    settings["resolution"] = list(RESOLUTION)
+    settings["blur_glossy"] = 2.0
+    settings["sample_as_light"] = True
+    return settings
+
+
+def host_profile_path(hostname:str=None) -> str:
+    return os.path.join(HOST_PROFILE_DIR, (hostname or socket.gethostname()) + ".json")
+
+
+def read_host_profile(profile:str=DEFAULT_PROFILE):
+    """
+    the tile size, threads per process and number of processes render_autotune.py found fastest for profile on this host,
+    as a dict, or None if it was not tuned (or was tuned with a different number of cores)
+    """
+    path = host_profile_path()
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        host = json.load(f)
+    if host["n_cores"] != os.cpu_count() or profile not in host["profiles"]:
+        return None
+    return host["profiles"][profile]
@@ -3,20 +3,9 @@
 # first, run once to compute config.txt instead of rendering
 ../blender-2.83.20-linux-x64/blender --background --python config_images.py
 
-echo "trnsimple" > split.txt
-for i in $(seq 0 99) # inclusive-inclusive
-do
-    echo "$i" > img2render.txt # pass image number to the script via file
-    ../blender-2.83.20-linux-x64/blender --background --python render_image.py
-    rm img2render.txt
-done
-rm split.txt
+# bake the base scene, shapes, materials and render settings into one template .blend the render processes start from
+../blender-2.83.20-linux-x64/blender --background --python scene_template.py
 
-echo "tstsimple" > split.txt
-for i in $(seq 0 99) # inclusive-inclusive
-do
-    echo "$i" > img2render.txt # pass image number to the script via file
-    ../blender-2.83.20-linux-x64/blender --background --python render_image.py
-    rm img2render.txt
-done
-rm split.txt
\ No newline at end of file
+# then render every image of both splits, spread over several blender processes that together use every core
+# (render_parallel.py needs numpy but not bpy, so the python packed with blender, which has numpy, runs it)
+../blender-2.83.20-linux-x64/2.83/python/bin/python3.7m render_parallel.py --jobs trnsimple:0-99 tstsimple:0-99 # inclusive-inclusive
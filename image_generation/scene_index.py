@@ -0,0 +1,241 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Inverted index over a split's scene metadata for selecting stimuli without scanning every scene:
+# one bitset (bit row = image) per attribute value of every object slot, per relationship between every pair of slots,
+# and for eyes_same_color and the randomized object. Queries combine bitsets with AND/OR, e.g.
+#   index = scene_index.read_index("trnsimple")
+#   bits = scene_index.all_of(scene_index.related(index, "left", {"color":"red", "material":"metal", "shape":"cube"}, {"shape":"sphere"}),
+#                             scene_index.randomized(index, part="mouth"))
+#   scene_index.select(index, bits) # the matching image indices
+# ../output/customclevr_<split>_index/ holds
+#   bitsets.npy  n_bitsets x ceil(n_images / 8) uint8, bit row of image row (little-endian bit order, see np.packbits)
+#   imgidx.npy   the imgidx of every row
+#   header.json  the name of every bitset, attribute values, face parts; written last, so an index without it is incomplete
+# Bitset names: "object/<objidx>/<attribute>/<value>", "relationship/<rel>/<i>/<j>" (object j is <rel> of object i, as in
+# scene["relationships"][rel][i]), "eyes_same_color", "randomized" and "randomized_obj/<objidx>".
+from __future__ import print_function
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import column_store
+import config_stream
+import relationships
+
+
+FORMAT_VERSION = 1
+ATTRIBUTES = {"shape":("shape_idx", "shapes"), "color":("color_idx", "colors"), "material":("mat_idx", "materials"), "size":("size_idx", "sizes")}
+# ^ attribute -> (array config field, config key whose keys are the value names in index order)
+CHUNK_SIZE = 1 << 20 # rows per build step, to bound memory (a multiple of 8, so chunks start on a byte)
+
+open_indexes = {} # split -> index (see load), opened by read_index the first time it is needed
+
+
+def index_path(split:str) -> str:
+    return "../output/customclevr_" + split + "_index"
+
+
+def bitset_names(config:dict) -> list:
+    """the bitsets of an index of a split with config's settings, in bitsets.npy row order"""
+    names = []
+    for objidx in range(config["n_objects"]):
+        for attribute, (_, key) in ATTRIBUTES.items():
+            names += ["object/%d/%s/%s" % (objidx, attribute, value) for value in config[key]]
+    for rel in relationships.RELATIONSHIP_NAMES:
+        names += ["relationship/%s/%d/%d" % (rel, i, j) for i in range(config["n_objects"]) for j in range(config["n_objects"]) if i != j]
+    names += ["eyes_same_color", "randomized"] + ["randomized_obj/%d" % objidx for objidx in range(config["n_objects"])]
+    return names
+
+
+def chunk_bits(config:dict, relationship_bits:np.ndarray, rows:slice) -> np.ndarray:
+    """n_bitsets x n_rows bool matrix (bitset_names order) for rows of an array config and its relationship_bits column"""
+    k = config["n_objects"]
+    bits = []
+    for objidx in range(k):
+        for attribute, (field, key) in ATTRIBUTES.items():
+            values = np.asarray(config[field][rows, objidx])
+            bits += [values == v for v in range(len(config[key]))]
+    rel_bits = np.asarray(relationship_bits[rows])
+    for relidx in range(len(relationships.RELATIONSHIP_NAMES)):
+        for i in range(k):
+            bits += [(rel_bits[:, relidx, i] >> np.uint64(j)) & np.uint64(1) == 1 for j in range(k) if i != j]
+    # a moved object (see config_images.randomize_pos) is recorded as randomized_obj_idx in odd layouts only; it is 0 elsewhere
+    n_views = config.get("n_views", 1)
+    has_randomized = (np.asarray(config["imgidx"][rows]) // n_views) % 2 == 1
+    randomized_obj = np.asarray(config["randomized_obj_idx"][rows])
+    bits += [np.asarray(config["eyes_same_color"][rows]), has_randomized] + [has_randomized & (randomized_obj == objidx) for objidx in range(k)]
+    return np.array(bits, dtype=bool)
+
+
+def build(parts, path:str, n_images:int):
+    """
+    writes the index of a split at path from parts, an iterable of (array config, scene columns) (see column_store.load) that
+    together hold n_images rows in order, e.g. the shards of config_stream.iterate_shards
+    """
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, "header.json")):
+        os.remove(os.path.join(path, "header.json")) # the index is incomplete until the new header is written
+    bitsets = None
+    imgidx = np.lib.format.open_memmap(os.path.join(path, "imgidx.npy"), mode="w+", dtype=np.int64, shape=(n_images,))
+    start = 0
+    for config, scene in parts:
+        if bitsets is None:
+            names = bitset_names(config)
+            bitsets = np.lib.format.open_memmap(os.path.join(path, "bitsets.npy"), mode="w+", dtype=np.uint8, shape=(len(names), (n_images + 7) // 8))
+            header = {"format_version":FORMAT_VERSION, "split":config["split"], "n_images":n_images, "n_objects":config["n_objects"],
+                      "faceparts":config["faceparts"], "values":{attribute:list(config[key]) for attribute, (_, key) in ATTRIBUTES.items()}, "bitsets":names}
+        n = len(config["imgidx"])
+        imgidx[start:start + n] = config["imgidx"]
+        for row in range(0, n, CHUNK_SIZE):
+            bits = chunk_bits(config, scene["relationship_bits"], slice(row, min(row + CHUNK_SIZE, n)))
+            # a part may start in the middle of a byte: pad it on the left to the byte boundary and OR it into that byte
+            offset = (start + row) % 8
+            packed = np.packbits(np.pad(bits, ((0, 0), (offset, 0))), axis=1, bitorder="little")
+            first = (start + row) // 8
+            bitsets[:, first:first + packed.shape[1]] |= packed
+        start += n
+    assert start == n_images, "parts hold " + str(start) + " rows, not " + str(n_images)
+    bitsets.flush()
+    imgidx.flush()
+    del bitsets, imgidx
+    with open(os.path.join(path, "header.json"), "w") as f:
+        json.dump(header, f, indent=1)
+
+
+def load(path:str) -> dict:
+    """opens an index written by build(); bitsets are memory-mapped, and "rows" maps bitset name -> row of bitsets"""
+    with open(os.path.join(path, "header.json"), "r") as f:
+        header = json.load(f)
+    assert header["format_version"] == FORMAT_VERSION
+    return {"header":header, "bitsets":np.load(os.path.join(path, "bitsets.npy"), mmap_mode="r"), "imgidx":np.load(os.path.join(path, "imgidx.npy")),
+            "rows":{name:row for row, name in enumerate(header["bitsets"])}}
+
+
+def read_index(split:str) -> dict:
+    """the split's index at index_path(split), opened the first time it is needed"""
+    if split not in open_indexes:
+        open_indexes[split] = load(index_path(split))
+    return open_indexes[split]
+
+
+def bitset(index:dict, name:str) -> np.ndarray:
+    return index["bitsets"][index["rows"][name]]
+
+
+def all_of(*bitsets) -> np.ndarray:
+    """AND"""
+    return np.bitwise_and.reduce(np.array(bitsets), axis=0)
+
+
+def any_of(*bitsets) -> np.ndarray:
+    """OR"""
+    return np.bitwise_or.reduce(np.array(bitsets), axis=0)
+
+
+def negate(index:dict, bits:np.ndarray) -> np.ndarray:
+    """NOT (the padding bits after the last image stay 0)"""
+    return all_of(np.invert(bits), everything(index))
+
+
+def everything(index:dict) -> np.ndarray:
+    """the bitset of every image"""
+    n = index["header"]["n_images"]
+    return np.packbits(np.ones(n, dtype=bool), bitorder="little")
+
+
+def nothing(index:dict) -> np.ndarray:
+    return np.zeros(index["bitsets"].shape[1], dtype=np.uint8)
+
+
+def object_slots(index:dict, part:str=None) -> list:
+    """the objidx of every object, or of the objects of one face part (e.g. "mouth")"""
+    faceparts = index["header"]["faceparts"]
+    assert part is None or part in faceparts, "unknown face part " + str(part)
+    return [objidx for objidx in range(index["header"]["n_objects"]) if part is None or faceparts[objidx] == part]
+
+
+def object_is(index:dict, objidx:int, **attributes) -> np.ndarray:
+    """images where object objidx has all the given attribute values, e.g. object_is(index, 2, color="red", shape="cube")"""
+    bits = [bitset(index, "object/%d/%s/%s" % (objidx, attribute, value)) for attribute, value in attributes.items()]
+    return all_of(*bits) if len(bits) > 0 else everything(index)
+
+
+def object_matches(index:dict, part:str=None, **attributes) -> dict:
+    """objidx -> images where that object (of face part, if given) has all the given attribute values"""
+    return {objidx:object_is(index, objidx, **attributes) for objidx in object_slots(index, part)}
+
+
+def has_object(index:dict, part:str=None, **attributes) -> np.ndarray:
+    """images with some object (of face part, if given) that has all the given attribute values, e.g. has_object(index, part="eye", color="blue")"""
+    return any_of(nothing(index), *object_matches(index, part, **attributes).values())
+
+
+def related(index:dict, relationship:str, subject:dict, reference:dict) -> np.ndarray:
+    """
+    images where some object matching subject is <relationship> (behind, front, left or right) of another object matching reference;
+    subject and reference are attribute values plus, optionally, "part", e.g. related(index, "left", {"color":"red"}, {"shape":"sphere"})
+    """
+    subjects = object_matches(index, **subject)
+    references = object_matches(index, **reference)
+    bits = [all_of(subject_bits, reference_bits, bitset(index, "relationship/%s/%d/%d" % (relationship, j, i)))
+            for i, subject_bits in subjects.items() for j, reference_bits in references.items() if i != j]
+    return any_of(nothing(index), *bits)
+
+
+def eyes_same_color(index:dict) -> np.ndarray:
+    return bitset(index, "eyes_same_color")
+
+
+def randomized(index:dict, part:str=None, **attributes) -> np.ndarray:
+    """images whose randomly placed object is of face part (any, if None) and has all the given attribute values"""
+    return any_of(nothing(index), *[all_of(bitset(index, "randomized_obj/%d" % objidx), bits) for objidx, bits in object_matches(index, part, **attributes).items()])
+
+
+def count(bits:np.ndarray) -> int:
+    """number of images in a bitset"""
+    return int(np.unpackbits(bits).sum())
+
+
+def select(index:dict, bits:np.ndarray) -> np.ndarray:
+    """the imgidx of the images in a bitset, in index order"""
+    return index["imgidx"][np.nonzero(np.unpackbits(bits, count=index["header"]["n_images"], bitorder="little"))[0]]
+
+
+def json_parts(split:str):
+    """the split's *_config.json and *_scenes.json as a single part for build()"""
+    with open("../output/customclevr_" + split + "_config.json", "r") as f:
+        json_config = json.load(f)
+    with open("../output/customclevr_" + split + "_scenes.json", "r") as f:
+        json_scenes = json.load(f)["scenes"]
+    yield column_store.from_json(json_config, json_scenes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build the attribute and relationship index of splits at ../output/customclevr_<split>_index/ (see README.md)")
+    parser.add_argument("--splits", type=str, nargs="+", default=["trnsimple", "tstsimple"], help="which splits")
+    parser.add_argument("--source", type=str, default="json", choices=["json", "columns", "stream"],
+                        help="read the split from its *_config.json and *_scenes.json, its column store (column_store.py) or its shards (config_stream.py)")
+    args = parser.parse_args()
+
+    for split in args.splits:
+        start = time.time()
+        if args.source == "json":
+            with open("../output/customclevr_" + split + "_config.json", "r") as f:
+                n_images = json.load(f)["n_images"]
+            parts = json_parts(split)
+        elif args.source == "columns":
+            parts = [column_store.load(column_store.store_path(split))]
+            n_images = len(parts[0][0]["imgidx"])
+        else:
+            with open(os.path.join(config_stream.stream_path(split), "manifest.json"), "r") as f:
+                n_images = json.load(f)["n_images"]
+            parts = config_stream.iterate_shards(config_stream.stream_path(split))
+        build(parts, index_path(split), n_images)
+        print("indexed " + str(n_images) + " " + split + " scenes into " + index_path(split) + " in %.1f s" % (time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
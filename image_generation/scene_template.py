@@ -0,0 +1,106 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Prepared scene templates: the base scene with every shape and material node group already loaded and a render profile
+# (and, optionally, the annotation passes) applied, saved as one self-contained .blend file, so a render_image.py process
+# starts with a single file open instead of opening data/base_scene.blend and reading every shape and material file.
+# ../output/templates/template_<key>.blend, where key is a hash of everything baked into it (see template_inputs): the
+# asset files' sizes and modification times, the render profile, the annotation passes and the blender version. A template
+# whose inputs have changed is never used: its key no longer matches, and render_image.py falls back to loading the assets
+# one by one.
+# Threads and tile size are per process (see render_parallel.py and render_autotune.py) and are set after opening it.
+# Run with blender, e.g. blender --background --python scene_template.py -- --profiles reference draft
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import image_records
+import render_settings
+
+INSIDE_BLENDER = True
+try:
+    import bpy
+except ImportError as e:
+    INSIDE_BLENDER = False
+
+
+TEMPLATE_VERSION = 1 # bump when render_image.setup_scene changes what it sets up, to invalidate every template
+TEMPLATE_DIR = "../output/templates"
+
+
+def asset_stamp(path:str) -> list:
+    """size and modification time of an asset file; unlike a content hash (see render_cache.py) it costs no reads"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def template_inputs(config:dict, profile:str=render_settings.DEFAULT_PROFILE, annotation_passes:bool=False) -> dict:
+    """everything a template for a split with config's settings holds (see render_image.setup_scene)"""
+    materials = sorted(os.path.splitext(fn)[0] for fn in os.listdir(config["material_dir"]) if fn.endswith(".blend"))
+    return {"version":TEMPLATE_VERSION, "blender":bpy.app.version_string if INSIDE_BLENDER else None,
+            "base_scene":asset_stamp(config["base_scene_blendfile"]),
+            "shapes":{shape:asset_stamp(os.path.join(config["shape_dir"], shape + ".blend")) for shape in sorted(set(config["shapes"].values()))},
+            "materials":{material:asset_stamp(os.path.join(config["material_dir"], material + ".blend")) for material in materials},
+            "render":render_settings.profile_settings(profile), "annotation_passes":annotation_passes}
+
+
+def template_key(config:dict, profile:str=render_settings.DEFAULT_PROFILE, annotation_passes:bool=False) -> str:
+    return hashlib.sha256(json.dumps(template_inputs(config, profile, annotation_passes), sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def template_path(key:str) -> str:
+    return os.path.join(TEMPLATE_DIR, "template_" + key + ".blend")
+
+
+def find_template(config:dict, profile:str=render_settings.DEFAULT_PROFILE, annotation_passes:bool=False) -> str:
+    """the path of the prepared template for these settings, or None if there is none"""
+    path = template_path(template_key(config, profile, annotation_passes))
+    return path if os.path.exists(path) else None
+
+
+def prepare(config:dict, profile:str=render_settings.DEFAULT_PROFILE, annotation_passes:bool=False) -> str:
+    """sets up the scene as render_image.py does, with every shape and material loaded, and saves it as the template; returns its path"""
+    import render_image # render_image.py imports this module
+    path = template_path(template_key(config, profile, annotation_passes))
+    render_image.setup_scene(config, profile=profile, annotation_passes=annotation_passes, use_template=False)
+    for shape in sorted(set(config["shapes"].values())):
+        render_image.load_shape(config["shape_dir"], shape) # kept by its fake user, although no object uses it yet
+    for group in bpy.data.node_groups:
+        group.use_fake_user = True # not used by any material yet, so it would not be saved otherwise
+    bpy.ops.file.pack_all() # e.g. textures, so the template does not depend on any other file
+
+    os.makedirs(TEMPLATE_DIR, exist_ok=True)
+    tmp = path[:-len(".blend")] + ".tmp%d.blend" % os.getpid() # renamed when complete, so workers never open a partial file
+    bpy.ops.wm.save_as_mainfile(filepath=tmp, compress=False, copy=True) # uncompressed: opened by every worker process
+    os.replace(tmp, path)
+    with open(path[:-len(".blend")] + ".json", "w") as f:
+        json.dump(template_inputs(config, profile, annotation_passes), f, indent=1)
+    return path
+
+
+def main():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(description="prepare the scene templates render_image.py starts from (see README.md)")
+    parser.add_argument("--splits", type=str, nargs="+", default=["trnsimple", "tstsimple"], help="splits whose assets to prepare (splits with the same assets share a template)")
+    parser.add_argument("--profiles", type=str, nargs="+", default=[render_settings.DEFAULT_PROFILE], choices=sorted(render_settings.PROFILES.keys()), help="render profiles to prepare")
+    parser.add_argument("--annotations", action="store_true", help="prepare templates for rendering with --annotations")
+    parser.add_argument("--force", action="store_true", help="prepare templates again even if they exist")
+    args = parser.parse_args(argv)
+
+    for split in args.splits:
+        config = image_records.read_header(image_records.records_path(split))
+        for profile in args.profiles:
+            path = find_template(config, profile, args.annotations)
+            if path is not None and not args.force:
+                print(split + ", profile " + profile + ": " + path + " is up to date")
+                continue
+            print(split + ", profile " + profile + ": wrote " + prepare(config, profile, args.annotations))
+
+
+if __name__ == "__main__":
+    if INSIDE_BLENDER:
+        main()
+    else:
+        print("this script is intended to be called by blender - see README.md")
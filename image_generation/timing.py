@@ -0,0 +1,92 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# Per-stage timing log: config_images.py and render_image.py append one json line per stage (open_mainfile, open_template,
+# load_materials, add_object, render, ...) with its start time, duration and image, plus the process's startup time and peak memory.
+# Logging is off (and every call nearly free) until open_log() is called. Summarize logs with timing_report.py.
+# Only uses the standard library, so it works both inside blender and in any python.
+from __future__ import print_function
+import contextlib
+import json
+import os
+import resource
+import socket
+import sys
+import time
+
+
+log_file = None # open log, or None if logging is off
+log_fields = {} # written with every event (process id, host, script)
+
+
+def open_log(path:str, script:str):
+    """starts appending events to path (one json object per line); records how long the process took to get here"""
+    global log_file
+    close_log()
+    log_dir = os.path.dirname(path)
+    if log_dir != "":
+        os.makedirs(log_dir, exist_ok=True)
+    log_file = open(path, "a")
+    log_fields.clear()
+    log_fields.update({"host":socket.gethostname(), "pid":os.getpid(), "script":script})
+    age = process_age()
+    if age is not None: # e.g. blender startup before the script runs
+        event("startup", time.time() - age, age)
+
+
+def close_log():
+    """writes the process's peak memory and stops logging"""
+    global log_file
+    if log_file is None:
+        return
+    event("process", time.time(), 0.0, peak_rss_mb=peak_rss_mb())
+    log_file.close()
+    log_file = None
+
+
+def event(stage:str, start:float, seconds:float, **fields):
+    """logs one stage that started at time start (seconds since the epoch) and took seconds; fields are e.g. split, imgidx"""
+    if log_file is None:
+        return
+    record = {"stage":stage, "start":start, "seconds":seconds}
+    record.update(log_fields)
+    record.update(fields)
+    log_file.write(json.dumps(record) + "\n")
+    log_file.flush() # so a crashed or killed process still leaves everything up to the crash
+
+
+@contextlib.contextmanager
+def stage(name:str, **fields):
+    """
+    times the body of a with statement, e.g.
+    with timing.stage("render", split=split, imgidx=imgidx):
+        bpy.ops.render.render()
+    a body that raises is logged too, with failed=True
+    """
+    if log_file is None:
+        yield
+        return
+    start = time.time()
+    tic = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        event(name, start, time.perf_counter() - tic, failed=True, **fields)
+        raise
+    event(name, start, time.perf_counter() - tic, **fields)
+
+
+def peak_rss_mb() -> float:
+    """peak resident memory of this process so far"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024.0 * 1024.0) if sys.platform == "darwin" else maxrss / 1024.0 # bytes on macOS, KiB on linux
+
+
+def process_age():
+    """seconds since this process started (linux only, else None)"""
+    try:
+        with open("/proc/self/stat", "r") as f:
+            start_ticks = float(f.read().rsplit(")", 1)[1].split()[19]) # field 22, counted after the "(comm)" field
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
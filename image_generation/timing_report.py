@@ -0,0 +1,93 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# see README.md for instructions on running this script
+# Summarizes timing logs (see timing.py): count, total and percentiles of the duration of each stage, and peak memory per process.
+from __future__ import print_function
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+
+PERCENTILES = [50, 90, 99]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="summarize per-stage timing logs written by config_images.py / render_image.py")
+    parser.add_argument("paths", type=str, nargs="+", help="timing log files, or directories of *.jsonl timing logs")
+    parser.add_argument("--split", type=str, default=None, help="only events of this split")
+    parser.add_argument("--json", type=str, default=None, help="also write the summary to this file")
+    args = parser.parse_args()
+
+    events = read_events(args.paths)
+    if args.split is not None:
+        events = [e for e in events if e.get("split", args.split) == args.split]
+    summary = summarize(events)
+    print_summary(summary)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=1)
+
+
+def read_events(paths:list) -> list:
+    """every event in the given log files / directories of log files; skips a truncated last line (e.g. of a killed process)"""
+    files = []
+    for path in paths:
+        files += sorted(glob.glob(os.path.join(path, "*.jsonl"))) if os.path.isdir(path) else [path]
+    events = []
+    for fn in files:
+        with open(fn, "r") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    return events
+
+
+def summarize(events:list) -> dict:
+    """
+    {"stages": {stage: {"count", "failed", "total", "mean", "p50", "p90", "p99", "max"}}, "processes": n, "peak_rss_mb": {"p50", "max"}}
+    stages are in order of first appearance; stages that raised (failed) count towards every statistic
+    """
+    seconds = {}
+    failed = {}
+    for e in events:
+        if e["stage"] != "process":
+            seconds.setdefault(e["stage"], []).append(e["seconds"])
+            failed[e["stage"]] = failed.get(e["stage"], 0) + int(e.get("failed", False))
+    summary = {"stages":{}}
+    for stage, values in seconds.items():
+        values = np.array(values)
+        stats = {"count":len(values), "failed":failed[stage], "total":float(values.sum()), "mean":float(values.mean()), "max":float(values.max())}
+        for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+            stats["p%d" % p] = float(value)
+        summary["stages"][stage] = stats
+
+    # peak memory: the end-of-process event if the process finished, otherwise the last per-image value
+    peaks = {}
+    for e in events:
+        if "peak_rss_mb" in e:
+            key = (e["host"], e["pid"], e["script"])
+            peaks[key] = max(peaks.get(key, 0.0), e["peak_rss_mb"])
+    summary["processes"] = len(set((e["host"], e["pid"], e["script"]) for e in events))
+    if len(peaks) > 0:
+        summary["peak_rss_mb"] = {"p50":float(np.median(list(peaks.values()))), "max":float(max(peaks.values()))}
+    return summary
+
+
+def print_summary(summary:dict):
+    header = "%-16s %8s %8s %10s %9s" % ("stage", "count", "failed", "total (s)", "mean") + "".join(" %9s" % ("p%d" % p) for p in PERCENTILES) + " %9s" % "max"
+    print(header)
+    for stage, stats in summary["stages"].items():
+        print("%-16s %8d %8d %10.1f %9.4f" % (stage, stats["count"], stats["failed"], stats["total"], stats["mean"])
+              + "".join(" %9.4f" % stats["p%d" % p] for p in PERCENTILES) + " %9.4f" % stats["max"])
+    line = str(summary["processes"]) + " processes"
+    if "peak_rss_mb" in summary:
+        line += ", peak memory per process: median %.0f MB, max %.0f MB" % (summary["peak_rss_mb"]["p50"], summary["peak_rss_mb"]["max"])
+    print(line)
+
+
+if __name__ == "__main__":
+    main()
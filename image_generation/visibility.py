@@ -0,0 +1,286 @@
+# Copyright 2023 Brain Engineering Lab at Dartmouth. Same license as original.
+# Blender-free estimate of how many pixels of each object are visible in the rendered image, to enforce min_pixels_per_object
+# while generating configs instead of finding occluded objects after rendering.
+# Casts one ray per pixel (or per stride x stride block) near each object from the camera of projection.py and intersects it
+# analytically with every object: spheres of radius r, upright cylinders of radius r and height 2r, and cubes of half size r rotated by theta
+# about z (the smooth cube's rounded edges are ignored), all resting on the ground plane like add_object() places them.
+# Objects that no other object can hide and that lie well inside the frame (most of them) skip the ray casting: their count
+# is the area of their projected silhouette (see projected_area), which agrees with the ray cast to within a few percent.
+# Checking configs (failing_images) first bounds every object's count by silhouette areas alone (see pixel_bounds) and
+# only ray casts, at a coarse stride, the objects those bounds leave undecided.
+# Run this file directly to report the visible pixels of the objects in ../output/*_config.json.
+from __future__ import print_function
+import argparse
+import json
+
+import numpy as np
+
+import projection
+
+
+SHAPE_KINDS = {"sphere":0, "cylinder":1, "cube":2} # by the shape's output name (the keys of config["shapes"])
+BOUNDING_RADIUS = np.array([1.0, np.sqrt(2.0), np.sqrt(3.0)]) # per SHAPE_KINDS, in units of r: the distance from the center to the farthest point
+CHUNK_SIZE = 32 # images ray cast at once, to bound memory (CHUNK_SIZE x n_rays temporaries)
+STRIDE = 4 # default: one ray per 4 x 4 block of pixels (the counts are checked against a threshold of hundreds of pixels)
+AREA_TOLERANCE = 0.1 # relative error allowed for projected_area in pixel_bounds (it is within 5% of the ray cast count)
+BOUNDS_CHUNK_SIZE = 65536 # images whose silhouettes are bounded at once, to bound memory (n_objects^2 temporaries per image)
+
+
+def view_offsets(px:np.ndarray, py:np.ndarray):
+    """view-plane offsets at unit depth, in units of the camera's right and up axes, of the rays through pixel positions px, py"""
+    w, h = projection.RESOLUTION
+    half_width = 0.5 * projection.CAMERA_SENSOR_WIDTH / projection.CAMERA_LENS # see projection.get_camera_coords
+    half_height = half_width * h / w
+    return (px / w - 0.5) * 2.0 * half_width, (0.5 - py / h) * 2.0 * half_height
+
+
+def ray_hits(origins:np.ndarray, dirs:np.ndarray, center:np.ndarray, r:np.ndarray, theta:np.ndarray, kind:np.ndarray) -> np.ndarray:
+    """
+    distance (in units of the ray direction) at which each ray first hits one object of each image, or inf
+    - origins: n x 3; dirs: n x n_rays x 3
+    - center (n x 3, the object location), r, theta (radians, like blender's rotation_euler), kind (SHAPE_KINDS): the object of each image
+    """
+    o = origins - center # ray origins relative to the object
+    d = dirs
+    out = np.full(d.shape[:2], np.inf)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # sphere
+        sel = kind == SHAPE_KINDS["sphere"]
+        if sel.any():
+            a = np.einsum("ijk,ijk->ij", d[sel], d[sel])
+            b = 2.0 * np.einsum("ijk,ik->ij", d[sel], o[sel])
+            c = (np.einsum("ik,ik->i", o[sel], o[sel]) - r[sel]**2)[:, None]
+            disc = b*b - 4*a*c
+            t = (-b - np.sqrt(disc)) / (2*a)
+            out[sel] = np.where((disc >= 0) & (t > 0), t, np.inf)
+
+        # upright cylinder: side wall between the ground and the top, and the top cap (the bottom one is on the ground)
+        sel = kind == SHAPE_KINDS["cylinder"]
+        if sel.any():
+            ds, os_, rs = d[sel], o[sel][:, None, :], r[sel][:, None]
+            a = ds[..., 0]**2 + ds[..., 1]**2
+            b = 2.0 * (ds[..., 0]*os_[..., 0] + ds[..., 1]*os_[..., 1])
+            c = os_[..., 0]**2 + os_[..., 1]**2 - rs**2
+            disc = b*b - 4*a*c
+            t_side = (-b - np.sqrt(disc)) / (2*a)
+            z_side = os_[..., 2] + t_side * ds[..., 2] # relative to the center, which is at height r
+            t_side = np.where((disc >= 0) & (t_side > 0) & (np.abs(z_side) <= rs), t_side, np.inf)
+            t_top = (rs - os_[..., 2]) / ds[..., 2]
+            x_top = os_[..., 0] + t_top * ds[..., 0]
+            y_top = os_[..., 1] + t_top * ds[..., 1]
+            t_top = np.where((t_top > 0) & (x_top**2 + y_top**2 <= rs**2), t_top, np.inf)
+            out[sel] = np.minimum(t_side, t_top)
+
+        # cube: slab test in the cube's own frame
+        sel = kind == SHAPE_KINDS["cube"]
+        if sel.any():
+            cos, sin = np.cos(theta[sel])[:, None], np.sin(theta[sel])[:, None]
+            ds, os_, rs = d[sel], o[sel], r[sel][:, None]
+            ol = np.stack([cos[:, 0]*os_[:, 0] + sin[:, 0]*os_[:, 1], -sin[:, 0]*os_[:, 0] + cos[:, 0]*os_[:, 1], os_[:, 2]], axis=1)
+            dl = [cos*ds[..., 0] + sin*ds[..., 1], -sin*ds[..., 0] + cos*ds[..., 1], ds[..., 2]]
+            t_near = np.full(ds.shape[:2], -np.inf)
+            t_far = np.full(ds.shape[:2], np.inf)
+            for axis in range(3):
+                t1 = (-rs - ol[:, axis:axis+1]) / dl[axis]
+                t2 = (rs - ol[:, axis:axis+1]) / dl[axis]
+                # a ray parallel to the slab (0 direction) is inside it for all t or for none
+                inside = np.abs(ol[:, axis:axis+1]) <= rs
+                t1 = np.where(dl[axis] == 0, np.where(inside, -np.inf, np.inf), t1)
+                t2 = np.where(dl[axis] == 0, np.where(inside, np.inf, -np.inf), t2)
+                t_near = np.maximum(t_near, np.minimum(t1, t2))
+                t_far = np.minimum(t_far, np.maximum(t1, t2))
+            out[sel] = np.where((t_far >= t_near) & (t_near > 0), t_near, np.inf)
+    return out
+
+
+def silhouettes(config:dict, rows:np.ndarray) -> dict:
+    """
+    camera, objects and projected silhouettes of the given images of config:
+    - px, py, radius_px: each object's projected center and bounding circle in pixels
+    - overlaps[img, i, j]: object j's bounding circle overlaps object i's, so j might hide part of i
+    - inside: the bounding circle is inside the frame, so the frame cannot cut off part of the object
+    - area: the silhouette area in pixels (see projected_area)
+    """
+    g = {}
+    g["cam_locs"] = projection.camera_locations(config)[rows]
+    g["forward"], g["right"], g["up"] = projection.camera_basis(g["cam_locs"])
+    g["coords"] = projection.object_coords(config)[rows]
+    g["theta"] = np.asarray(config["theta"], dtype=np.float64)[rows]
+    g["r"] = np.asarray(config["r"], dtype=np.float64)[rows]
+    g["kind"] = object_kinds(config)[rows]
+    k = g["r"].shape[1]
+    w, h = projection.RESOLUTION
+
+    g["px"], g["py"], g["depth"] = projection.get_camera_coords(g["cam_locs"], g["coords"])
+    g["radius"] = BOUNDING_RADIUS[g["kind"]] * g["r"]
+    g["radius_px"] = focal_px() * g["radius"] / np.maximum(g["depth"] - g["radius"], 1e-6) + 2.0
+    px, py, radius_px = g["px"], g["py"], g["radius_px"]
+    g["overlaps"] = np.hypot(px[:, :, None] - px[:, None, :], py[:, :, None] - py[:, None, :]) < radius_px[:, :, None] + radius_px[:, None, :]
+    g["overlaps"][:, np.arange(k), np.arange(k)] = False
+    g["inside"] = (px - radius_px >= 0) & (px + radius_px < w) & (py - radius_px >= 0) & (py + radius_px < h)
+    g["area"] = projected_area(g["cam_locs"], g["coords"], g["r"], g["theta"], g["kind"])
+    return g
+
+
+def pixel_bounds(g:dict):
+    """
+    lower and upper bounds (n_images x n_objects) of every object's visible pixels from silhouettes() alone, without ray casting:
+    at most its silhouette area, and at least that minus, for every object that could be in front of it, the overlap of
+    their bounding circles (0 if the frame may cut it off); both widened by AREA_TOLERANCE for the error of projected_area
+    """
+    # j can only hide i if j's nearest point is nearer than i's farthest, and at most its silhouette or the circles' overlap
+    in_front = (g["depth"] - g["radius"])[:, None, :] < (g["depth"] + g["radius"])[:, :, None]
+    d = np.hypot(g["px"][:, :, None] - g["px"][:, None, :], g["py"][:, :, None] - g["py"][:, None, :])
+    overlap = circle_overlap(g["radius_px"][:, :, None], g["radius_px"][:, None, :], d)
+    hidden = np.where(g["overlaps"] & in_front, np.minimum(overlap, g["area"][:, None, :]), 0.0).sum(axis=2)
+    lower = np.where(g["inside"], np.maximum((1.0 - AREA_TOLERANCE) * g["area"] - hidden, 0.0), 0.0)
+    return lower, (1.0 + AREA_TOLERANCE) * g["area"]
+
+
+def circle_overlap(a:np.ndarray, b:np.ndarray, d:np.ndarray) -> np.ndarray:
+    """area of the intersection of circles of radii a and b whose centers are d apart"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cos_a = np.clip((d*d + a*a - b*b) / (2*d*a), -1.0, 1.0)
+        cos_b = np.clip((d*d + b*b - a*a) / (2*d*b), -1.0, 1.0)
+        lens = a*a*np.arccos(cos_a) + b*b*np.arccos(cos_b) - 0.5 * np.sqrt(np.maximum((-d + a + b) * (d + a - b) * (d - a + b) * (d + a + b), 0.0))
+    return np.where(d >= a + b, 0.0, np.where(d <= np.abs(a - b), np.pi * np.minimum(a, b)**2, lens))
+
+
+def visible_pixels(config:dict, rows=None, stride:int=STRIDE, exact:bool=False, cast:np.ndarray=None) -> np.ndarray:
+    """
+    n_images x n_objects estimated number of visible pixels of every object (0 if fully occluded or out of frame)
+    config is a *_config.json style config or an array config (see config_arrays.py)
+    - rows: only these images (default all)
+    - stride: cast one ray per stride x stride block of pixels (faster, coarser)
+    - exact: ray cast every object; otherwise objects that nothing can hide and that are well inside the frame get their
+      projected_area() instead (within a few percent of the ray cast count, and several times faster overall)
+    - cast: n_images x n_objects which objects to ray cast (overrides the above); the others get their projected_area()
+    Rays are only cast in a window around each object's projected bounding circle, since no other ray can hit it.
+    """
+    if rows is None:
+        rows = np.arange(len(config["r"]))
+    rows = np.asarray(rows, dtype=np.int64)
+    g = silhouettes(config, rows)
+    cam_locs, forward, right, up, coords = g["cam_locs"], g["forward"], g["right"], g["up"], g["coords"]
+    theta, r, kind, px, py, radius_px, overlaps = g["theta"], g["r"], g["kind"], g["px"], g["py"], g["radius_px"], g["overlaps"]
+    n, k = r.shape
+    w, h = projection.RESOLUTION
+
+    if cast is None:
+        cast = overlaps.any(axis=2) | ~g["inside"]
+        if exact:
+            cast[:] = True
+
+    counts = np.round(g["area"]).astype(np.int64)
+    for objidx in range(k):
+        cast_rows = np.nonzero(cast[:, objidx])[0]
+        for start in range(0, len(cast_rows), CHUNK_SIZE):
+            chunk = cast_rows[start:start + CHUNK_SIZE]
+            m = len(chunk)
+            # stride-aligned window of pixel centers around the object
+            half = int(np.ceil(radius_px[chunk, objidx].max() / stride)) # window half size in rays
+            offsets = np.arange(-half, half + 1) * stride
+            x0 = (px[chunk, objidx] // stride) * stride
+            y0 = (py[chunk, objidx] // stride) * stride
+            wx = (x0[:, None, None] + offsets[None, None, :]) + np.zeros((1, len(offsets), 1)) # m x window x window
+            wy = (y0[:, None, None] + offsets[None, :, None]) + np.zeros((1, 1, len(offsets)))
+            wx = wx.reshape(m, -1) + 0.5 * stride
+            wy = wy.reshape(m, -1) + 0.5 * stride
+            in_frame = (wx >= 0) & (wx < w) & (wy >= 0) & (wy < h)
+            vx, vy = view_offsets(wx, wy)
+            dirs = forward[chunk, None, :] + vx[..., None] * right[chunk, None, :] + vy[..., None] * up[chunk, None, :]
+
+            hits = ray_hits(cam_locs[chunk], dirs, coords[chunk, objidx], r[chunk, objidx], theta[chunk, objidx], kind[chunk, objidx])
+            visible = np.isfinite(hits) & in_frame
+            for other in range(k):
+                sel = np.nonzero(overlaps[chunk, objidx, other])[0] # only objects whose bounding circle overlaps can hide part of this one
+                if len(sel) == 0:
+                    continue
+                t = ray_hits(cam_locs[chunk[sel]], dirs[sel], coords[chunk[sel], other], r[chunk[sel], other], theta[chunk[sel], other], kind[chunk[sel], other])
+                visible[sel] &= ~(t < hits[sel])
+            counts[chunk, objidx] = visible.sum(axis=1) * stride * stride
+    return counts
+
+
+def focal_px() -> float:
+    """focal length in pixels"""
+    return 0.5 * projection.RESOLUTION[0] * projection.CAMERA_LENS / (0.5 * projection.CAMERA_SENSOR_WIDTH)
+
+
+def projected_area(cam_locs:np.ndarray, coords:np.ndarray, r:np.ndarray, theta:np.ndarray, kind:np.ndarray) -> np.ndarray:
+    """
+    n_images x n_objects area in pixels of each object's silhouette, ignoring occlusion and the frame
+    the area of a convex body seen from direction v is half the sum over its faces of |n . v| times the face area
+    (for a cylinder: the top disc plus the side's height x diameter x sin of the elevation), scaled to pixels at the
+    object's distance and stretched by 1/cos^3 of its angle off the view axis (perspective)
+    """
+    view = coords - cam_locs[:, None, :]
+    dist = np.linalg.norm(view, axis=2)
+    view /= dist[..., None]
+    depth = np.einsum("ijk,ik->ij", coords - cam_locs[:, None, :], projection.camera_basis(cam_locs)[0])
+    vz = np.abs(view[..., 2])
+    vx = np.abs(np.cos(theta) * view[..., 0] + np.sin(theta) * view[..., 1]) # in the cube's own frame
+    vy = np.abs(-np.sin(theta) * view[..., 0] + np.cos(theta) * view[..., 1])
+    area = np.choose(kind, [np.pi * r**2, np.pi * r**2 * vz + 4 * r**2 * np.sqrt(1 - vz**2), 4 * r**2 * (vx + vy + vz)])
+    return area * focal_px()**2 * dist / depth**3
+
+
+def failing_images(config:dict, rows=None, stride:int=STRIDE) -> np.ndarray:
+    """
+    the images (of rows, default all) where some object has fewer than min_pixels_per_object visible pixels
+    objects whose pixel_bounds() already decide it are not ray cast, so only objects that may be partly hidden or cut off
+    near the threshold cost rays (at stride)
+    """
+    if rows is None:
+        rows = np.arange(len(config["r"]))
+    rows = np.asarray(rows, dtype=np.int64)
+    min_pixels = config["min_pixels_per_object"]
+    if min_pixels <= 0 or len(rows) == 0:
+        return rows[:0] # nothing to check
+    failing = np.zeros(len(rows), dtype=bool)
+    for start in range(0, len(rows), BOUNDS_CHUNK_SIZE):
+        chunk = slice(start, start + BOUNDS_CHUNK_SIZE)
+        lower, upper = pixel_bounds(silhouettes(config, rows[chunk]))
+        undecided = (lower < min_pixels) & (upper >= min_pixels)
+        failing[chunk] = (upper < min_pixels).any(axis=1)
+        check = np.nonzero(~failing[chunk] & undecided.any(axis=1))[0]
+        if len(check) > 0:
+            counts = visible_pixels(config, rows[chunk][check], stride, cast=undecided[check])
+            failing[start + check] = (counts < min_pixels).any(axis=1)
+    return rows[failing]
+
+
+def add_visible_pixels(scenes:list, counts:np.ndarray):
+    """records the visible pixel estimate of every object in its scene struct (as "visible_pixels"). modifies scenes"""
+    for scene, row in zip(scenes, counts.tolist()):
+        for obj, count in zip(scene["objects"], row):
+            obj["visible_pixels"] = count
+
+
+def object_kinds(config:dict) -> np.ndarray:
+    """n_images x n_objects SHAPE_KINDS values"""
+    shape_names = list(config["shapes"].keys())
+    kinds = np.array([SHAPE_KINDS[name] for name in shape_names])
+    if "shape_idx" in config:
+        return kinds[np.asarray(config["shape_idx"])]
+    return np.array([[SHAPE_KINDS[name] for name in row] for row in config["shape_name_out"]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="estimate the visible pixels of every object in ../output/customclevr_<split>_config.json")
+    parser.add_argument("--splits", type=str, nargs="+", default=["trnsimple", "tstsimple"], help="which splits")
+    parser.add_argument("--stride", type=int, default=1, help="cast one ray per stride x stride pixels (configs are checked with " + str(STRIDE) + ")")
+    parser.add_argument("--exact", action="store_true", help="ray cast every object instead of using the projected area of unoccluded ones")
+    args = parser.parse_args()
+
+    for split in args.splits:
+        with open("../output/customclevr_" + split + "_config.json", "r") as f:
+            config = json.load(f)
+        counts = visible_pixels(config, stride=args.stride, exact=args.exact)
+        failing = np.nonzero((counts < config["min_pixels_per_object"]).any(axis=1))[0]
+        print(split + ": visible pixels per object min %d, median %d; %d of %d images have an object below min_pixels_per_object (%d)%s"
+              % (counts.min(), np.median(counts), len(failing), len(counts), config["min_pixels_per_object"], (": " + str(failing.tolist())) if len(failing) > 0 else ""))
+
+
+if __name__ == "__main__":
+    main()